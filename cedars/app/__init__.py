@@ -15,6 +15,7 @@ from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMet
 from . import auth
 from . import ops
 from . import stats
+from . import mongo_metrics
 
 environment = os.getenv('ENV', 'local')
 config = dotenv_values(".env")
@@ -57,6 +58,9 @@ def create_app(config_filename=None):
 
     sess.init_app(cedars_app)
     rq_init_app(cedars_app)
+    # MongoDB command durations are exported with the other metrics
+    cedars_app.mongo_listener = mongo_metrics.MongoCommandListener(
+        cedars_app.redis, cedars_app.config.get("SLOW_QUERY_MS", 100))
 
     auth.login_manager.init_app(cedars_app)
     cedars_app.register_blueprint(auth.bp)
@@ -93,10 +97,10 @@ def setup_logging():
     # 🔴 Remove default Loguru handler (avoid duplicate logs)
     logger.remove()
 
-    # ✅ Setup Loguru logging (only DEBUG and above)
+    # ✅ Setup Loguru logging (only LOG_LEVEL and above, DEBUG by default)
     logger.add(sys.stdout,
                format="{time} {level} {message}",
-               level="DEBUG",
+               level=config.get("LOG_LEVEL", "DEBUG"),
                colorize=True)
 
     # 🔴 Suppress Flask's werkzeug logs (disable request logs)
@@ -0,0 +1,415 @@
+"""
+This module contatins the server side cache of the adjudication state of a patient.
+The annotations shown to a user and their review statuses are kept in a redis hash
+per patient, so the session only stores the patient ID and the current index and
+each request only reads the annotations it shows.
+Snapshots of the session of each user are also kept here, so a review can be
+resumed if the session is lost, along with the next patient prepared for each user.
+"""
+import json
+from array import array
+from collections.abc import Sequence
+from datetime import date, datetime
+import flask
+from loguru import logger
+from redis.exceptions import WatchError
+from .cedars_enums import log_function_call
+
+logger.enable(__name__)
+
+ADJUDICATION_KEY_PREFIX = "cedars:adjudication:"
+# Safety net for patients that are never finished or unlocked,
+# the state is deleted when the review of a patient ends.
+ADJUDICATION_TTL = 24 * 60 * 60
+ANNOTATION_FIELD_PREFIX = "annotation:"
+NOTE_INDEX_FIELD_PREFIX = "note:"
+SENTENCE_INDEX_FIELD_PREFIX = "sentence:"
+SESSION_SNAPSHOT_KEY_PREFIX = "cedars:session_snapshot:"
+# Snapshots older than this are not restored
+SESSION_SNAPSHOT_TTL = 60 * 60
+PREFETCH_KEY_PREFIX = "cedars:prefetch:"
+# Marks a prefetch that has been requested but is not ready yet
+PREFETCH_PENDING = b"pending"
+
+
+def _key(patient_id):
+    return f"{ADJUDICATION_KEY_PREFIX}{patient_id}"
+
+
+def _encode_annotation(annotation):
+    annotation = {name: value for name, value in annotation.items() if name != "_id"}
+    if isinstance(annotation.get("text_date"), datetime):
+        annotation["text_date"] = annotation["text_date"].isoformat()
+    return json.dumps(annotation)
+
+
+def _decode_annotation(value):
+    annotation = json.loads(value)
+    if annotation.get("text_date") is not None:
+        annotation["text_date"] = datetime.fromisoformat(annotation["text_date"])
+    return annotation
+
+
+def _encode_date(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.isoformat()
+
+
+def _decode_date(value):
+    value = value.decode()
+    if not value:
+        return None
+    return date.fromisoformat(value)
+
+
+class CachedAnnotations(Sequence):
+    '''
+    Read only list of the annotations of a patient stored in the cache.
+    Annotations are fetched when they are first accessed.
+    '''
+
+    def __init__(self, redis, patient_id, length):
+        self._redis = redis
+        self._key = _key(patient_id)
+        self._length = length
+        self._annotations = {}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("annotation index out of range")
+        if index not in self._annotations:
+            self.prefetch([index])
+        return self._annotations[index]
+
+    def __iter__(self):
+        self.prefetch(range(self._length))
+        for index in range(self._length):
+            yield self._annotations[index]
+
+    def prefetch(self, indices):
+        '''
+        Fetches the annotations at the given indices with a single command.
+        '''
+        indices = [index for index in indices if index not in self._annotations]
+        if not indices:
+            return
+        values = self._redis.hmget(self._key,
+                                   [f"{ANNOTATION_FIELD_PREFIX}{index}" for index in indices])
+        for index, value in zip(indices, values):
+            if value is None:
+                raise KeyError(f"Annotation {index} is missing from the adjudication cache.")
+            self._annotations[index] = _decode_annotation(value)
+
+
+class CachedIndex:
+    '''
+    Read only mapping from a note or sentence key to the offsets of its annotations.
+    The offsets of a key are fetched when they are first accessed.
+    '''
+
+    def __init__(self, redis, patient_id, field_prefix):
+        self._redis = redis
+        self._key = _key(patient_id)
+        self._field_prefix = field_prefix
+        self._offsets = {}
+
+    def get(self, key, default=None):
+        if key not in self._offsets:
+            value = self._redis.hget(self._key, f"{self._field_prefix}{key}")
+            self._offsets[key] = None if value is None else json.loads(value)
+        offsets = self._offsets[key]
+        return default if offsets is None else offsets
+
+    def __getitem__(self, key):
+        offsets = self.get(key)
+        if offsets is None:
+            raise KeyError(key)
+        return offsets
+
+
+@log_function_call
+def save_patient_data(patient_id, patient_data):
+    '''
+    Stores the adjudication state of a patient, including all of the annotations
+    shown to the user, replacing any state stored for this patient.
+
+    Args :
+        - patient_id (str) : ID for the patient currently being reviewed.
+        - patient_data (dict) : The data created by AdjudicationHandler.init_patient_data.
+
+    Returns :
+        - None
+    '''
+    redis = flask.current_app.redis
+    fields = {f"{ANNOTATION_FIELD_PREFIX}{index}": _encode_annotation(annotation)
+              for index, annotation in enumerate(patient_data["annotations"])}
+    for field_prefix, name in [(NOTE_INDEX_FIELD_PREFIX, "note_index"),
+                               (SENTENCE_INDEX_FIELD_PREFIX, "sentence_index")]:
+        fields.update({f"{field_prefix}{key}": json.dumps(offsets)
+                       for key, offsets in patient_data[name].items()})
+    fields["annotation_ids"] = json.dumps(patient_data["annotation_ids"])
+    fields.update(_state_fields(patient_data))
+
+    with redis.pipeline() as pipe:
+        pipe.delete(_key(patient_id))
+        pipe.hset(_key(patient_id), mapping=fields)
+        pipe.expire(_key(patient_id), ADJUDICATION_TTL)
+        pipe.execute()
+
+
+def _state_fields(patient_data):
+    # One byte per annotation
+    review_statuses = array('b', patient_data["review_statuses"])
+    return {"review_statuses": review_statuses.tobytes(),
+            "event_date": _encode_date(patient_data["event_date"]),
+            "event_annotation_id": patient_data["event_annotation_id"] or ""}
+
+
+@log_function_call
+def save_patient_state(patient_id, patient_data):
+    '''
+    Stores the fields of the adjudication state that change while
+    a patient is reviewed (review statuses and event date).
+
+    Args :
+        - patient_id (str) : ID for the patient currently being reviewed.
+        - patient_data (dict) : The data of an AdjudicationHandler.
+
+    Returns :
+        - None
+    '''
+    redis = flask.current_app.redis
+    with redis.pipeline() as pipe:
+        pipe.hset(_key(patient_id), mapping=_state_fields(patient_data))
+        pipe.expire(_key(patient_id), ADJUDICATION_TTL)
+        pipe.execute()
+
+
+@log_function_call
+def load_patient_data(patient_id, current_index):
+    '''
+    Loads the adjudication state of a patient.
+    The annotations are only read from the cache when they are accessed.
+
+    Args :
+        - patient_id (str) : ID for the patient currently being reviewed.
+        - current_index (int) : Index of the annotation shown to the user.
+
+    Returns :
+        - patient_data (dict) : Data for an AdjudicationHandler, None if the
+                                state of this patient is not in the cache.
+    '''
+    redis = flask.current_app.redis
+    annotation_ids, review_statuses, event_date, event_annotation_id = redis.hmget(
+        _key(patient_id),
+        ["annotation_ids", "review_statuses", "event_date", "event_annotation_id"])
+    if annotation_ids is None:
+        logger.info(f"Adjudication state of patient {patient_id} is not cached.")
+        return None
+
+    annotation_ids = json.loads(annotation_ids)
+    statuses = array('b')
+    statuses.frombytes(review_statuses)
+    return {
+        'event_date' : _decode_date(event_date),
+        'event_annotation_id' : event_annotation_id.decode() or None,
+        'annotation_ids' : annotation_ids,
+        'review_statuses' : statuses,
+        'current_index' : current_index,
+        'annotations' : CachedAnnotations(redis, patient_id, len(annotation_ids)),
+        'note_index' : CachedIndex(redis, patient_id, NOTE_INDEX_FIELD_PREFIX),
+        'sentence_index' : CachedIndex(redis, patient_id, SENTENCE_INDEX_FIELD_PREFIX)
+    }
+
+
+@log_function_call
+def has_patient_data(patient_id):
+    '''
+    Returns True if the adjudication state of a patient is cached.
+    '''
+    return flask.current_app.redis.exists(_key(patient_id)) > 0
+
+
+@log_function_call
+def delete_patient_data(patient_id):
+    '''
+    Removes the adjudication state of a patient once its review has ended.
+    '''
+    flask.current_app.redis.delete(_key(patient_id))
+
+
+def _snapshot_key(username, patient_id=None):
+    # The key without a patient points to the last patient reviewed by the user
+    if patient_id is None:
+        return f"{SESSION_SNAPSHOT_KEY_PREFIX}{username}"
+    return f"{SESSION_SNAPSHOT_KEY_PREFIX}{username}:{patient_id}"
+
+
+@log_function_call
+def save_session_snapshot(username, patient_id, snapshot):
+    '''
+    Stores a snapshot of the session of a user for the patient being reviewed.
+
+    Args :
+        - username (str) : The user reviewing the patient.
+        - patient_id (str) : ID for the patient currently being reviewed.
+        - snapshot (dict) : JSON serializable session data.
+
+    Returns :
+        - None
+    '''
+    redis = flask.current_app.redis
+    with redis.pipeline() as pipe:
+        pipe.set(_snapshot_key(username, patient_id), json.dumps(snapshot),
+                 ex=SESSION_SNAPSHOT_TTL)
+        pipe.set(_snapshot_key(username), str(patient_id), ex=SESSION_SNAPSHOT_TTL)
+        pipe.execute()
+
+
+@log_function_call
+def load_session_snapshot(username):
+    '''
+    Loads the snapshot of the last patient reviewed by a user.
+
+    Args :
+        - username (str) : The user reviewing the patient.
+
+    Returns :
+        - snapshot (dict) : The session data, None if there is no recent snapshot.
+    '''
+    redis = flask.current_app.redis
+    patient_id = redis.get(_snapshot_key(username))
+    if patient_id is None:
+        return None
+
+    snapshot = redis.get(_snapshot_key(username, patient_id.decode()))
+    if snapshot is None:
+        return None
+    return json.loads(snapshot)
+
+
+@log_function_call
+def delete_session_snapshot(username, patient_id):
+    '''
+    Removes the snapshot of a patient once its review has ended.
+    '''
+    flask.current_app.redis.delete(_snapshot_key(username, patient_id),
+                                   _snapshot_key(username))
+
+
+def _prefetch_key(username):
+    return f"{PREFETCH_KEY_PREFIX}{username}"
+
+
+@log_function_call
+def reserve_prefetch(username, ttl):
+    '''
+    Marks that the next patient of a user is being prepared.
+
+    Args :
+        - username (str) : The user reviewing patients.
+        - ttl (int) : Number of seconds after which the reservation expires.
+
+    Returns :
+        - is_reserved (bool) : False if a patient is already prepared or being prepared.
+    '''
+    return bool(flask.current_app.redis.set(_prefetch_key(username), PREFETCH_PENDING,
+                                            nx=True, ex=ttl))
+
+
+@log_function_call
+def save_prefetched_patient(username, prefetched, ttl):
+    '''
+    Stores the next patient prepared for a user, the adjudication state of
+    the patient is stored separately with save_patient_data.
+    The patient is only stored if the reservation made by reserve_prefetch
+    is still pending, i.e. the user has not stopped reviewing in the meantime.
+
+    Args :
+        - username (str) : The user reviewing patients.
+        - prefetched (dict) : JSON serializable details of the prepared patient.
+        - ttl (int) : Number of seconds for which the patient is reserved.
+
+    Returns :
+        - is_saved (bool) : False if the reservation was removed or has expired.
+    '''
+    redis = flask.current_app.redis
+    key = _prefetch_key(username)
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) != PREFETCH_PENDING:
+                return False
+            pipe.multi()
+            pipe.set(key, json.dumps(prefetched), ex=ttl)
+            pipe.execute()
+        except WatchError:
+            return False
+
+    return True
+
+
+@log_function_call
+def pop_prefetched_patient(username):
+    '''
+    Removes and returns the next patient prepared for a user.
+
+    Returns :
+        - prefetched (dict) : The details of the prepared patient, None if no
+                              patient is ready yet.
+    '''
+    redis = flask.current_app.redis
+    key = _prefetch_key(username)
+    with redis.pipeline() as pipe:
+        try:
+            # Only one request can take the prepared patient
+            pipe.watch(key)
+            value = pipe.get(key)
+            if value is None or value == PREFETCH_PENDING:
+                return None
+            pipe.multi()
+            pipe.delete(key)
+            pipe.execute()
+        except WatchError:
+            return None
+
+    return json.loads(value)
+
+
+@log_function_call
+def cancel_prefetch(username):
+    '''
+    Removes the reservation of a prefetch that did not prepare a patient.
+    '''
+    flask.current_app.redis.delete(_prefetch_key(username))
+
+
+@log_function_call
+def discard_prefetch(username):
+    '''
+    Removes the reservation or the prepared patient of a user who stopped
+    reviewing. A prefetch that is still running does not store its patient
+    once its reservation has been removed.
+
+    Returns :
+        - prefetched (dict) : The details of the prepared patient, None if no
+                              patient was ready yet.
+    '''
+    with flask.current_app.redis.pipeline() as pipe:
+        pipe.get(_prefetch_key(username))
+        pipe.delete(_prefetch_key(username))
+        value, _ = pipe.execute()
+
+    if value is None or value == PREFETCH_PENDING:
+        return None
+    return json.loads(value)
@@ -1,4 +1,6 @@
 import datetime
+import html
+from array import array
 from loguru import logger
 from bson import ObjectId
 from .cedars_enums import PatientStatus, ReviewStatus
@@ -11,13 +13,18 @@ class AdjudicationHandler:
     the adjudication workflow in CEDARS for a patient.
     '''
 
+    # Review statuses are stored as an array of ReviewStatus values
+    UNREVIEWED = ReviewStatus.UNREVIEWED.value
+    REVIEWED = ReviewStatus.REVIEWED.value
+    SKIPPED = ReviewStatus.SKIPPED.value
+
     def __init__(self, patient_id):
         self.patient_id = patient_id
         self.patient_data = {
             'event_date' : None,
             'event_annotation_id' : None,
             'annotation_ids' : [],
-            'review_statuses' : [],
+            'review_statuses' : array('b'),
             'current_index' : -1
         }
 
@@ -48,7 +55,7 @@ class AdjudicationHandler:
         index = 0
         try:
             # Find the index of the first unreviewed index
-            index = review_statuses.index(ReviewStatus.UNREVIEWED)
+            index = review_statuses.index(self.UNREVIEWED)
         except ValueError as e:
             # A ValueError is thrown if the element being searched for
             # does not exist in the list.
@@ -66,9 +73,53 @@ class AdjudicationHandler:
             'current_index' : index,
             'annotations' : annotations
         }
+        self.patient_data.update(self._build_indexes(annotations))
 
         return self.patient_data, annotations_with_duplicates
 
+    @staticmethod
+    def _build_indexes(annotations):
+        '''
+        Builds the offsets of the annotations (that are not negated) of each note
+        and of each sentence, in the order in which they are highlighted.
+
+        Returns :
+            - indexes (dict) : note_index maps a note_id to offsets sorted by
+                                text_date and sentence_number, sentence_index maps
+                                "{note_id}:{sentence_number}" to offsets sorted by
+                                text_date and note_start_index.
+        '''
+        note_index = {}
+        sentence_index = {}
+        for offset, annotation in enumerate(annotations):
+            if annotation.get('isNegated') is not False:
+                continue
+            note_index.setdefault(annotation['note_id'], []).append(offset)
+            sentence_key = f"{annotation['note_id']}:{annotation['sentence_number']}"
+            sentence_index.setdefault(sentence_key, []).append(offset)
+
+        for offsets in note_index.values():
+            offsets.sort(key=lambda offset: (annotations[offset]['text_date'],
+                                             annotations[offset]['sentence_number']))
+        for offsets in sentence_index.values():
+            offsets.sort(key=lambda offset: (annotations[offset]['text_date'],
+                                             annotations[offset]['note_start_index']))
+
+        return {'note_index' : note_index, 'sentence_index' : sentence_index}
+
+    def _get_index(self, name):
+        # State created before the indexes were introduced
+        if name not in self.patient_data:
+            self.patient_data.update(self._build_indexes(self.patient_data['annotations']))
+        return self.patient_data[name]
+
+    def _get_annotations(self, offsets):
+        annotations = self.patient_data['annotations']
+        if hasattr(annotations, 'prefetch'):
+            # Cached annotations are fetched with a single command
+            annotations.prefetch(offsets)
+        return [annotations[offset] for offset in offsets]
+
     @log_function_call
     def load_from_patient_data(self, patient_id, patient_data):
         '''
@@ -106,18 +157,9 @@ class AdjudicationHandler:
             sentence_number (ascending)
         """
         note_id = self.get_curr_annotation()['note_id']
+        offsets = self._get_index('note_index').get(note_id, [])
 
-        note_annotations = []
-        for annotation in self.patient_data['annotations']:
-            if annotation['note_id'] == note_id and annotation['isNegated'] is False:
-                note_annotations.append(annotation)
-
-        # Sort by text_date, then by sentence_number
-        sorting_function = lambda entry : (entry['text_date'], 
-                                           entry['sentence_number'])
-        sorted_annotations = sorted(note_annotations, key=sorting_function)
-
-        return sorted_annotations
+        return self._get_annotations(offsets)
 
     @log_function_call
     def get_all_annotations_for_curr_sentence(self):
@@ -130,31 +172,21 @@ class AdjudicationHandler:
             note_start_index (ascending)
         """
         curr_anno = self.get_curr_annotation()
-        note_id = curr_anno['note_id']
-        sentence_number = curr_anno['sentence_number']
-
-        note_annotations = []
-        for annotation in self.patient_data['annotations']:
-            correct_note = annotation['note_id'] == note_id
-            correct_sentence = annotation['sentence_number'] == sentence_number
-            is_not_negated = annotation['isNegated'] is False
-            if correct_note and correct_sentence and is_not_negated:
-                note_annotations.append(annotation)
+        sentence_key = f"{curr_anno['note_id']}:{curr_anno['sentence_number']}"
+        offsets = self._get_index('sentence_index').get(sentence_key, [])
 
-        # Sort by text_date, then by sentence_number
-        sorting_function = lambda entry : (entry['text_date'], 
-                                           entry['note_start_index'])
-        sorted_annotations = sorted(note_annotations, key=sorting_function)
-
-        return sorted_annotations
+        return self._get_annotations(offsets)
 
     @log_function_call
     def get_annotation_details(self, annotation, note, comments,
-                               annotations_for_note, annotations_for_sentence):
+                               annotations_for_note, annotations_for_sentence,
+                               text_highlighter=None):
         '''
         Get the details for the current annotation that is to be showed to the annotator.
+        A SentenceHighlighter is used unless another highlighter is given.
         '''
-        text_highlighter = SentenceHighlighter()
+        if text_highlighter is None:
+            text_highlighter = SentenceHighlighter()
         annotation_data = {
             "pos_start": self.patient_data['current_index'] + 1,
             "total_pos": len(self.patient_data['annotation_ids']),
@@ -213,7 +245,13 @@ class AdjudicationHandler:
         # Note that this is not the same as having all the annotatings
         # being reviewed as annotations that are unreviewed but after the event date
         # can be marked None to indicate that they do not need to be annotated.
-        return self.patient_data['review_statuses'].count(ReviewStatus.UNREVIEWED) == 0
+        return self.get_num_unreviewed() == 0
+
+    def get_num_unreviewed(self):
+        '''
+        Returns the number of annotations left to review for the current patient.
+        '''
+        return self.patient_data['review_statuses'].count(self.UNREVIEWED)
 
     @log_function_call
     def perform_shift(self, action):
@@ -252,7 +290,7 @@ class AdjudicationHandler:
         next unreviewed annotation.
         '''
         index = self.patient_data['current_index']
-        self.patient_data['review_statuses'][index] = ReviewStatus.REVIEWED
+        self.patient_data['review_statuses'][index] = self.REVIEWED
         review_statuses = self.patient_data['review_statuses']
         last_index = len(review_statuses) - 1
 
@@ -269,7 +307,7 @@ class AdjudicationHandler:
         for new_index in range(index+1, len(review_statuses)):
             logger.debug(f"Checking index {new_index} / {len(review_statuses)-1}")
             logger.debug(f"Index status : {review_statuses[new_index]}")
-            if review_statuses[new_index] == ReviewStatus.UNREVIEWED:
+            if review_statuses[new_index] == self.UNREVIEWED:
                 self.patient_data['current_index'] = new_index
                 return
         
@@ -278,7 +316,7 @@ class AdjudicationHandler:
         for new_index in range(0, index):
             logger.debug(f"Checking index {new_index} / {len(review_statuses)-1}")
             logger.debug(f"Index status : {review_statuses[new_index]}")
-            if review_statuses[new_index] == ReviewStatus.UNREVIEWED:
+            if review_statuses[new_index] == self.UNREVIEWED:
                 self.patient_data['current_index'] = new_index
                 return
 
@@ -295,8 +333,8 @@ class AdjudicationHandler:
         for i, anno_id in enumerate(self.patient_data['annotation_ids']):
             review_status = self.patient_data['review_statuses'][i]
             anno_id = ObjectId(anno_id)
-            if (anno_id in annotations_after_event) and (review_status == ReviewStatus.UNREVIEWED):
-                self.patient_data['review_statuses'][i] = ReviewStatus.SKIPPED
+            if (anno_id in annotations_after_event) and (review_status == self.UNREVIEWED):
+                self.patient_data['review_statuses'][i] = self.SKIPPED
 
         self._adjudicate_annotation()
 
@@ -317,7 +355,7 @@ class AdjudicationHandler:
 
         # Mark the annotation un-reviewed after the event_date is deleted
         index = self.patient_data['current_index']
-        self.patient_data['review_statuses'][index] = ReviewStatus.UNREVIEWED
+        self.patient_data['review_statuses'][index] = self.UNREVIEWED
 
     @log_function_call
     def reset_all_skipped(self):
@@ -326,8 +364,8 @@ class AdjudicationHandler:
         UNREVIEWED.
         '''
         for i, status in enumerate(self.patient_data['review_statuses']):
-            if status == ReviewStatus.SKIPPED:
-                self.patient_data['review_statuses'][i] = ReviewStatus.UNREVIEWED
+            if status == self.SKIPPED:
+                self.patient_data['review_statuses'][i] = self.UNREVIEWED
 
     @log_function_call
     def _format_date(self, date_obj):
@@ -345,6 +383,31 @@ class AdjudicationHandler:
         return res
 
 class AnnotationFilterStrategy:
+    @staticmethod
+    def _sentence_key(annotation):
+        # The hash of the normalized sentence is stored by the NLP processor
+        sentence_hash = annotation.get('sentence_hash')
+        if sentence_hash is not None:
+            return sentence_hash
+        return annotation['sentence'].lower().strip()
+
+    def _find_duplicates(self, annotations, by_note):
+        '''
+        Returns a mask where True marks an annotation whose sentence was already
+        seen, across the notes of the patient or only within the same note.
+        The annotations are visited once.
+        '''
+        seen_sentences = set()
+        is_duplicate = []
+        for annotation in annotations:
+            sentence = self._sentence_key(annotation)
+            if by_note:
+                sentence = (annotation['note_id'], sentence)
+            is_duplicate.append(sentence in seen_sentences)
+            seen_sentences.add(sentence)
+
+        return is_duplicate
+
     @log_function_call
     def _filter_duplicates_by_patient(self, annotations):
         '''
@@ -352,17 +415,8 @@ class AnnotationFilterStrategy:
         for this patient. The first instance of a sentence is kept and all others
         are marked as duplicates.
         '''
-        indices_with_duplicates = []
-        seen_sentences = set()
-        for i, annotation in enumerate(annotations):
-            sentence = annotation['sentence'].lower().strip()
-            if sentence in seen_sentences:
-                indices_with_duplicates.append(i)
-                continue
-
-            seen_sentences.add(sentence)
-
-        return indices_with_duplicates
+        is_duplicate = self._find_duplicates(annotations, by_note=False)
+        return [i for i, duplicate in enumerate(is_duplicate) if duplicate]
 
     @log_function_call
     def _filter_duplicates_by_note(self, annotations):
@@ -371,43 +425,24 @@ class AnnotationFilterStrategy:
         note. The first instance of a sentence is kept and all others
         are marked as duplicates.
         '''
-        indices_with_duplicates = []
-        prev_note_id = None
-        seen_sentences = set()
-        for i, annotation in enumerate(annotations):
-            # If we are on a new note, then clear the hashset of sentences.
-            # This is done so that we only check for the same sentence
-            # in that note.
-            if annotation['note_id'] != prev_note_id:
-                seen_sentences.clear()
-
-            prev_note_id = annotation['note_id']
-            sentence = annotation['sentence'].lower().strip()
-            if sentence in seen_sentences:
-                indices_with_duplicates.append(i)
-                continue
-
-            seen_sentences.add(sentence)
-
-        return indices_with_duplicates
+        is_duplicate = self._find_duplicates(annotations, by_note=True)
+        return [i for i, duplicate in enumerate(is_duplicate) if duplicate]
 
-    @log_function_call
-    def _pop_and_mark_duplicates(self, annotations, indices_with_duplicates):
+    @staticmethod
+    def _split_duplicates(annotations, is_duplicate):
         '''
-        Pops all annotations that have duplicates based on a list of
-        indices dictating where the duplicates are found. The annotation
-        IDs of these indices are also stored and returned in a seperate list.
+        Splits the annotations with a mask of duplicates into the annotations
+        that are kept and the IDs of the duplicates, in a single pass.
         '''
-
+        kept_annotations = []
         annotations_with_duplicates = []
-        # Remove the indices in reverse order to avoid a later index changing
-        # after a prior one is removed.
-        indices_with_duplicates.sort(reverse=True)
-        for index in indices_with_duplicates:
-            annotations_with_duplicates.append(annotations[index]["_id"])
-            annotations.pop(index)
+        for annotation, duplicate in zip(annotations, is_duplicate):
+            if duplicate:
+                annotations_with_duplicates.append(annotation["_id"])
+            else:
+                kept_annotations.append(annotation)
 
-        return annotations, annotations_with_duplicates
+        return kept_annotations, annotations_with_duplicates
 
     @log_function_call
     def filter_annotations(self, annotations, hide_duplicates):
@@ -424,80 +459,106 @@ class AnnotationFilterStrategy:
         """
 
         logger.info("Finding duplicates...")
-        if hide_duplicates:
-            indices_with_duplicates = self._filter_duplicates_by_patient(annotations)
-        else:
-            indices_with_duplicates = self._filter_duplicates_by_note(annotations)
+        is_duplicate = self._find_duplicates(annotations, by_note=not hide_duplicates)
 
         logger.info("Removing duplicates...")
-        annotations, annotations_with_duplicates = self._pop_and_mark_duplicates(annotations,
-                                                                                 indices_with_duplicates)
+        annotations, annotations_with_duplicates = self._split_duplicates(annotations,
+                                                                          is_duplicate)
 
         filtered_results = {
             'annotation_ids' : [str(annotation["_id"]) for annotation in annotations],
-            'review_statuses' : [ReviewStatus(int(x["reviewed"])) for x in annotations],
-            'annotations' : [dict(annotation) for annotation in annotations]
+            'review_statuses' : array('b', (int(x["reviewed"]) for x in annotations)),
+            'annotations' : annotations
         }
 
         return filtered_results, annotations_with_duplicates
 
 class SentenceHighlighter:
-    @log_function_call
-    def get_highlighted_text(self, note, annotations_for_note):
-        """
-        Returns highlighted all of the text in a note.
-        """
-        highlighted_note = []
-        prev_end_index = 0
-        text = note["text"]
+    '''
+    Builds the HTML shown to the annotator, where the tokens of the
+    annotations are highlighted. The text is escaped and each character
+    of the note is only visited once.
+    '''
 
-        annotations = annotations_for_note
-        logger.debug(f"Getting highlighted text for : {annotations}")
+    @staticmethod
+    def _escape(segment):
+        return html.escape(segment, quote=False).replace("\n", "<br>")
 
+    def _highlight(self, text, start, end, annotations):
+        """
+        Returns the HTML of text[start:end] where the tokens of the annotations
+        are highlighted. Overlapping tokens are merged into a single highlight.
+        """
+        spans = []
         for annotation in annotations:
-            start_index = annotation['note_start_index']
-            end_index = annotation['note_end_index']
-            # Make sure the annotations don't overlap
-            if start_index < prev_end_index:
+            token_start = max(annotation['note_start_index'], start)
+            token_end = min(annotation['note_end_index'], end)
+            if token_start < token_end:
+                spans.append((token_start, token_end))
+        spans.sort()
+
+        highlighted = []
+        position = start
+        span_start = span_end = None
+        for token_start, token_end in spans + [(end, end)]:
+            if span_end is not None and token_start <= span_end and token_start < end:
+                span_end = max(span_end, token_end)
                 continue
 
-            highlighted_note.append(text[prev_end_index:start_index])
-            highlighted_note.append(f'<b><mark>{text[start_index:end_index]}</mark></b>')
-            prev_end_index = end_index
+            if span_end is not None:
+                highlighted.append(self._escape(text[position:span_start]))
+                highlighted.append(f'<b><mark>{self._escape(text[span_start:span_end])}</mark></b>')
+                position = span_end
+            span_start, span_end = token_start, token_end
+
+        highlighted.append(self._escape(text[position:end]))
+        return "".join(highlighted)
+
+    @staticmethod
+    def _find_sentence(text, annotation):
+        """
+        Returns the start and end of the sentence of an annotation in the note.
+        The stored sentence offsets are used when they match the sentence,
+        otherwise the sentence is searched for around the token.
+        """
+        sentence = annotation['sentence']
+        sentence_start = annotation.get('sentence_start')
+        if sentence_start is not None:
+            sentence_end = sentence_start + len(sentence)
+            if text[sentence_start:sentence_end].lower() == sentence:
+                return sentence_start, sentence_end
+
+        # The sentence contains the token
+        window_start = max(annotation['note_start_index'] - len(sentence), 0)
+        window_end = annotation['note_end_index'] + len(sentence)
+        index = text[window_start:window_end].lower().find(sentence)
+        if index >= 0:
+            return window_start + index, window_start + index + len(sentence)
+
+        index = text.lower().find(sentence)
+        if index >= 0:
+            return index, index + len(sentence)
+
+        logger.warning(f"Sentence of annotation {annotation.get('_id')} not found in its note.")
+        return annotation['note_start_index'], annotation['note_end_index']
 
-        highlighted_note.append(text[prev_end_index:])
-        logger.debug(f"Final highlighted note : {highlighted_note}")
-        return " ".join(highlighted_note).replace("\n", "<br>")
+    @log_function_call
+    def get_highlighted_text(self, note, annotations_for_note):
+        """
+        Returns highlighted all of the text in a note.
+        """
+        text = note["text"]
+        return self._highlight(text, 0, len(text), annotations_for_note)
 
     @log_function_call
     def get_highlighted_sentence(self, current_annotation, note, annotations_for_sentence):
         """
         Returns highlighted text for a specific sentence in a note.
         """
-        highlighted_note = []
         text = note["text"]
+        sentence_start, sentence_end = self._find_sentence(text, current_annotation)
 
-        sentence_start = text.lower().index(current_annotation['sentence'])
-        sentence_end = sentence_start + len(current_annotation['sentence'])
-        prev_end_index = sentence_start
-
-        annotations = annotations_for_sentence
-
-        highlighted_note = []
-        for annotation in annotations:
-            token_start_index = annotation['note_start_index']
-            token_end_index = annotation['note_end_index']
-
-            # Make sure the annotations don't overlap unless it is the first index
-            if (token_start_index < prev_end_index) and (token_start_index != 0):
-                continue
-
-            highlighted_note.append(text[prev_end_index:token_start_index])
-            key_token = text[token_start_index:token_end_index]
-            highlighted_note.append(f'<b><mark>{key_token}</mark></b>')
-            prev_end_index = token_end_index
-
-        highlighted_note.append(text[prev_end_index:sentence_end])
-        sentence = "".join(highlighted_note).strip().replace("\n", "<br>")
+        sentence = self._highlight(text, sentence_start, sentence_end,
+                                   annotations_for_sentence).strip()
         logger.debug(f'Showing sentence : {sentence}')
         return sentence
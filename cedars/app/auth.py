@@ -233,8 +233,13 @@ def token_login():
 @bp.route('/logout', methods=["GET", "POST"])
 def logout():
     """Logout a user"""
+    # ops imports this module
+    from .ops import release_prefetched_patient
+
     if session.get("patient_id"):
         db.set_patient_lock_status(int(session.get("patient_id")), False)
+    if current_user.is_authenticated:
+        release_prefetched_patient(current_user.username)
 
     logout_user()
     session.clear()
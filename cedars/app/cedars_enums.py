@@ -1,20 +1,49 @@
 from enum import Enum
+import os
+import random
 import time
 from functools import wraps
+from dotenv import dotenv_values
 from loguru import logger
+from prometheus_client import Histogram
+
+FUNCTION_DURATION = Histogram("cedars_function_duration_seconds",
+                              "Time spent in functions decorated with log_function_call.",
+                              ["function"])
+
+# Fraction of the calls whose arguments are logged, 1 traces every call.
+# Arguments are not formatted at all when this is 0.
+_trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE",
+                                     dotenv_values(".env").get("TRACE_SAMPLE_RATE", 0)))
+
+
+def set_trace_sample_rate(rate):
+    """Sets the fraction of the decorated calls that are logged with their arguments."""
+    global _trace_sample_rate
+    _trace_sample_rate = float(rate)
 
 
 def log_function_call(func):
-    """Decorator to log function calls."""
+    """
+    Decorator to record the duration of function calls in a prometheus histogram.
+    A sample of the calls is logged with their arguments (see TRACE_SAMPLE_RATE).
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+    duration = FUNCTION_DURATION.labels(function=name)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        logger.debug(f"Python function {func.__name__} called with args: {args}, kwargs: {kwargs}")
+        is_traced = _trace_sample_rate > 0 and random.random() < _trace_sample_rate
+        if is_traced:
+            logger.debug(f"Python function {func.__name__} called with args: {args}, kwargs: {kwargs}")
         start_time = time.perf_counter()  # More precise than time.time()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        execution_time = (end_time - start_time)
-        logger.debug(f"Python function {func.__name__} finished execution in {execution_time:.6f}s")
-        return result
+        try:
+            return func(*args, **kwargs)
+        finally:
+            execution_time = (time.perf_counter() - start_time)
+            duration.observe(execution_time)
+            if is_traced:
+                logger.debug(f"Python function {func.__name__} finished execution in {execution_time:.6f}s")
     return wrapper
 
 class ReviewStatus(Enum):
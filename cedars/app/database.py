@@ -13,7 +13,8 @@ config = dotenv_values(".env")
 
 def get_mongo():
     # https://pymongo.readthedocs.io/en/stable/faq.html#is-pymongo-fork-safe
-    mongo = flask_pymongo.PyMongo(current_app)
+    listeners = [current_app.mongo_listener] if hasattr(current_app, "mongo_listener") else []
+    mongo = flask_pymongo.PyMongo(current_app, event_listeners=listeners)
     return mongo
 
 
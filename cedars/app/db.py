@@ -2,26 +2,27 @@
 This file contatins an abstract class for CEDARS to interact with mongodb.
 """
 
-from math import ceil
+import hashlib
+import json
+from itertools import islice
 import os
-from io import BytesIO, StringIO
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 
 from typing import Optional
 from faker import Faker
-from pymongo import UpdateOne
-from pymongo.errors import BulkWriteError
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
 import flask
 from flask import g
 import requests
-import pandas as pd
 import polars as pl
 from werkzeug.security import check_password_hash
 from bson import ObjectId
 from loguru import logger
 from .database import mongo, minio
+from . import exporter
 from .cedars_enums import ReviewStatus
 from .cedars_enums import log_function_call
 
@@ -48,6 +49,11 @@ def create_project(project_name,
     """
     create_db_indices()
     if mongo.db["INFO"].find_one() is not None:
+        # Projects created by older versions do not have the
+        # pending_annotations counter used to find the next patient.
+        if mongo.db["PATIENTS"].find_one({"pending_annotations": {"$exists": False}},
+                                         {"_id": 1}) is not None:
+            rebuild_pending_annotations()
         logger.info("Database already created.")
         return
 
@@ -175,6 +181,13 @@ def create_db_indices():
 
     logger.info("Creating indexes for PATIENTS.")
     mongo.db["PATIENTS"].create_index([("patient_id", 1)], unique=True)
+    # Index for get_patients_to_annotate, only patients with
+    # pending annotations are kept in the index.
+    mongo.db["PATIENTS"].create_index([("reviewed", 1), ("locked", 1), ("index_no", 1)],
+                                      partialFilterExpression={"pending_annotations": {"$gt": 0}})
+    # Index for release_expired_locks, only locked patients have a lease.
+    # A TTL index cannot be used as it would delete the patients.
+    mongo.db["PATIENTS"].create_index([("lock_expires_at", 1)], sparse=True)
 
     create_annotation_indices()
 
@@ -187,6 +200,8 @@ def create_db_indices():
 
     logger.info("Creating indexes for RESULTS.")
     create_index("RESULTS", [("patient_id", {"unique": True})])
+    # Index for the changes since the last export in download_annotations
+    create_index("RESULTS", ["last_updated"])
 
     logger.info("Creating indexes for NOTES_SUMMARY.")
     create_index("NOTES_SUMMARY", [("patient_id")])
@@ -329,17 +344,173 @@ def update_notes_summary():
     
     return 0
 
+@log_function_call
+def get_note_hash(note):
+    '''
+    Returns a hash of the uploaded contents of a note. The review status
+    of the note is not included, so a note that has been reviewed since
+    it was uploaded will have the same hash.
+
+    Args :
+        - note (dict) : The note as it is stored in the NOTES collection.
+
+    Returns :
+        - content_hash (str) : SHA-256 hex digest of the note contents.
+    '''
+    ignored_fields = {"_id", "reviewed", "reviewed_by", "content_hash"}
+    contents = {key: value for key, value in note.items() if key not in ignored_fields}
+    serialized = json.dumps(contents, sort_keys=True, default=str)
+
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+def get_sentence_hash(sentence):
+    '''
+    Returns a hash of a sentence after it is normalized, sentences with
+    the same hash are duplicates of each other.
+
+    Args :
+        - sentence (str) : The sentence of an annotation.
+
+    Returns :
+        - sentence_hash (str) : SHA-1 hex digest of the normalized sentence.
+    '''
+    return hashlib.sha1(sentence.lower().strip().encode("utf-8")).hexdigest()
+
 @log_function_call
 def bulk_insert_notes(notes):
+    '''
+    Inserts a batch of new notes into the NOTES collection.
+    The insert is unordered, so a note that already exists does not
+    prevent the rest of the batch from being inserted.
+
+    Args :
+        - notes (list[dict]) : Notes formatted with ops.prepare_note.
+
+    Returns :
+        - inserted_count (int) : Number of notes inserted.
+    '''
     notes_collection = mongo.db["NOTES"]
+    for note in notes:
+        note["content_hash"] = get_note_hash(note)
     try:
-        result = notes_collection.insert_many(notes)
+        result = notes_collection.insert_many(notes, ordered=False)
         logger.info(f"Inserted {len(result.inserted_ids)} notes.")
         return len(result.inserted_ids)
     except BulkWriteError as bwe:
-        logger.error(f"Bulk write error: {bwe.details}")
+        logger.error(f"Bulk write error: {bwe.details['writeErrors'][:5]}")
         return bwe.details['nInserted']
 
+@log_function_call
+def bulk_upsert_notes(notes):
+    '''
+    Idempotent version of bulk_insert_notes used when uploading notes.
+    Notes are upserted by text_id and a content hash is stored with each note,
+    notes that are already stored with the same contents are not written again.
+    This makes it safe to re-run an upload that has failed part of the way through.
+    The annotations and PINES predictions of a note whose contents have changed
+    no longer match its text, so they are removed for the note to be processed
+    again and the results of its patient are rebuilt.
+
+    Args :
+        - notes (list[dict]) : Notes formatted with ops.prepare_note.
+
+    Returns :
+        - written_count (int) : Number of notes that were inserted or updated.
+    '''
+    notes_collection = mongo.db["NOTES"]
+    for note in notes:
+        note["content_hash"] = get_note_hash(note)
+
+    stored_hashes = {note["text_id"]: note.get("content_hash") for note in
+                     notes_collection.find({"text_id": {"$in": [note["text_id"] for note in notes]}},
+                                           {"_id": 0, "text_id": 1, "content_hash": 1})}
+
+    note_operations = []
+    changed_notes = {}
+    for note in notes:
+        if stored_hashes.get(note["text_id"]) == note["content_hash"]:
+            continue
+        if note["text_id"] in stored_hashes:
+            changed_notes[note["text_id"]] = note["patient_id"]
+        note_operations.append(UpdateOne({"text_id": note["text_id"]},
+                                         {"$set": note},
+                                         upsert=True))
+
+    if len(note_operations) == 0:
+        logger.info(f"All {len(notes)} notes are already stored.")
+        return 0
+
+    try:
+        result = notes_collection.bulk_write(note_operations, ordered=False)
+        written_count = result.upserted_count + result.modified_count
+    except BulkWriteError as bwe:
+        logger.error(f"Bulk write error: {bwe.details['writeErrors'][:5]}")
+        written_count = bwe.details['nUpserted'] + bwe.details['nModified']
+
+    logger.info(f"Wrote {written_count} notes, skipped {len(notes) - len(note_operations)} unchanged notes.")
+    if written_count > 0:
+        bump_notes_version()
+    if changed_notes:
+        reset_changed_notes(changed_notes)
+    return written_count
+
+@log_function_call
+def reset_changed_notes(changed_notes):
+    '''
+    Removes the annotations and predictions of notes whose text has been
+    replaced, so that they are annotated again, and rebuilds the results
+    of their patients (reviewed note counts, sentences and scores).
+
+    Args :
+        - changed_notes (dict) : Patient ID of each changed note, by text_id.
+
+    Returns :
+        - None
+    '''
+    note_ids = list(changed_notes.keys())
+    logger.info(f"Contents of {len(note_ids)} stored notes changed, removing their annotations.")
+    mongo.db["ANNOTATIONS"].delete_many({"note_id": {"$in": note_ids}})
+    mongo.db["PINES"].delete_many({"text_id": {"$in": note_ids}})
+    rebuild_patient_results(list(set(changed_notes.values())))
+
+# Incremented every time stored notes change, so that notes cached
+# by the web workers are read again.
+NOTES_VERSION_KEY = "cedars:notes_version"
+
+@log_function_call
+def bump_notes_version():
+    '''
+    Marks that stored notes have changed.
+    '''
+    flask.current_app.redis.incr(NOTES_VERSION_KEY)
+
+# Incremented for a patient every time the review status of one of its
+# notes changes, so that the notes cached for this patient are read again.
+NOTES_REVIEW_VERSIONS_KEY = "cedars:notes_review_versions"
+
+@log_function_call
+def get_patient_notes_versions(patient_id: str):
+    '''
+    Returns the version of the NOTES collection and the version of the
+    review statuses of the notes of a patient, read with a single command.
+    '''
+    with flask.current_app.redis.pipeline() as pipe:
+        pipe.get(NOTES_VERSION_KEY)
+        pipe.hget(NOTES_REVIEW_VERSIONS_KEY, patient_id)
+        notes_version, review_version = pipe.execute()
+
+    return int(notes_version or 0), int(review_version or 0)
+
+@log_function_call
+def bump_notes_review_versions(patient_ids):
+    '''
+    Marks that the review status of notes of these patients has changed.
+    '''
+    with flask.current_app.redis.pipeline() as pipe:
+        for patient_id in patient_ids:
+            pipe.hincrby(NOTES_REVIEW_VERSIONS_KEY, patient_id, 1)
+        pipe.execute()
+
 @log_function_call
 def bulk_upsert_patients(patient_ids):
     '''
@@ -347,6 +518,11 @@ def bulk_upsert_patients(patient_ids):
     PATIENTS and RESULTS collection for each patient. The order in which
     the patients are uploaded will be maintained using an index_no field.
 
+    The PATIENTS entries are written in chunks from the ordered list of IDs,
+    as the upload order is only known to the caller. The RESULTS entries are
+    generated on the server from the NOTES_SUMMARY collection using a single
+    aggregation, so update_notes_summary must be run before this function.
+
     For compatibility with older versions of CEDARS without the index_no field,
     mongodb will ignore the sorting step and the program will continue as normal.
 
@@ -357,30 +533,12 @@ def bulk_upsert_patients(patient_ids):
         - total patients and results uploaded
     '''
     patients_collection = mongo.db["PATIENTS"]
-    results_collection = mongo.db["RESULTS"]
-    patient_operations = []
-    results_operations = []
     number_of_patients_in_db = patients_collection.count_documents({})
+    number_of_results_in_db = mongo.db["RESULTS"].count_documents({})
 
-    # get cached note summary for all patients where each patient is a key
-    notes_summary_dict = get_notes_summary()
-
-
-    for index_no, p_id in enumerate(patient_ids):
-        # Update the index in cases where a batch of patients
-        # has been added after the initial batch.
-
-        index_no += number_of_patients_in_db
-        p_id = str(p_id).strip()
-
-        patient_op = generate_patient_entry(p_id, index_no)
-        patient_operations.append(patient_op)
-
-        results_op = generate_results_entry(p_id, index_no, 
-                                            first_note_date=notes_summary_dict.get(p_id, {}).get("first_note_date"),
-                                            last_note_date=notes_summary_dict.get(p_id, {}).get("last_note_date"),
-                                            num_notes=notes_summary_dict.get(p_id, {}).get("num_notes"))
-        results_operations.append(results_op)
+    # A dict is used as an ordered set so that a patient whose notes span
+    # multiple chunks of an upload is only written (and numbered) once.
+    patient_ids = iter(dict.fromkeys(str(p_id).strip() for p_id in patient_ids))
 
     try:
         '''
@@ -392,16 +550,33 @@ def bulk_upsert_patients(patient_ids):
         # bulk write in chunks
         chunk_size = 2000
         total_uploaded_patients = 0
-        total_uploaded_results = 0
-        for i in range(0, len(patient_operations), chunk_size):
-            patients_update = patients_collection.bulk_write(patient_operations[i:i+chunk_size],
-                                                            ordered=False)
-            total_uploaded_patients += patients_update.upserted_count
-    
-        for i in range(0, len(results_operations), chunk_size):
-            results_update = results_collection.bulk_write(results_operations[i:i+chunk_size],
-                                                            ordered=False)
-            total_uploaded_results += results_update.upserted_count
+        # Update the index in cases where a batch of patients
+        # has been added after the initial batch.
+        index_no = number_of_patients_in_db
+        while True:
+            chunk = list(islice(patient_ids, chunk_size))
+            if not chunk:
+                break
+
+            # Patients that already exist keep their index_no,
+            # so they are not sent to the database again.
+            existing_ids = {patient["patient_id"] for patient in
+                            patients_collection.find({"patient_id": {"$in": chunk}},
+                                                     {"_id": 0, "patient_id": 1})}
+            patient_operations = []
+            for p_id in chunk:
+                if p_id in existing_ids:
+                    continue
+                patient_operations.append(generate_patient_entry(p_id, index_no))
+                index_no += 1
+
+            if patient_operations:
+                patients_update = patients_collection.bulk_write(patient_operations,
+                                                                 ordered=False)
+                total_uploaded_patients += patients_update.upserted_count
+
+        upsert_results_from_notes_summary()
+        total_uploaded_results = mongo.db["RESULTS"].count_documents({}) - number_of_results_in_db
 
         logger.info(f"Inserted {total_uploaded_patients} patients and {total_uploaded_results} results.")
         return total_uploaded_patients, total_uploaded_results
@@ -433,6 +608,7 @@ def generate_patient_entry(p_id: str, index_no: int):
         "event_annotation_id": None,
         "event_date": None,
         "admin_locked": False,
+        "pending_annotations": 0,
         "index_no" : index_no
     }
 
@@ -443,54 +619,53 @@ def generate_patient_entry(p_id: str, index_no: int):
             )
 
 @log_function_call
-def generate_results_entry(p_id: str,
-                           index_no: int,
-                           first_note_date=None,
-                           last_note_date=None,
-                           num_notes=None):
+def upsert_results_from_notes_summary():
     '''
-    Generates a blank entry for a new patient in the RESULTS collection.
+    Generates a blank entry in the RESULTS collection for every patient in the
+    NOTES_SUMMARY collection that has a PATIENTS entry but no stored results.
+    The entries are built and written on the server with a single aggregation,
+    existing results are never overwritten.
 
-    Args:
-        - p_id (str) : Unique ID for the patient.
-        - index_no (int) : Order number for this patient.
-                            Follows the ordering in which patients are uploaded.
+    Args :
+        - None
 
-    Returns:
-        - operation (pymongo.UpdateOne) : Pymongo operation to insert the patient
-                                            into a collection.
+    Returns :
+        - None
     '''
+    pipeline = [
+        {"$lookup": {
+            "from": "PATIENTS",
+            "localField": "patient_id",
+            "foreignField": "patient_id",
+            "as": "patient"
+        }},
+        {"$unwind": "$patient"},
+        {"$project": {
+            "_id": 0,
+            "patient_id": 1,
+            "total_notes": {"$ifNull": ["$num_notes", 0]},
+            "reviewed_notes": {"$literal": 0},
+            "total_sentences": {"$literal": 0},
+            "reviewed_sentences": {"$literal": 0},
+            "sentences": {"$literal": []},
+            "event_date": {"$literal": None},
+            "event_information": {"$literal": None},
+            "first_note_date": {"$ifNull": ["$first_note_date", None]},
+            "last_note_date": {"$ifNull": ["$last_note_date", None]},
+            "comments": {"$literal": ""},
+            "reviewer": {"$literal": None},
+            "max_score_note_id": {"$literal": None},
+            "max_score_note_date": {"$literal": None},
+            "max_score": {"$literal": None},
+            "predicted_notes": {"$literal": []},
+            "last_updated": {"$literal": datetime.now()},
+            "index_no": "$patient.index_no"
+        }}
+    ]
 
-    first_note_date = get_first_note_date_for_patient(p_id, first_note_date)
-    last_note_date = get_last_note_date_for_patient(p_id, last_note_date)
-    num_notes = get_num_patient_notes(p_id, num_notes)
-
-    patient_results = {
-        'patient_id' : p_id,
-        'total_notes' : num_notes,
-        'reviewed_notes' : 0,
-        'total_sentences' : 0,
-        'reviewed_sentences' : 0,
-        'sentences' : '',
-        'event_date' : None,
-        'event_information' : None,
-        'first_note_date' : first_note_date,
-        'last_note_date' : last_note_date,
-        'comments' : '',
-        'reviewer' : None,
-        'max_score_note_id' : None,
-        'max_score_note_date' : None,
-        'max_score' : None,
-        'predicted_notes' : None,
-        'last_updated' : datetime.now(),
-        'index_no' : index_no
-    }
-
-    return UpdateOne(
-                {"patient_id": p_id},
-                {"$setOnInsert": patient_results},
-                upsert=True
-            )
+    logger.info("Creating RESULTS entries from NOTES_SUMMARY.")
+    merge_aggregation("NOTES_SUMMARY", pipeline, "RESULTS",
+                      when_matched="keepExisting")
 
 @log_function_call
 def insert_one_annotation(annotation):
@@ -520,16 +695,8 @@ def upsert_patient_records(patient_id: str, insert_datetime: datetime = None, up
 
     num_reviewed_notes = mongo.db["NOTES"].count_documents({'patient_id' : patient_id,
                                                         'reviewed' : True})
-    all_note_details = get_formatted_patient_predictions(patient_id)
-
-    reviewed_sentences = get_patient_annotation_ids(patient_id,
-                                                                reviewed=ReviewStatus.REVIEWED,
-                                                                key="sentence")
-    unreviewed_sentences = get_patient_annotation_ids(patient_id,
-                                                        reviewed=ReviewStatus.UNREVIEWED,
-                                                        key="sentence")
-    sentences = reviewed_sentences + unreviewed_sentences
-
+    all_note_details = get_patient_predictions(patient_id)
+    sentences = get_patient_sentences(patient_id)
 
     event_date = get_event_date(patient_id)
     key_annotation_id = get_event_annotation_id(patient_id)
@@ -568,8 +735,8 @@ def upsert_patient_records(patient_id: str, insert_datetime: datetime = None, up
         'total_notes' : get_num_patient_notes(patient_id),
         'reviewed_notes' : num_reviewed_notes,
         'total_sentences' : len(sentences),
-        'reviewed_sentences' : len(reviewed_sentences),
-        'sentences' : "\n".join(sentences),
+        'reviewed_sentences' : sum(sentence["reviewed"] for sentence in sentences),
+        'sentences' : sentences,
         'event_date' : event_date,
         'event_information' : event_information,
         'first_note_date' : first_note_date,
@@ -588,6 +755,294 @@ def upsert_patient_records(patient_id: str, insert_datetime: datetime = None, up
     mongo.db["RESULTS"].update_one({"patient_id": patient_id},
                                     {"$set": patient_results})
 
+@log_function_call
+def rebuild_patient_results(patient_ids=None, insert_datetime: datetime = None):
+    '''
+    Recomputes the RESULTS entries of many patients at once.
+    Each source collection is aggregated a single time for the whole cohort
+    (grouped by patient) instead of running the queries of
+    upsert_patient_records once per patient.
+    Every field except the event information is computed and written
+    on the server with $merge.
+
+    Args :
+        - patient_ids (list[str]) : Patients to rebuild, all patients if None.
+        - insert_datetime (datetime) : Stored as last_updated, defaults to now.
+
+    Returns :
+        - None
+    '''
+    if insert_datetime is None:
+        insert_datetime = datetime.now()
+
+    match_stage = _patient_match_stage(patient_ids)
+
+    logger.info("Rebuilding RESULTS from PATIENTS and NOTES_SUMMARY.")
+    merge_aggregation("PATIENTS", [
+        match_stage,
+        {"$lookup": {
+            "from": "NOTES_SUMMARY",
+            "localField": "patient_id",
+            "foreignField": "patient_id",
+            "as": "summary"
+        }},
+        {"$unwind": {"path": "$summary", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "_id": 0,
+            "patient_id": 1,
+            "total_notes": {"$ifNull": ["$summary.num_notes", 0]},
+            "reviewed_notes": {"$literal": 0},
+            "total_sentences": {"$literal": 0},
+            "reviewed_sentences": {"$literal": 0},
+            "sentences": {"$literal": []},
+            "event_date": {"$ifNull": ["$event_date", None]},
+            "event_information": {"$literal": ""},
+            "first_note_date": {"$ifNull": ["$summary.first_note_date", None]},
+            "last_note_date": {"$ifNull": ["$summary.last_note_date", None]},
+            "comments": {"$ifNull": ["$comments", ""]},
+            "reviewer": {"$cond": [{"$eq": [{"$ifNull": ["$reviewed_by", ""]}, ""]},
+                                   None, "$reviewed_by"]},
+            "max_score_note_id": {"$literal": ""},
+            "max_score_note_date": {"$literal": None},
+            "max_score": {"$literal": None},
+            "predicted_notes": {"$literal": []},
+            "last_updated": {"$literal": insert_datetime},
+            "index_no": "$index_no"
+        }}
+    ], "RESULTS")
+
+    logger.info("Rebuilding reviewed note counts.")
+    merge_aggregation("NOTES", [
+        match_stage,
+        {"$match": {"reviewed": True}},
+        {"$group": {"_id": "$patient_id", "reviewed_notes": {"$sum": 1}}},
+        {"$project": {"_id": 0, "patient_id": "$_id", "reviewed_notes": 1,
+                      "last_updated": {"$literal": insert_datetime}}}
+    ], "RESULTS", when_not_matched="discard")
+
+    rebuild_prediction_results(patient_ids, insert_datetime)
+    rebuild_sentence_results(patient_ids, insert_datetime)
+    rebuild_pending_annotations(patient_ids)
+
+    logger.info("Rebuilding event information.")
+    event_annotation_ids = {patient["patient_id"]: ObjectId(patient["event_annotation_id"])
+                            for patient in mongo.db["PATIENTS"].find(
+                                {**match_stage["$match"],
+                                 "event_date": {"$ne": None},
+                                 "event_annotation_id": {"$ne": None}},
+                                {"_id": 0, "patient_id": 1, "event_annotation_id": 1})}
+    key_annotations = {annotation["_id"]: annotation
+                       for annotation in mongo.db["ANNOTATIONS"].find(
+                           {"_id": {"$in": list(event_annotation_ids.values())}},
+                           {"sentence": 1, "note_id": 1})}
+    bulk_write_documents(({"patient_id": patient_id,
+                           "event_information": (f'{key_annotations[annotation_id]["sentence"]}'
+                                                 f'\nNote_id : {key_annotations[annotation_id]["note_id"]}')}
+                          for patient_id, annotation_id in event_annotation_ids.items()
+                          if annotation_id in key_annotations),
+                         "RESULTS", upsert=False)
+
+# Review statuses of the annotations listed in the RESULTS sentences,
+# skipped annotations are not listed.
+LISTED_REVIEW_STATUSES = [ReviewStatus.REVIEWED.value, ReviewStatus.UNREVIEWED.value]
+
+def _patient_match_stage(patient_ids=None):
+    if patient_ids is None:
+        return {"$match": {}}
+
+    return {"$match": {"patient_id": {"$in": list(patient_ids)}}}
+
+@log_function_call
+def rebuild_prediction_results(patient_ids=None, insert_datetime: datetime = None):
+    '''
+    Recomputes the max_score, max_score_note_id, max_score_note_date and
+    predicted_notes fields of RESULTS from the PINES collection.
+
+    Args :
+        - patient_ids (list[str]) : Patients to rebuild, all patients if None.
+        - insert_datetime (datetime) : Stored as last_updated, defaults to now.
+
+    Returns :
+        - None
+    '''
+    if insert_datetime is None:
+        insert_datetime = datetime.now()
+
+    match_stage = _patient_match_stage(patient_ids)
+    mongo.db["RESULTS"].update_many(match_stage["$match"],
+                                    {"$set": {"max_score_note_id": "",
+                                              "max_score_note_date": None,
+                                              "max_score": None,
+                                              "predicted_notes": [],
+                                              "last_updated": insert_datetime}})
+
+    logger.info("Rebuilding prediction results.")
+    merge_aggregation("PINES", [
+        match_stage,
+        {"$match": {"predicted_score": {"$ne": None}}},
+        {"$group": {
+            "_id": "$patient_id",
+            "max_score": {"$max": "$predicted_score"},
+            "predictions": {"$push": {"text_id": "$text_id",
+                                      "text_date": "$text_date",
+                                      "predicted_score": "$predicted_score"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "patient_id": "$_id",
+            "max_score": 1,
+            "predictions": 1,
+            "max_prediction": {"$arrayElemAt": [{"$filter": {
+                "input": "$predictions",
+                "as": "prediction",
+                "cond": {"$eq": ["$$prediction.predicted_score", "$max_score"]}
+            }}, 0]}
+        }},
+        {"$project": {
+            "patient_id": 1,
+            "max_score": 1,
+            "max_score_note_id": "$max_prediction.text_id",
+            "max_score_note_date": "$max_prediction.text_date",
+            "predicted_notes": "$predictions",
+            "last_updated": {"$literal": insert_datetime}
+        }}
+    ], "RESULTS", when_not_matched="discard")
+
+@log_function_call
+def rebuild_sentence_results(patient_ids=None, insert_datetime: datetime = None):
+    '''
+    Recomputes the total_sentences, reviewed_sentences and sentences
+    fields of RESULTS from the ANNOTATIONS collection.
+
+    Args :
+        - patient_ids (list[str]) : Patients to rebuild, all patients if None.
+        - insert_datetime (datetime) : Stored as last_updated, defaults to now.
+
+    Returns :
+        - None
+    '''
+    if insert_datetime is None:
+        insert_datetime = datetime.now()
+
+    match_stage = _patient_match_stage(patient_ids)
+    mongo.db["RESULTS"].update_many(match_stage["$match"],
+                                    {"$set": {"sentences": [], "total_sentences": 0,
+                                              "reviewed_sentences": 0,
+                                              "last_updated": insert_datetime}})
+
+    logger.info("Rebuilding annotation sentences.")
+    merge_aggregation("ANNOTATIONS", [
+        match_stage,
+        {"$match": {"isNegated": False,
+                    "reviewed": {"$in": LISTED_REVIEW_STATUSES}}},
+        {"$group": {
+            "_id": "$patient_id",
+            "total_sentences": {"$sum": 1},
+            "reviewed_sentences": {"$sum": {"$cond": [
+                {"$eq": ["$reviewed", ReviewStatus.REVIEWED.value]}, 1, 0]}},
+            "sentences": {"$push": {
+                "annotation_id": "$_id",
+                "note_id": "$note_id",
+                "text_date": "$text_date",
+                "sentence_number": "$sentence_number",
+                "sentence": "$sentence",
+                "reviewed": {"$eq": ["$reviewed", ReviewStatus.REVIEWED.value]}
+            }}
+        }},
+        {"$project": {"_id": 0, "patient_id": "$_id", "total_sentences": 1,
+                      "reviewed_sentences": 1, "sentences": 1,
+                      "last_updated": {"$literal": insert_datetime}}}
+    ], "RESULTS", when_not_matched="discard")
+
+@log_function_call
+def rebuild_pending_annotations(patient_ids=None):
+    '''
+    Recomputes the pending_annotations counter of PATIENTS, the number of
+    unreviewed annotations that are not negated, from the ANNOTATIONS collection.
+    The counter is then maintained by set_annotation_review_status.
+
+    Args :
+        - patient_ids (list[str]) : Patients to rebuild, all patients if None.
+
+    Returns :
+        - None
+    '''
+    match_stage = _patient_match_stage(patient_ids)
+    mongo.db["PATIENTS"].update_many(match_stage["$match"],
+                                     {"$set": {"pending_annotations": 0}})
+
+    logger.info("Rebuilding pending annotation counts.")
+    merge_aggregation("ANNOTATIONS", [
+        match_stage,
+        {"$match": {"isNegated": False,
+                    "reviewed": ReviewStatus.UNREVIEWED.value}},
+        {"$group": {"_id": "$patient_id", "pending_annotations": {"$sum": 1}}},
+        {"$project": {"_id": 0, "patient_id": "$_id", "pending_annotations": 1}}
+    ], "PATIENTS", when_not_matched="discard")
+
+def get_sentence_entry(annotation):
+    '''
+    Returns the entry stored in the RESULTS sentences array for an annotation.
+    '''
+    return {"annotation_id": annotation["_id"],
+            "note_id": annotation["note_id"],
+            "text_date": annotation["text_date"],
+            "sentence_number": annotation["sentence_number"],
+            "sentence": annotation["sentence"],
+            "reviewed": annotation["reviewed"] == ReviewStatus.REVIEWED.value}
+
+@log_function_call
+def increment_patient_results(increments):
+    '''
+    Applies changes of the RESULTS counters caused by a review event.
+
+    Args :
+        - increments (dict[str, dict[str, int]]) : The change of each counter
+                                                    by patient ID, e.g.
+                                                    {patient_id : {"reviewed_notes" : 1}}.
+
+    Returns :
+        - None
+    '''
+    operations = []
+    for patient_id, counters in increments.items():
+        counters = {field: value for field, value in counters.items() if value != 0}
+        if not counters:
+            continue
+        operations.append(UpdateOne({"patient_id": patient_id},
+                                    {"$inc": counters,
+                                     "$set": {"last_updated": datetime.now()}}))
+
+    if operations:
+        mongo.db["RESULTS"].bulk_write(operations, ordered=False)
+
+@log_function_call
+def record_patient_review(patient_id: str, insert_datetime: datetime = None,
+                          updated_by: str = None):
+    '''
+    Stores the reviewer and time of the latest review of a patient in RESULTS.
+    The other fields are updated by the functions that record each review event.
+
+    Args :
+        - patient_id (str) : ID of the patient who has been reviewed.
+        - insert_datetime (datetime) : The time at which the review was saved.
+        - updated_by (str) : The name of the user who reviewed the patient.
+
+    Returns :
+        - None
+    '''
+    if updated_by is not None:
+        reviewer = updated_by
+    else:
+        reviewer = get_patient_reviewer(patient_id)
+
+    if insert_datetime is None:
+        insert_datetime = datetime.now()
+
+    mongo.db["RESULTS"].update_one({"patient_id": patient_id},
+                                   {"$set": {"reviewer": reviewer,
+                                             "last_updated": insert_datetime}})
+
 # Get functions
 @log_function_call
 def get_user(username):
@@ -707,6 +1162,18 @@ def get_annotation_note(annotation_id: str):
 
     return note
 
+@log_function_call
+def get_note(note_id: str):
+    """
+    Retrives a single note.
+
+    Args:
+        note_id (str) : Unique ID for the note.
+    Returns:
+        note (dict) : Dictionary for a note from mongodb, None if it does not exist.
+    """
+    return mongo.db["NOTES"].find_one({"text_id": note_id})
+
 @log_function_call
 def get_patient_by_id(patient_id: str):
     """
@@ -771,13 +1238,17 @@ def get_patients_to_annotate():
     """
     logger.info("Retriving all un-reviewed patients from database.")
 
-    # check is this patient has any unreviewed annotations
-    for patient_id in get_patient_ids():
-        annotations = get_patient_annotation_ids(patient_id)
-        if len(annotations) > 0:
-            return patient_id
+    # Patients with unreviewed annotations are kept in a partial index
+    # sorted by index_no to maintain the order of upload.
+    patient = mongo.db["PATIENTS"].find_one({"reviewed": False,
+                                             "locked": False,
+                                             "pending_annotations": {"$gt": 0}},
+                                            {"patient_id": 1},
+                                            sort=[("index_no", 1)])
+    if patient is None:
+        return None
 
-    return None
+    return patient["patient_id"]
 
 @log_function_call
 def patient_results_exist(patient_id: str):
@@ -798,53 +1269,44 @@ def patient_results_exist(patient_id: str):
     return True
 
 @log_function_call
-def get_formatted_patient_predictions(patient_id: str):
+def get_patient_predictions(patient_id: str):
     '''
-    Checks if the results for this patient exist in the RESULTS collection.
+    Retrives the PINES predictions of every scored note of a patient.
 
     Args :
         - patient_id (str) : ID of the patient.
 
     Returns :
-        - concat_patient_predictions (str) : A string with each predicted note
-                as well as the prediction scores. 
-                Each prediction is in the format {note_id:note_date:prediction_score} .
-                Each prediction is seperated by a newline character.
-    '''
-    match_stage = {'patient_id' : patient_id, "predicted_score":{'$ne':None}}
-
-    group_stage = {
-                    '_id' : None,
-                    'note_prediction': { '$push': { '$concat': [ "$text_id", ":", 
-                    { "$dateToString": { "format": "%Y-%m-%d", "date": "$text_date" } },
-                    ":", {'$toString': "$predicted_score"}  ] } }
-                    }
-
-    concat_stage = {
-                    'concat_patient_predictions': {
-                        '$reduce': {
-                            'input': "$note_prediction",
+        - predictions (list[dict]) : The text_id, text_date and predicted_score
+                                        of each predicted note.
+    '''
+    predictions = mongo.db["PINES"].find({'patient_id' : patient_id,
+                                          "predicted_score": {'$ne': None}},
+                                         {"_id": 0, "text_id": 1,
+                                          "text_date": 1, "predicted_score": 1})
 
-                            'initialValue': "",
-                            'in': {
-                                '$cond': [ { "$eq": [ "$$value", "" ] },
-                                "$$this", { '$concat': [ "$$value", "\n", "$$this" ] } ]
-                            }
-                        }}
-                    }
+    return list(predictions)
 
-    pipeline = []
-    pipeline.append({'$match': match_stage})
-    pipeline.append({ '$group' : group_stage})
-    pipeline.append({ '$project' : concat_stage})
+@log_function_call
+def get_patient_sentences(patient_id: str):
+    '''
+    Retrives the sentences of all listed annotations of a patient
+    in the format stored in the RESULTS collection.
 
-    result = mongo.db["PINES"].aggregate(pipeline)
-    result = list(result)
+    Args :
+        - patient_id (str) : ID of the patient.
 
-    if len(result) > 0:
-        return result[0]['concat_patient_predictions']
+    Returns :
+        - sentences (list[dict]) : One entry for each reviewed or unreviewed annotation.
+    '''
+    annotations = mongo.db["ANNOTATIONS"].find({"patient_id": patient_id,
+                                                "isNegated": False,
+                                                "reviewed": {"$in": LISTED_REVIEW_STATUSES}},
+                                               {"note_id": 1, "text_date": 1,
+                                                "sentence_number": 1, "sentence": 1,
+                                                "reviewed": 1})
 
-    return None
+    return [get_sentence_entry(annotation) for annotation in annotations]
 
 @log_function_call
 def get_documents_to_annotate(patient_id=None):
@@ -876,21 +1338,85 @@ def get_documents_to_annotate(patient_id=None):
     return documents_to_annotate
 
 @log_function_call
-def get_all_annotations_for_patient(patient_id: str):
+def get_all_annotations_for_patient(patient_id: str, include_duplicates=True):
     """
     Retrives all annotations for a patient.
 
     Args:
         patient_id (str) : Unique ID for a patient.
+        include_duplicates (bool) : False to only retrieve the annotations that are
+                                    not duplicates found by assign_duplicate_annotations.
     Returns:
         annotations (list) : A list of all annotations for that patient.
     """
+    annotation_filter = {"patient_id": patient_id, "isNegated": False}
+    if not include_duplicates:
+        # Also matches annotations created before duplicates were assigned
+        annotation_filter["duplicate_of"] = None
+
     annotations = list(mongo.db["ANNOTATIONS"]
-                       .find({"patient_id": patient_id, "isNegated": False})
+                       .find(annotation_filter)
                        .sort([("text_date", 1), ("note_id", 1), ("note_start_index", 1)]))
 
     return annotations
 
+@log_function_call
+def assign_duplicate_annotations(patient_id: Optional[str], hide_duplicates: bool):
+    """
+    Points every annotation whose sentence is a duplicate to the first annotation
+    with the same sentence, in the order in which annotations are reviewed.
+    Duplicates are searched for across all the notes of a patient if
+    hide_duplicates is True, otherwise only within each note.
+    Duplicates that are not reviewed are marked as reviewed, so that they do not
+    need to be filtered out when the patient is reviewed.
+
+    Args:
+        patient_id (str) : Unique ID for a patient, None for all patients.
+        hide_duplicates (bool) : True if duplicate sentences are hidden across notes.
+    Returns:
+        duplicate_count (int) : The number of duplicate annotations.
+    """
+    annotation_filter = {"isNegated": False}
+    if patient_id is not None:
+        annotation_filter["patient_id"] = patient_id
+
+    annotations = (mongo.db["ANNOTATIONS"]
+                   .find(annotation_filter,
+                         {"patient_id": 1, "note_id": 1, "sentence": 1, "sentence_hash": 1,
+                          "duplicate_of": 1, "reviewed": 1})
+                   .sort([("patient_id", 1), ("text_date", 1), ("note_id", 1),
+                          ("note_start_index", 1)]))
+
+    canonical_annotations = {}
+    updates = []
+    duplicate_count = 0
+    unreviewed_duplicates = []
+    for annotation in annotations:
+        sentence_hash = annotation.get("sentence_hash") or get_sentence_hash(annotation["sentence"])
+        key = (annotation["patient_id"], sentence_hash)
+        if not hide_duplicates:
+            key += (annotation["note_id"],)
+        duplicate_of = canonical_annotations.setdefault(key, annotation["_id"])
+        if duplicate_of == annotation["_id"]:
+            duplicate_of = None
+        else:
+            duplicate_count += 1
+            if annotation["reviewed"] == ReviewStatus.UNREVIEWED.value:
+                unreviewed_duplicates.append(str(annotation["_id"]))
+
+        if (annotation.get("duplicate_of") != duplicate_of
+                or annotation.get("sentence_hash") != sentence_hash):
+            updates.append(UpdateOne({"_id": annotation["_id"]},
+                                     {"$set": {"duplicate_of": duplicate_of,
+                                               "sentence_hash": sentence_hash}}))
+
+    for start in range(0, len(updates), 1000):
+        mongo.db["ANNOTATIONS"].bulk_write(updates[start:start + 1000], ordered=False)
+
+    mark_annotation_reviewed_batch(unreviewed_duplicates, "CEDARS")
+    logger.info(f"Found {duplicate_count} duplicate annotations.")
+    return duplicate_count
+
 @log_function_call
 def get_patient_annotation_ids(p_id: str, reviewed=ReviewStatus.UNREVIEWED, key="_id"):
     """
@@ -1154,6 +1680,10 @@ def get_patient_lock_status(patient_id: str):
         None
     """
     patient = mongo.db["PATIENTS"].find_one({"patient_id": patient_id})
+    lock_expires_at = patient.get("lock_expires_at")
+    if lock_expires_at is not None and lock_expires_at <= datetime.now():
+        return False
+
     return patient["locked"]
 
 @log_function_call
@@ -1277,6 +1807,135 @@ def update_pines_api_url(new_url):
     mongo.db["INFO"].update_one({},
                                 {"$set": {"pines_url": new_url}})
 
+@log_function_call
+def get_export_watermark(export_name):
+    """
+    Returns the start time of the last incremental export of a type,
+    RESULTS entries updated after this time have not been exported yet.
+
+    Args:
+        export_name (str) : The type of export (compact or full).
+    Returns:
+        watermark (datetime) : None if there has not been an incremental export.
+    """
+    info = mongo.db["INFO"].find_one({}, {"export_watermarks": 1})
+    if info is None:
+        return None
+
+    return info.get("export_watermarks", {}).get(export_name)
+
+@log_function_call
+def update_export_watermark(export_name, watermark):
+    """
+    Stores the start time of an incremental export in the INFO collection.
+
+    Args:
+        export_name (str) : The type of export (compact or full).
+        watermark (datetime) : The time at which the export started.
+    Returns:
+        None
+    """
+    logger.info(f"Setting {export_name} export watermark to {watermark}")
+    mongo.db["INFO"].update_one({},
+                                {"$set": {f"export_watermarks.{export_name}": watermark}})
+
+
+@log_function_call
+def set_annotation_review_status(annotation_filter, status: ReviewStatus):
+    '''
+    Sets the review status of the annotations matching a filter and
+    applies the resulting change of the sentence counters and
+    the sentences array to RESULTS.
+
+    Args :
+        - annotation_filter (dict) : Query selecting the annotations to update.
+        - status (ReviewStatus) : The new review status of the annotations.
+
+    Returns :
+        - modified_count (int) : The number of annotations whose status changed.
+    '''
+    # Read before the update as the previous statuses are overwritten
+    changed_annotations = list(mongo.db["ANNOTATIONS"].find(
+        {"$and": [annotation_filter,
+                  {"isNegated": False, "reviewed": {"$ne": status.value}}]},
+        {"patient_id": 1, "note_id": 1, "text_date": 1,
+         "sentence_number": 1, "sentence": 1, "reviewed": 1}))
+
+    result = mongo.db["ANNOTATIONS"].update_many(annotation_filter,
+                                                 {"$set": {"reviewed": status.value}})
+
+    is_listed = status.value in LISTED_REVIEW_STATUSES
+    changes = {}
+    for annotation in changed_annotations:
+        change = changes.setdefault(annotation["patient_id"],
+                                    {"total_sentences": 0, "reviewed_sentences": 0,
+                                     "pending_annotations": 0,
+                                     "removed": [], "added": []})
+        was_listed = annotation["reviewed"] in LISTED_REVIEW_STATUSES
+        change["pending_annotations"] += ((status == ReviewStatus.UNREVIEWED)
+                                          - (annotation["reviewed"] == ReviewStatus.UNREVIEWED.value))
+        change["total_sentences"] += is_listed - was_listed
+        change["reviewed_sentences"] += ((status == ReviewStatus.REVIEWED)
+                                         - (annotation["reviewed"] == ReviewStatus.REVIEWED.value))
+        if was_listed:
+            change["removed"].append(annotation["_id"])
+        if is_listed:
+            annotation["reviewed"] = status.value
+            change["added"].append(get_sentence_entry(annotation))
+
+    # A changed sentence is pulled and pushed again with its new status,
+    # the two updates must be applied in order.
+    operations = []
+    for patient_id, change in changes.items():
+        operations.append(UpdateOne({"patient_id": patient_id},
+                                    {"$inc": {"total_sentences": change["total_sentences"],
+                                              "reviewed_sentences": change["reviewed_sentences"]},
+                                     "$set": {"last_updated": datetime.now()},
+                                     "$pull": {"sentences": {"annotation_id": {"$in": change["removed"]}}}}))
+        if change["added"]:
+            operations.append(UpdateOne({"patient_id": patient_id},
+                                        {"$push": {"sentences": {"$each": change["added"]}}}))
+
+    if operations:
+        mongo.db["RESULTS"].bulk_write(operations, ordered=True)
+
+    pending_operations = [UpdateOne({"patient_id": patient_id},
+                                    {"$inc": {"pending_annotations": change["pending_annotations"]}})
+                          for patient_id, change in changes.items()
+                          if change["pending_annotations"] != 0]
+    if pending_operations:
+        mongo.db["PATIENTS"].bulk_write(pending_operations, ordered=False)
+
+    return result.modified_count
+
+@log_function_call
+def set_note_review_status(note_filter, is_reviewed: bool, reviewed_by: str):
+    '''
+    Sets the review status of the notes matching a filter and
+    applies the resulting change of the reviewed_notes counter to RESULTS.
+
+    Args :
+        - note_filter (dict) : Query selecting the notes to update.
+        - is_reviewed (bool) : True if the notes are marked reviewed.
+        - reviewed_by (str) : The name of the user who changed the review status.
+
+    Returns :
+        - None
+    '''
+    changed_filter = {"reviewed": {"$ne": True}} if is_reviewed else {"reviewed": True}
+    changed_notes = mongo.db["NOTES"].aggregate([
+        {"$match": {"$and": [note_filter, changed_filter]}},
+        {"$group": {"_id": "$patient_id", "count": {"$sum": 1}}}
+    ])
+    increments = {group["_id"]: {"reviewed_notes": group["count"] if is_reviewed else -group["count"]}
+                  for group in changed_notes}
+
+    mongo.db["NOTES"].update_many(note_filter,
+                                  {"$set": {"reviewed": is_reviewed,
+                                            "reviewed_by": reviewed_by}})
+    increment_patient_results(increments)
+    if increments:
+        bump_notes_review_versions(increments.keys())
 
 @log_function_call
 def batch_mark_annotation_reviewed(annotation_ids, reviewed_by):
@@ -1294,8 +1953,7 @@ def batch_mark_annotation_reviewed(annotation_ids, reviewed_by):
     """
     logger.debug(f"Marking annotations {annotation_ids} as reviewed.")
     annotation_ids = [ObjectId(annotation_id) for annotation_id in annotation_ids]
-    mongo.db["ANNOTATIONS"].update_many({"_id": {"$in": annotation_ids}},
-                                       {"$set": {"reviewed": ReviewStatus.REVIEWED.value}})
+    set_annotation_review_status({"_id": {"$in": annotation_ids}}, ReviewStatus.REVIEWED)
 
     annotation_data = mongo.db["ANNOTATIONS"].find({"_id": {"$in": annotation_ids}})
     note_ids = list(set([i['note_id'] for i in annotation_data]))
@@ -1338,8 +1996,7 @@ def mark_annotation_reviewed(annotation_id, reviewed_by):
         None
     """
     logger.debug(f"Marking annotation #{annotation_id} as reviewed.")
-    mongo.db["ANNOTATIONS"].update_one({"_id": ObjectId(annotation_id)},
-                                       {"$set": {"reviewed": ReviewStatus.REVIEWED.value}})
+    set_annotation_review_status({"_id": ObjectId(annotation_id)}, ReviewStatus.REVIEWED)
     update_note_review_status(annotation_id, reviewed_by)
 
 @log_function_call
@@ -1364,10 +2021,8 @@ def mark_annotation_reviewed_batch(annotation_ids, reviewed_by):
 
     logger.info(f"Marking annotations {annotation_ids} as reviewed.")
 
-    mongo.db["ANNOTATIONS"].update_many(
-        {"_id": {"$in": [ObjectId(aid) for aid in annotation_ids]}},
-        {"$set": {"reviewed": ReviewStatus.REVIEWED.value}}
-    )
+    set_annotation_review_status({"_id": {"$in": [ObjectId(aid) for aid in annotation_ids]}},
+                                 ReviewStatus.REVIEWED)
     update_batch_note_review_status(annotation_ids, reviewed_by)
 
 @log_function_call
@@ -1438,11 +2093,7 @@ def update_batch_note_review_status(annotation_ids, reviewed_by):
 
     if reviewed_notes:
         logger.debug(f"Marking notes {reviewed_notes} as reviewed.")
-        mongo.db["NOTES"].update_many(
-            {"text_id": {"$in": reviewed_notes}},
-            {"$set": {"reviewed": True,
-                      "reviewed_by": reviewed_by}}
-        )
+        set_note_review_status({"text_id": {"$in": reviewed_notes}}, True, reviewed_by)
 
 
 @log_function_call
@@ -1459,8 +2110,7 @@ def revert_annotation_reviewed(annotation_id, reviewed_by):
         None
     '''
     logger.debug(f"Marking annotation #{annotation_id} as un-reviewed.")
-    mongo.db["ANNOTATIONS"].update_one({"_id": ObjectId(annotation_id)},
-                                       {"$set": {"reviewed": ReviewStatus.UNREVIEWED.value}})
+    set_annotation_review_status({"_id": ObjectId(annotation_id)}, ReviewStatus.UNREVIEWED)
 
     annotation_data = get_annotation(annotation_id)
     note_id = annotation_data['note_id']
@@ -1481,9 +2131,7 @@ def revert_note_reviewed(note_id, reviewed_by: str):
                             causing this note to be marked un-reviewed.
     """
     logger.debug(f"Marking note #{note_id} as un-reviewed.")
-    mongo.db["NOTES"].update_one({"text_id": note_id},
-                                 {"$set": {"reviewed": False,
-                                           "reviewed_by": reviewed_by}})
+    set_note_review_status({"text_id": note_id}, False, reviewed_by)
 
     note_info = mongo.db["NOTES"].find_one({"text_id": note_id})
     revert_patient_reviewed(note_info['patient_id'], reviewed_by)
@@ -1521,11 +2169,10 @@ def mark_annotations_post_event(patient_id: str, event_date: datetime.date):
         - None
     '''
     logger.info(f"Skipping future annotations for patient {patient_id} after {event_date}.")
-    mongo.db["ANNOTATIONS"].update_many({ 'patient_id' : patient_id,
-                                          'text_date': {'$gte': event_date},
-                                          'reviewed': ReviewStatus.UNREVIEWED.value
-                                        },
-                                        {"$set": {"reviewed": ReviewStatus.SKIPPED.value}})
+    set_annotation_review_status({'patient_id' : patient_id,
+                                  'text_date': {'$gte': event_date},
+                                  'reviewed': ReviewStatus.UNREVIEWED.value},
+                                 ReviewStatus.SKIPPED)
 
 @log_function_call
 def revert_skipped_annotations(patient_id: str):
@@ -1540,10 +2187,9 @@ def revert_skipped_annotations(patient_id: str):
     Returns:
         - None
     '''
-    mongo.db["ANNOTATIONS"].update_many({ 'patient_id' : patient_id,
-                                          'reviewed': ReviewStatus.SKIPPED.value
-                                        },
-                                        {"$set": {"reviewed": ReviewStatus.UNREVIEWED.value}})
+    set_annotation_review_status({'patient_id' : patient_id,
+                                  'reviewed': ReviewStatus.SKIPPED.value},
+                                 ReviewStatus.UNREVIEWED)
 
 @log_function_call
 def update_event_date(patient_id: str, new_date, annotation_id):
@@ -1566,6 +2212,15 @@ def update_event_date(patient_id: str, new_date, annotation_id):
 
     update_event_annotation_id(patient_id, annotation_id)
 
+    event_information = ""
+    key_annotation = get_annotation(annotation_id) if annotation_id else None
+    if new_date and key_annotation:
+        event_information = f'{key_annotation["sentence"]}\nNote_id : {key_annotation["note_id"]}'
+    mongo.db["RESULTS"].update_one({"patient_id": patient_id},
+                                   {"$set": {"event_date": new_date,
+                                             "event_information": event_information,
+                                             "last_updated": datetime.now()}})
+
 @log_function_call
 def delete_event_date(patient_id: str):
     """
@@ -1581,6 +2236,10 @@ def delete_event_date(patient_id: str):
     mongo.db["PATIENTS"].update_one({"patient_id": patient_id},
                                        {"$set": {"event_date": None}})
     delete_event_annotation_id(patient_id)
+    mongo.db["RESULTS"].update_one({"patient_id": patient_id},
+                                   {"$set": {"event_date": None,
+                                             "event_information": "",
+                                             "last_updated": datetime.now()}})
 
 @log_function_call
 def get_event_annotation_id(patient_id: str):
@@ -1654,7 +2313,7 @@ def mark_patient_reviewed(patient_id: str, reviewed_by: str, is_reviewed=True):
                                               "reviewed_by": reviewed_by}})
 
     logger.info(f"Storing results for patient #{patient_id}")
-    upsert_patient_records(patient_id, datetime.now())
+    record_patient_review(patient_id, datetime.now(), reviewed_by)
 
 @log_function_call
 def mark_note_reviewed(note_id, reviewed_by: str):
@@ -1666,9 +2325,7 @@ def mark_note_reviewed(note_id, reviewed_by: str):
         reviewed_by (str) : The name of the user who reviewed the note.
     """
     logger.debug(f"Marking note #{note_id} as reviewed.")
-    mongo.db["NOTES"].update_one({"text_id": note_id},
-                                 {"$set": {"reviewed": True,
-                                           "reviewed_by": reviewed_by}})
+    set_note_review_status({"text_id": note_id}, True, reviewed_by)
 
 @log_function_call
 def batch_mark_note_reviewed(note_ids, reviewed_by: str):
@@ -1680,9 +2337,7 @@ def batch_mark_note_reviewed(note_ids, reviewed_by: str):
         reviewed_by (str) : The name of the user who reviewed the note.
     """
     logger.debug(f"Marking notes #{note_ids} as reviewed.")
-    mongo.db["NOTES"].update_many({"text_id": {"$in": note_ids}},
-                                 {"$set": {"reviewed": True,
-                                           "reviewed_by": reviewed_by}})
+    set_note_review_status({"text_id": {"$in": note_ids}}, True, reviewed_by)
 
 @log_function_call
 def reset_patient_reviewed():
@@ -1697,6 +2352,7 @@ def reset_patient_reviewed():
                                                "comments": ""}})
     mongo.db["NOTES"].update_many({}, {"$set": {"reviewed": False,
                                                 "reviewed_by": ""}})
+    rebuild_patient_results()
 
 @log_function_call
 def add_comment(patient_id, comment):
@@ -1714,6 +2370,9 @@ def add_comment(patient_id, comment):
                                     {"$set":
                                      {"comments": comment}
                                      })
+    mongo.db["RESULTS"].update_one({"patient_id": patient_id},
+                                   {"$set": {"comments": comment,
+                                             "last_updated": datetime.now()}})
 
 @log_function_call
 def set_patient_lock_status(patient_id: str, status):
@@ -1728,8 +2387,108 @@ def set_patient_lock_status(patient_id: str, status):
         None
     """
     patients_collection = mongo.db["PATIENTS"]
-    patients_collection.update_one({"patient_id": patient_id},
-                                   {"$set": {"locked": status}})
+    if status:
+        patients_collection.update_one({"patient_id": patient_id},
+                                       {"$set": {"locked": True}})
+    else:
+        patients_collection.update_one({"patient_id": patient_id},
+                                       {"$set": {"locked": False},
+                                        "$unset": {"locked_by": "", "lock_expires_at": ""}})
+
+def _lock_fields(owner: str, lease_seconds: int):
+    return {"locked": True,
+            "locked_by": owner,
+            "lock_expires_at": datetime.now() + timedelta(seconds=lease_seconds)}
+
+@log_function_call
+def claim_next_patient(owner: str, lease_seconds: int):
+    """
+    Selects and locks the next patient with annotations to review
+    in a single atomic operation, so that concurrent users
+    are never given the same patient.
+
+    Args:
+        owner (str) : The name of the user claiming the patient.
+        lease_seconds (int) : Number of seconds for which the lock is held.
+
+    Returns:
+        patient_id (str) : The claimed patient, None if no patient is left to review.
+    """
+    release_expired_locks()
+    patient = mongo.db["PATIENTS"].find_one_and_update(
+        {"reviewed": False, "locked": False, "pending_annotations": {"$gt": 0}},
+        {"$set": _lock_fields(owner, lease_seconds)},
+        projection={"patient_id": 1},
+        sort=[("index_no", 1)])
+
+    if patient is None:
+        logger.info("Failed to claim any further un-reviewed patients.")
+        return None
+
+    return patient["patient_id"]
+
+@log_function_call
+def claim_patient(patient_id: str, owner: str, lease_seconds: int):
+    """
+    Locks a patient for a user in a single atomic operation.
+    A patient already locked by the same user is claimed again
+    with a new lease, this is also used to renew the lease
+    while the patient is being reviewed.
+
+    Args:
+        patient_id (str) : Unique ID for the patient.
+        owner (str) : The name of the user claiming the patient.
+        lease_seconds (int) : Number of seconds for which the lock is held.
+
+    Returns:
+        is_claimed (bool) : False if the patient does not exist
+                            or is locked by another user.
+    """
+    patient = mongo.db["PATIENTS"].find_one_and_update(
+        {"patient_id": patient_id,
+         "$or": [{"locked": False},
+                 {"locked_by": owner},
+                 {"lock_expires_at": {"$lte": datetime.now()}}]},
+        {"$set": _lock_fields(owner, lease_seconds)},
+        projection={"patient_id": 1})
+
+    return patient is not None
+
+@log_function_call
+def release_patient(patient_id: str, owner: str):
+    """
+    Unlocks a patient only if it is still locked by the given user,
+    e.g. a patient reserved for a user who stopped reviewing.
+
+    Args:
+        patient_id (str) : Unique ID for the patient.
+        owner (str) : The name of the user who claimed the patient.
+
+    Returns:
+        is_released (bool) : False if the patient is not locked by this user.
+    """
+    result = mongo.db["PATIENTS"].update_one({"patient_id": patient_id, "locked_by": owner},
+                                             {"$set": {"locked": False},
+                                              "$unset": {"locked_by": "", "lock_expires_at": ""}})
+    return result.modified_count > 0
+
+@log_function_call
+def release_expired_locks():
+    """
+    Unlocks the patients whose lock lease has expired, e.g. when the
+    session of the user reviewing the patient ended without unlocking it.
+    Only the expired locks are read from the lock_expires_at index.
+
+    Returns:
+        count (int) : The number of patients unlocked.
+    """
+    result = mongo.db["PATIENTS"].update_many({"lock_expires_at": {"$lte": datetime.now()}},
+                                              {"$set": {"locked": False},
+                                               "$unset": {"locked_by": "", "lock_expires_at": ""}})
+    if result.modified_count > 0:
+        logger.info(f"Released {result.modified_count} expired patient locks.")
+
+    return result.modified_count
 
 @log_function_call
 def remove_all_locked():
@@ -1739,7 +2498,8 @@ def remove_all_locked():
     """
     patients_collection = mongo.db["PATIENTS"]
     patients_collection.update_many({},
-                                    {"$set": {"locked": False}})
+                                    {"$set": {"locked": False},
+                                     "$unset": {"locked_by": "", "lock_expires_at": ""}})
 
 @log_function_call
 def update_annotation_reviewed(note_id: str) -> int:
@@ -1751,10 +2511,7 @@ def update_annotation_reviewed(note_id: str) -> int:
     Returns:
         count (int) : The number of annotations that were marked as reviewed.
     """
-    annotations_collection = mongo.db["ANNOTATIONS"]
-    result = annotations_collection.update_many({"note_id": note_id},
-                                                {"$set": {"reviewed": ReviewStatus.REVIEWED.value}})
-    return result.modified_count
+    return set_annotation_review_status({"note_id": note_id}, ReviewStatus.REVIEWED)
 
 
 # delete functions
@@ -1767,6 +2524,7 @@ def empty_annotations():
     logger.info("Deleting all data in annotations collection.")
     annotations = mongo.db["ANNOTATIONS"]
     annotations.delete_many({})
+    mongo.db["PATIENTS"].update_many({}, {"$set": {"pending_annotations": 0}})
 
     # also reset the queue
     flask.current_app.task_queue.empty()
@@ -1779,6 +2537,84 @@ def drop_database(name):
 
 
 # utility functions
+@log_function_call
+def merge_aggregation(collection_name, pipeline, into, on="patient_id",
+                      when_matched="merge", when_not_matched="insert",
+                      chunk_size=2000):
+    '''
+    Runs an aggregation pipeline and writes its output into another collection
+    using a $merge stage, so the documents never have to be loaded into python.
+
+    Backends that do not support $merge (such as DocumentDB or mongomock)
+    will instead stream the output of the pipeline and write it in chunks.
+
+    Args :
+        - collection_name (str) : Collection the pipeline is run on.
+        - pipeline (list[dict]) : Aggregation stages, without the $merge stage.
+        - into (str) : Collection the output documents are written to.
+        - on (str) : Field used to match output documents to existing ones.
+                        This field must have a unique index in the target collection.
+        - when_matched (str) : Either "merge", "replace" or "keepExisting".
+        - when_not_matched (str) : Either "insert" or "discard".
+        - chunk_size (int) : Number of documents per bulk write when $merge is not available.
+
+    Returns :
+        - None
+    '''
+    merge_stage = {"$merge": {"into": into,
+                              "on": on,
+                              "whenMatched": when_matched,
+                              "whenNotMatched": when_not_matched}}
+    try:
+        mongo.db[collection_name].aggregate(pipeline + [merge_stage], allowDiskUse=True)
+        return
+    except NotImplementedError:
+        logger.info(f"$merge is not supported, writing {into} in chunks.")
+    except OperationFailure as exc:
+        # 40324 : Unrecognized pipeline stage name
+        if exc.code != 40324:
+            raise
+        logger.info(f"$merge is not supported, writing {into} in chunks.")
+
+    bulk_write_documents(mongo.db[collection_name].aggregate(pipeline, allowDiskUse=True),
+                         into, on=on, when_matched=when_matched,
+                         upsert=when_not_matched == "insert", chunk_size=chunk_size)
+
+@log_function_call
+def bulk_write_documents(documents, into, on="patient_id", when_matched="merge",
+                         upsert=True, chunk_size=2000):
+    '''
+    Writes a stream of documents into a collection with chunked unordered bulk writes.
+
+    Args :
+        - documents (iterable[dict]) : Documents to write, each must contain the field on.
+        - into (str) : Collection the documents are written to.
+        - on (str) : Field used to match documents to existing ones.
+        - when_matched (str) : Either "merge", "replace" or "keepExisting".
+        - upsert (bool) : True if documents without a match are inserted.
+        - chunk_size (int) : Number of documents per bulk write.
+
+    Returns :
+        - None
+    '''
+    operations = []
+    for document in documents:
+        document.pop("_id", None)
+        key = {on: document[on]}
+        if when_matched == "keepExisting":
+            operations.append(UpdateOne(key, {"$setOnInsert": document}, upsert=upsert))
+        elif when_matched == "replace":
+            operations.append(ReplaceOne(key, document, upsert=upsert))
+        else:
+            operations.append(UpdateOne(key, {"$set": document}, upsert=upsert))
+
+        if len(operations) == chunk_size:
+            mongo.db[into].bulk_write(operations, ordered=False)
+            operations = []
+
+    if operations:
+        mongo.db[into].bulk_write(operations, ordered=False)
+
 @log_function_call
 def check_password(username, password):
     """
@@ -2135,89 +2971,275 @@ def is_pines_api_running():
 
     return False
 
+def format_sentences(sentences):
+    '''
+    Renders the RESULTS sentences array as text, one sentence per line
+    in the format {note_id}:{note_date}:{sentence}.
+    Reviewed sentences are listed first, each group sorted by
+    note_id, note date and sentence number.
+    '''
+    if isinstance(sentences, str):
+        # Results stored by older versions
+        return sentences
+
+    sentences = sorted(sentences, key=lambda sentence: (not sentence["reviewed"],
+                                                        sentence["note_id"],
+                                                        sentence["text_date"],
+                                                        sentence["sentence_number"]))
+
+    return "\n".join(f'{sentence["note_id"]}:{str(sentence["text_date"])[:10]}:'
+                     f'{" ".join(sentence["sentence"].split())}'
+                     for sentence in sentences)
+
+def format_predicted_notes(predictions):
+    '''
+    Renders the RESULTS predicted_notes array as text, one prediction per line
+    in the format {note_id}:{note_date}:{prediction_score}.
+    '''
+    if predictions is None or isinstance(predictions, str):
+        return predictions
+
+    if len(predictions) == 0:
+        return None
+
+    return "\n".join(f'{prediction["text_id"]}:{str(prediction["text_date"])[:10]}:'
+                     f'{prediction["predicted_score"]}'
+                     for prediction in predictions)
+
+def format_results_row(row):
+    '''
+    Renders the structured fields of a RESULTS document for export.
+    '''
+    if "sentences" in row:
+        row["sentences"] = format_sentences(row["sentences"])
+    if "predicted_notes" in row:
+        row["predicted_notes"] = format_predicted_notes(row["predicted_notes"])
+
+    return row
+
+RESULTS_EXPORT_SCHEMA = {
+    'patient_id': pl.Utf8,
+    'total_notes': pl.Int64,
+    'reviewed_notes': pl.Int64,
+    'total_sentences': pl.Int64,
+    'reviewed_sentences': pl.Int64,
+    'sentences': pl.Utf8,
+    'event_date': pl.Datetime,
+    'event_information': pl.Utf8,
+    'first_note_date': pl.Datetime,
+    'last_note_date': pl.Datetime,
+    'comments': pl.Utf8,
+    'reviewer': pl.Utf8,
+    'max_score_note_id': pl.Utf8,
+    'max_score_note_date': pl.Datetime,
+    'max_score': pl.Float64,
+    'predicted_notes': pl.Utf8,
+    'last_updated' : pl.Datetime
+}
+
+@log_function_call
+def iter_results_frames(schema, query=None, batch_size=1000):
+    '''
+    Reads the RESULTS collection in batches for an export.
+
+    Args :
+        - schema (dict) : Columns to export and their polars types.
+        - query (dict) : Filter for the RESULTS documents, all documents if None.
+        - batch_size (int) : Number of patients in each batch.
+
+    Returns :
+        - frames (generator[polars.DataFrame]) : One DataFrame per batch,
+                                                 in upload order of the patients.
+                                                 An empty DataFrame if no documents match.
+    '''
+    projection = {'_id': False}
+    projection.update({column : True for column in schema.keys()})
+
+    # Sorting results by index_no to maintain upload order
+    # Mongodb will ignore this command if index_no does not exist.
+    # This is improtant for backwards compatibility,
+    # as the index_no will not be present in older CEDARS versions.
+    cursor = mongo.db["RESULTS"].find(query or {}, projection,
+                                      batch_size=batch_size).sort([("index_no", 1)])
+
+    date_cols = ['first_note_date', 'last_note_date', 'event_date']
+    batch_number = 0
+    while True:
+        rows = [format_results_row(row) for row in islice(cursor, batch_size)]
+        # An empty export still has one (empty) batch for the header and schema
+        if not rows and batch_number > 0:
+            break
+
+        batch_number += 1
+        logger.info(f"Exporting batch {batch_number} of RESULTS")
+        frame = pl.DataFrame(rows, orient="row", schema=schema,
+                             infer_schema_length=None)
+        yield frame.with_columns([pl.col(col).dt.date() for col in date_cols])
+
+# Incremental exports also include the entries updated this long before the
+# previous export started. last_updated is stamped before the write is committed
+# (and by workers whose clocks may differ), so an entry stamped just before the
+# watermark can become visible after the previous export has read past it.
+EXPORT_WATERMARK_OVERLAP = timedelta(minutes=5)
+
 @log_function_call
-def download_annotations(filename: str = "annotations.csv", get_sentences: bool = False) -> bool:
+def download_annotations(filename: str = "annotations.csv", get_sentences: bool = False,
+                         export_format: str = "csv", incremental: bool = False) -> bool:
     """
     Download annotations from the database and stream them to MinIO.
+
+    Args :
+        - filename (str) : Name of the file in the annotated_files folder.
+        - get_sentences (bool) : True if the key sentences are to be included.
+        - export_format (str) : One of exporter.EXPORT_FORMATS (csv, parquet or ipc).
+        - incremental (bool) : True if only the patients whose results changed since
+                               the last incremental export of this type are exported.
+                               Consecutive incremental exports overlap by
+                               EXPORT_WATERMARK_OVERLAP, so a patient can be in two of
+                               them and the latest row of a patient must be kept.
+
+    Returns :
+        - (bool) : True if the file was uploaded.
     """
-    schema = {
-        'patient_id': pl.Utf8,
-        'total_notes': pl.Int64,
-        'reviewed_notes': pl.Int64,
-        'total_sentences': pl.Int64,
-        'reviewed_sentences': pl.Int64,
-        'sentences': pl.Utf8,
-        'event_date': pl.Datetime,
-        'event_information': pl.Utf8,
-        'first_note_date': pl.Datetime,
-        'last_note_date': pl.Datetime,
-        'comments': pl.Utf8,
-        'reviewer': pl.Utf8,
-        'max_score_note_id': pl.Utf8,
-        'max_score_note_date': pl.Datetime,
-        'max_score': pl.Float64,
-        'predicted_notes': pl.Utf8,
-        'last_updated' : pl.Datetime
-    }
+    if export_format not in exporter.EXPORT_FORMATS:
+        logger.error(f"Unsupported export format {export_format}.")
+        return False
 
+    schema = dict(RESULTS_EXPORT_SCHEMA)
     if  get_sentences is False:
         schema.pop('sentences')
 
+    # The watermark is the start of the export, entries updated while the
+    # file is written are exported again by the next export. Mongodb stores
+    # milliseconds, entries updated in the same millisecond are also included.
+    export_name = "full" if get_sentences else "compact"
+    started_at = datetime.now()
+    started_at = started_at.replace(microsecond=started_at.microsecond // 1000 * 1000)
+    query = None
+    metadata = None
+    if incremental:
+        since = get_export_watermark(export_name)
+        if since is not None:
+            query = {"last_updated": {"$gte": since - EXPORT_WATERMARK_OVERLAP}}
+        metadata = {"export-since": since.isoformat() if since else "",
+                    "export-until": started_at.isoformat()}
+
+    export = exporter.EXPORT_FORMATS[export_format]
     try:
-        logger.info("Starting download task")
-        # Create an in-memory buffer for the CSV data
-        csv_buffer = StringIO()
-        writer = pd.DataFrame(columns=list(schema.keys()))
-        writer.to_csv(csv_buffer, index=False, header=True, encoding="utf-8-sig")
-
-        # Write data in chunks and stream to MinIO
-        columns_to_retrive = {'_id': False}
-        columns_to_retrive.update({column : True for column in schema.keys()})
-
-        # Sorting results by index_no to maintain upload order
-        # Mongodb will ignore this command if index_no does not exist.
-        # This is improtant for backwards compatibility,
-        # as the index_no will not be present in older CEDARS versions.
-        logger.info("Retriving RESULTS from db")
-        project_results = mongo.db["RESULTS"].find({},
-                                                    columns_to_retrive).sort([("index_no", 1)])
-
-        logger.info("Creating dataframe for RESULTS")
-        df = pl.DataFrame(project_results, orient="row",
-                                           schema=schema,
-                                           infer_schema_length=None)
-
-        date_cols = ['first_note_date', 'last_note_date', 'event_date']
-        for col in date_cols:
-            df = df.with_columns(
-                pl.col(col).dt.date().alias(col)
-            )
-
-        logger.info("Uploading results to csv buffer")
-        chunk_size = 1000
-        for chunk_index in range(0, df.shape[0], chunk_size):
-            chunk = df.slice(chunk_index, chunk_size)
-            logger.info(f"Sending chunk {ceil(chunk_index/chunk_size)+1}/{ceil(df.shape[0]/chunk_size)} to csv buffer")
-            csv_buffer.write(chunk.to_pandas().to_csv(header=False,index=False))
-
-        # Move the cursor to the beginning of the buffer
-        csv_buffer.seek(0)
-        data_bytes = csv_buffer.getvalue().encode('utf-8')
-        data_stream = BytesIO(data_bytes)
-
-        logger.info("Uploading RESULTS to minio")
-        # Upload to MinIO
+        logger.info(f"Starting {export_format} download task")
+        frames = iter_results_frames(schema, query, batch_size=export["batch_size"])
+        chunks = export["writer"](frames)
+        # Multipart upload of unknown length, only one part is held in memory
         minio.put_object(g.bucket_name,
                          f"annotated_files/{filename}",
-                         data_stream,
-                         length=len(data_bytes),
-                         content_type="application/csv")
+                         exporter.IterStream(chunks),
+                         length=-1,
+                         part_size=exporter.EXPORT_PART_SIZE,
+                         content_type=export["content_type"],
+                         metadata=metadata)
         logger.info(f"Uploaded annotations to s3: {filename}")
-        return True
     except Exception as e:
         logger.error(f"Failed to upload annotations to s3: {filename}, error: {str(e)}")
         return False
 
+    if incremental:
+        update_export_watermark(export_name, started_at)
+    return True
+
+ANNOTATION_EXPORT_SCHEMA = {
+    'annotation_id': pl.Utf8,
+    'patient_id': pl.Utf8,
+    'note_id': pl.Utf8,
+    'text_date': pl.Datetime,
+    'sentence_number': pl.Int64,
+    'sentence_start': pl.Int64,
+    'sentence_end': pl.Int64,
+    'note_start_index': pl.Int64,
+    'note_end_index': pl.Int64,
+    'token': pl.Utf8,
+    'sentence': pl.Utf8,
+    'isNegated': pl.Boolean,
+    'reviewed': pl.Int64,
+    'predicted_score': pl.Float64,
+}
+
+def iter_annotation_frames(batch_size=50000):
+    '''
+    Reads the ANNOTATIONS collection in batches with the PINES score of each note.
+
+    Args :
+        - batch_size (int) : Number of annotations in each batch.
+
+    Returns :
+        - frames (generator[polars.DataFrame]) : One DataFrame per batch,
+                                                 sorted by patient, note date,
+                                                 note and position in the note.
+    '''
+    projection = {column: True for column in ANNOTATION_EXPORT_SCHEMA
+                  if column not in ("annotation_id", "predicted_score")}
+
+    # Sort order of the index on patient_id, isNegated, text_date, note_id, note_start_index
+    cursor = mongo.db["ANNOTATIONS"].find({}, projection,
+                                          batch_size=batch_size).sort([("patient_id", 1),
+                                                                       ("isNegated", 1),
+                                                                       ("text_date", 1),
+                                                                       ("note_id", 1),
+                                                                       ("note_start_index", 1)])
+    batch_number = 0
+    while True:
+        annotations = list(islice(cursor, batch_size))
+        if not annotations and batch_number > 0:
+            break
+
+        note_ids = list({annotation["note_id"] for annotation in annotations})
+        scores = {prediction["text_id"]: prediction.get("predicted_score")
+                  for prediction in mongo.db["PINES"].find({"text_id": {"$in": note_ids}},
+                                                           {"text_id": True,
+                                                            "predicted_score": True})}
+        rows = []
+        for annotation in annotations:
+            annotation["annotation_id"] = str(annotation.pop("_id"))
+            annotation["predicted_score"] = scores.get(annotation["note_id"])
+            rows.append(annotation)
+
+        batch_number += 1
+        logger.info(f"Exporting batch {batch_number} of ANNOTATIONS")
+        yield pl.DataFrame(rows, schema=ANNOTATION_EXPORT_SCHEMA)
+
+@log_function_call
+def export_annotation_details(dirname: str, rows_per_part: int = 1000000,
+                              batch_size: int = 50000) -> bool:
+    """
+    Streams one row per annotation, with the PINES score of its note,
+    to MinIO as a partitioned parquet dataset.
+    Each part is a separate object with one row group per batch.
+
+    Args :
+        - dirname (str) : Name of the folder in annotated_files for the parts.
+        - rows_per_part (int) : Minimum number of rows in each part (except the last).
+        - batch_size (int) : Number of annotations read and written at a time.
+
+    Returns :
+        - (bool) : True if all of the parts were uploaded.
+    """
+    export = exporter.EXPORT_FORMATS["parquet"]
+    frames = iter_annotation_frames(batch_size)
+    try:
+        for part_number, part in enumerate(exporter.iter_partitions(frames, rows_per_part)):
+            object_name = f"annotated_files/{dirname}/part-{part_number:05d}.parquet"
+            minio.put_object(g.bucket_name,
+                             object_name,
+                             exporter.IterStream(export["writer"](part)),
+                             length=-1,
+                             part_size=exporter.EXPORT_PART_SIZE,
+                             content_type=export["content_type"])
+            logger.info(f"Uploaded annotation details to s3: {object_name}")
+    except Exception as e:
+        logger.error(f"Failed to upload annotation details to s3: {dirname}, error: {str(e)}")
+        return False
+
+    return True
+
 @log_function_call
 def update_patient_results(update_existing_results = False):
     '''
@@ -2235,13 +3257,31 @@ def update_patient_results(update_existing_results = False):
         - None
     '''
 
-    if "RESULTS" not in mongo.db.list_collection_names():
-        # Create results collection
-        populate_results()
+    if update_existing_results:
+        rebuild_patient_results()
+        return
+
+    # Anti-join on the RESULTS patient_id index, only the IDs of
+    # the patients without results are streamed from the server.
+    missing_patient_ids = (patient["patient_id"] for patient in mongo.db["PATIENTS"].aggregate([
+        {"$project": {"_id": 0, "patient_id": 1}},
+        {"$lookup": {
+            "from": "RESULTS",
+            "localField": "patient_id",
+            "foreignField": "patient_id",
+            "as": "results"
+        }},
+        {"$match": {"results": []}}
+    ], allowDiskUse=True))
+
+    chunk_size = 10000
+    while True:
+        chunk = list(islice(missing_patient_ids, chunk_size))
+        if not chunk:
+            break
 
-    for patient_id in get_all_patient_ids():
-        if update_existing_results or (not patient_results_exist(patient_id)):
-            upsert_patient_records(patient_id)
+        logger.info(f"Creating results for {len(chunk)} patients without results.")
+        rebuild_patient_results(chunk)
 
 @log_function_call
 def terminate_project():
@@ -2261,6 +3301,7 @@ def terminate_project():
     mongo.db.drop_collection("TASK")
     mongo.db.drop_collection("RESULTS")
     mongo.db.drop_collection("NOTES_SUMMARY")
+    bump_notes_version()
 
     project_id = os.getenv("PROJECT_ID", None)
 
@@ -0,0 +1,214 @@
+"""
+This module contatins the writers used to stream exports to MinIO.
+Exports are written one batch at a time into a readable stream that
+MinIO uploads as a multipart object, so the size of an export does not
+change the memory used to create it.
+"""
+import io
+from itertools import groupby
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Size of each part of a multipart upload, MinIO requires at least 5 MiB.
+EXPORT_PART_SIZE = 16 * 1024 * 1024
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S%.f"
+PARQUET_COMPRESSION = "zstd"
+IPC_COMPRESSION = "zstd"
+
+
+class IterStream(io.RawIOBase):
+    '''
+    A read only file-like object over an iterator of bytes.
+    Data is only produced by the iterator when it is read.
+    '''
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Fills the buffer from as many chunks as needed
+        written = 0
+        while written < len(buffer):
+            if not self._pending:
+                self._pending = next(self._chunks, None)
+                if self._pending is None:
+                    self._pending = b""
+                    break
+                continue
+
+            size = min(len(buffer) - written, len(self._pending))
+            buffer[written:written + size] = self._pending[:size]
+            self._pending = self._pending[size:]
+            written += size
+
+        return written
+
+
+def csv_chunks(frames):
+    '''
+    Writes a stream of polars DataFrames as CSV.
+
+    Args :
+        - frames (iterable[polars.DataFrame]) : Batches with the same columns.
+
+    Returns :
+        - chunks (generator[bytes]) : The CSV text of each batch,
+                                      the header is written with the first batch.
+    '''
+    include_header = True
+    for frame in frames:
+        buffer = io.BytesIO()
+        frame.write_csv(buffer, include_header=include_header,
+                        datetime_format=DATETIME_FORMAT)
+        include_header = False
+        yield buffer.getvalue()
+
+
+class ChunkSink(io.RawIOBase):
+    '''
+    A write only file-like object that keeps the bytes written since
+    the last call to drain. The position reported by tell is the total
+    number of bytes written, so writers that record offsets in a footer
+    (parquet and Arrow IPC files) produce a valid file.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(frames, compression=PARQUET_COMPRESSION):
+    '''
+    Writes a stream of polars DataFrames as a parquet file.
+
+    Args :
+        - frames (iterable[polars.DataFrame]) : Batches with the same schema.
+        - compression (str) : Compression codec of the column chunks.
+
+    Returns :
+        - chunks (generator[bytes]) : The bytes of one row group per batch,
+                                      the footer is written after the last batch.
+    '''
+    sink = ChunkSink()
+    writer = None
+    for frame in frames:
+        table = frame.to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema, compression=compression)
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def ipc_chunks(frames, compression=IPC_COMPRESSION):
+    '''
+    Writes a stream of polars DataFrames as an Arrow IPC file.
+
+    Args :
+        - frames (iterable[polars.DataFrame]) : Batches with the same schema.
+        - compression (str) : Compression codec of the record batches.
+
+    Returns :
+        - chunks (generator[bytes]) : The bytes of the record batches of each frame,
+                                      the footer is written after the last batch.
+    '''
+    sink = ChunkSink()
+    writer = None
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    for frame in frames:
+        table = frame.to_arrow()
+        if writer is None:
+            writer = pa.ipc.new_file(sink, table.schema, options=options)
+        writer.write_table(table)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def iter_partitions(frames, rows_per_part):
+    '''
+    Splits a stream of DataFrames into consecutive partitions of whole batches.
+    Each partition must be consumed before the next one is read.
+
+    Args :
+        - frames (iterable[polars.DataFrame]) : Batches with the same schema.
+        - rows_per_part (int) : A new partition is started once a partition
+                                has at least this number of rows.
+
+    Returns :
+        - partitions (generator[iterator[polars.DataFrame]]) : The batches of each partition.
+    '''
+    written_rows = 0
+
+    def part_number(frame):
+        nonlocal written_rows
+        number = written_rows // rows_per_part
+        written_rows += frame.height
+        return number
+
+    return (part for _, part in groupby(frames, key=part_number))
+
+
+# Writer, file extension, content type and number of rows in each
+# batch for every export format. Larger batches are used for the columnar
+# formats as every batch becomes a row group or record batch in the file.
+EXPORT_FORMATS = {
+    "csv": {
+        "writer": csv_chunks,
+        "extension": "csv",
+        "content_type": "text/csv",
+        "batch_size": 1000,
+    },
+    "parquet": {
+        "writer": parquet_chunks,
+        "extension": "parquet",
+        "content_type": "application/vnd.apache.parquet",
+        "batch_size": 10000,
+    },
+    "ipc": {
+        "writer": ipc_chunks,
+        "extension": "arrow",
+        "content_type": "application/vnd.apache.arrow.file",
+        "batch_size": 10000,
+    },
+}
+
+
+def get_export_format(filename):
+    '''
+    Returns the export format of a file from its extension, csv if it is unknown.
+    '''
+    extension = str(filename).rsplit('.', maxsplit=1)[-1].lower()
+    for export_format, details in EXPORT_FORMATS.items():
+        if details["extension"] == extension:
+            return export_format
+
+    return "csv"
@@ -0,0 +1,268 @@
+"""
+This module contatins the format adapters used to load uploaded EMR files.
+Every supported file type is read as a stream of pyarrow RecordBatches that
+follow the NOTES schema, so the rest of the upload pipeline is the same for
+every format and only one batch is held in memory at a time.
+"""
+import csv
+import gzip
+import json
+import xml.etree.ElementTree as ET
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from loguru import logger
+from .cedars_enums import log_function_call
+
+logger.enable(__name__)
+
+# Columns every uploaded file must contain and the types they are converted to.
+# Optional text_tag_* columns are read as strings, any other columns are kept as loaded
+# (csv files are read with every column as a string).
+NOTES_SCHEMA = pa.schema([
+    pa.field("text_id", pa.string(), nullable=False),
+    pa.field("patient_id", pa.string(), nullable=False),
+    pa.field("text_date", pa.timestamp("ms"), nullable=False),
+    pa.field("text", pa.string()),
+])
+TEXT_TAG_PREFIX = "text_tag_"
+DATE_FORMAT = "%Y-%m-%d"
+# Size of the blocks read from csv files
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+@log_function_call
+def get_file_extension(filepath):
+    '''
+    Returns the extension of an uploaded file.
+    GZIP files are assumed to be a compressed csv as this is the
+    only compressed format allowed by ops.allowed_data_file.
+    '''
+    extension = str(filepath).rsplit('.', maxsplit=1)[-1].lower()
+    if extension == "gz":
+        return "csv.gz"
+
+    return extension
+
+
+@log_function_call
+def conform_batch(batch):
+    '''
+    Validates and converts a RecordBatch to the NOTES schema.
+
+    Args :
+        - batch (pyarrow.RecordBatch) : A batch of rows loaded from an uploaded file.
+
+    Returns :
+        - batch (pyarrow.RecordBatch) : The batch with the NOTES columns converted
+                                        to their declared types.
+
+    Raises :
+        - ValueError : If a required column is missing or cannot be converted.
+    '''
+    missing_columns = [name for name in NOTES_SCHEMA.names if name not in batch.schema.names]
+    if missing_columns:
+        raise ValueError(f"Uploaded file is missing the required columns {missing_columns}.")
+
+    columns = []
+    fields = []
+    for field, column in zip(batch.schema, batch.columns):
+        if field.name == "text_date":
+            column = _to_timestamp(column)
+        elif field.name in NOTES_SCHEMA.names or field.name.startswith(TEXT_TAG_PREFIX):
+            column = _to_string(column)
+        columns.append(column)
+        fields.append(pa.field(field.name, column.type))
+
+    return pa.RecordBatch.from_arrays(columns, schema=pa.schema(fields))
+
+
+def _to_string(column):
+    if pa.types.is_string(column.type):
+        return column
+    if pa.types.is_floating(column.type):
+        # IDs read into a float column because of missing values
+        # are written without the trailing '.0'
+        is_whole = pc.equal(column, pc.floor(column))
+        if pc.all(pc.or_kleene(is_whole, pc.is_null(column))).as_py():
+            column = pc.cast(column, pa.int64())
+
+    return pc.cast(column, pa.string())
+
+
+def _to_timestamp(column):
+    try:
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            return pc.strptime(pc.utf8_trim_whitespace(column), format=DATE_FORMAT, unit="ms")
+        return pc.cast(column, pa.timestamp("ms"))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as exc:
+        raise ValueError(f"text_date must be a date in the format YYYY-MM-DD : {exc}") from exc
+
+
+def _rebatch(batches, batch_size):
+    '''
+    Re-slices a stream of RecordBatches of any size into batches of batch_size rows.
+    '''
+    pending = []
+    pending_rows = 0
+    for batch in batches:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= batch_size:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, batch_size).combine_chunks().to_batches()[0]
+            remainder = table.slice(batch_size)
+            pending = remainder.to_batches()
+            pending_rows = remainder.num_rows
+
+    if pending_rows > 0:
+        yield pa.Table.from_batches(pending).combine_chunks().to_batches()[0]
+
+
+def _rows_to_batches(rows, batch_size):
+    '''
+    Groups a stream of row dictionaries into RecordBatches of batch_size rows.
+    '''
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == batch_size:
+            yield pa.RecordBatch.from_pylist(chunk)
+            chunk = []
+
+    if chunk:
+        yield pa.RecordBatch.from_pylist(chunk)
+
+
+def _read_csv_header(filepath):
+    open_file = gzip.open if get_file_extension(filepath) == "csv.gz" else open
+    with open_file(filepath, "rt", encoding="utf-8-sig", newline="") as file:
+        return next(csv.reader(file), [])
+
+
+def _read_csv(filepath, batch_size):
+    # Every column is read as a string, types are set in conform_batch.
+    # Types inferred from the first block could fail on a later block
+    # (or drop the leading zeros of IDs and tags).
+    read_options = pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE)
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(column_types={name: pa.string()
+                                                          for name in _read_csv_header(filepath)})
+    reader = pa_csv.open_csv(filepath, read_options=read_options,
+                             parse_options=parse_options,
+                             convert_options=convert_options)
+
+    return _rebatch(reader, batch_size)
+
+
+def _read_parquet(filepath, batch_size):
+    return pq.ParquetFile(filepath).iter_batches(batch_size=batch_size)
+
+
+def _read_json(filepath, batch_size):
+    with open(filepath, "r", encoding="utf-8") as file:
+        first_character = file.read(1)
+        while first_character.isspace():
+            first_character = file.read(1)
+
+    if first_character == "[":
+        # A JSON array cannot be read incrementally without a streaming parser,
+        # JSON lines files should be used for large uploads.
+        logger.info(f"Loading JSON array {filepath} into memory.")
+        with open(filepath, "r", encoding="utf-8") as file:
+            rows = json.load(file)
+        yield from _rows_to_batches(rows, batch_size)
+        return
+
+    def json_lines():
+        with open(filepath, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    yield from _rows_to_batches(json_lines(), batch_size)
+
+
+def _read_excel(filepath, batch_size):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(name) for name in next(rows)]
+        yield from _rows_to_batches((dict(zip(header, row)) for row in rows), batch_size)
+    finally:
+        workbook.close()
+
+
+def _read_xml(filepath, batch_size):
+    def xml_rows():
+        # Each child of the root element is a row and
+        # each child of a row is a column.
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(filepath, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if root is None:
+                    root = element
+                continue
+            depth -= 1
+            if depth == 1:
+                yield {child.tag: child.text for child in element}
+                # Drop rows that have already been read
+                root.clear()
+
+    return _rows_to_batches(xml_rows(), batch_size)
+
+
+def _read_pickle(filepath, batch_size):
+    # Pickled DataFrames can only be loaded as a whole.
+    logger.info(f"Loading pickle {filepath} into memory.")
+    dataframe = pd.read_pickle(filepath)
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+
+    return table.to_batches(max_chunksize=batch_size)
+
+
+READERS = {
+    "csv": _read_csv,
+    "csv.gz": _read_csv,
+    "parquet": _read_parquet,
+    "json": _read_json,
+    "xlsx": _read_excel,
+    "xml": _read_xml,
+    "pickle": _read_pickle,
+    "pkl": _read_pickle,
+}
+
+
+@log_function_call
+def iter_record_batches(filepath, batch_size=1000):
+    '''
+    Streams a local EMR file as RecordBatches that follow the NOTES schema.
+
+    Args :
+        - filepath (str) : Path to a local csv, csv.gz, xlsx, json,
+                            parquet, pickle, pkl or xml file.
+        - batch_size (int) : Maximum number of rows in each batch.
+
+    Returns :
+        - batches (generator[pyarrow.RecordBatch]) : Batches of at most batch_size rows.
+
+    Raises :
+        - ValueError : If the file type is not supported or the file does not
+                        match the NOTES schema.
+    '''
+    extension = get_file_extension(filepath)
+    if extension not in READERS:
+        raise ValueError(f"""
+                         Unsupported file extension '{extension}'.
+                         Supported extensions are
+                         {', '.join(READERS.keys())}.""")
+
+    for batch in READERS[extension](filepath, batch_size):
+        if batch.num_rows > 0:
+            yield conform_batch(batch)
@@ -30,7 +30,8 @@ def create_ops_worker():
         worker = Worker(rq_app.ops_queue,
                         connection=rq_app.redis,
                         )
-        worker.work()
+        # The scheduler runs the coalesced RESULTS updates
+        worker.work(with_scheduler=True)
 
 
 if __name__ == "__main__":
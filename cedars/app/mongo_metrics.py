@@ -0,0 +1,175 @@
+"""
+This module contatins the monitoring of the commands sent to MongoDB.
+The duration of every command is recorded in a prometheus histogram labelled
+by collection and command, and the slowest commands are kept in a rolling
+log in redis, shared by all workers, with the values of their filters redacted.
+"""
+import json
+from datetime import datetime
+from loguru import logger
+from prometheus_client import Histogram
+from pymongo import monitoring
+
+MONGO_COMMAND_DURATION = Histogram("cedars_mongo_command_duration_seconds",
+                                   "Time spent in MongoDB commands.",
+                                   ["collection", "command"])
+
+SLOW_QUERY_KEY = "cedars:slow_queries"
+# Number of slow commands kept in the log
+SLOW_QUERY_LOG_SIZE = 200
+REDACTED = "?"
+
+# Fields of each command that describe the documents it reads or writes
+FILTER_FIELDS = {
+    "find": ["filter", "sort", "projection"],
+    "aggregate": ["pipeline"],
+    "count": ["query"],
+    "distinct": ["key", "query"],
+    "findAndModify": ["query", "sort"],
+    "update": ["updates"],
+    "delete": ["deletes"],
+    "insert": [],
+    "createIndexes": ["indexes"],
+    "getMore": [],
+}
+# Fields of a $lookup stage naming collections and fields, needed to find missing indexes
+LOOKUP_NAME_FIELDS = ("from", "localField", "foreignField", "as")
+# Stages that only hold collection and field names and sort directions
+UNREDACTED_STAGES = ("$sort", "$merge", "$out")
+
+
+def redact(value, keep_field_paths=False):
+    '''
+    Returns the shape of a filter, where all of the values are replaced
+    and only the field names and operators are kept.
+    Field paths ("$field") are also kept in aggregation pipelines.
+    '''
+    if isinstance(value, dict):
+        return {key: redact(item, keep_field_paths) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # The shape of a list of values does not depend on its length
+        if all(not isinstance(item, (dict, list, tuple)) for item in value):
+            if keep_field_paths and any(isinstance(item, str) and item.startswith("$")
+                                        for item in value):
+                return [redact(item, keep_field_paths) for item in value]
+            return [REDACTED] if value else []
+        return [redact(item, keep_field_paths) for item in value]
+    if keep_field_paths and isinstance(value, str) and value.startswith("$"):
+        return value
+    return REDACTED
+
+
+def redact_pipeline(pipeline):
+    '''
+    Returns the shape of an aggregation pipeline, keeping the field paths
+    and the collections and fields joined by $lookup stages.
+    '''
+    stages = []
+    for stage in pipeline:
+        shape = {}
+        for operator, spec in stage.items():
+            if operator in UNREDACTED_STAGES:
+                shape[operator] = spec
+            elif operator == "$lookup" and isinstance(spec, dict):
+                shape[operator] = {key: (item if key in LOOKUP_NAME_FIELDS
+                                         else redact_pipeline(item) if key == "pipeline"
+                                         else redact(item, keep_field_paths=True))
+                                   for key, item in spec.items()}
+            else:
+                shape[operator] = redact(spec, keep_field_paths=True)
+        stages.append(shape)
+
+    return stages
+
+
+def get_command_shape(command_name, command):
+    '''
+    Returns the redacted fields of a command that describe the documents it uses.
+    '''
+    shape = {}
+    for field in FILTER_FIELDS.get(command_name, []):
+        if field not in command:
+            continue
+        if field in ("updates", "deletes"):
+            # Every statement of a bulk write usually has the same shape
+            statement = command[field][0] if command[field] else {}
+            shape[field] = redact({key: statement[key] for key in ("q", "u")
+                                   if key in statement})
+        elif field in ("sort", "projection", "key", "indexes"):
+            # Field names and directions are not sensitive
+            shape[field] = command[field]
+        elif field == "pipeline":
+            shape[field] = redact_pipeline(command[field])
+        else:
+            shape[field] = redact(command[field])
+
+    return shape
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    '''
+    Records the duration of the MongoDB commands and logs the slow commands.
+    '''
+
+    def __init__(self, redis, slow_query_ms):
+        self._redis = redis
+        self._slow_query_seconds = slow_query_ms / 1000
+        self._started = {}
+
+    def started(self, event):
+        if event.command_name == "getMore":
+            # The getMore field is the cursor ID
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self._started[(event.connection_id, event.request_id)] = (collection, event.command)
+
+    def succeeded(self, event):
+        self._finished(event, failed=False)
+
+    def failed(self, event):
+        self._finished(event, failed=True)
+
+    def _finished(self, event, failed):
+        collection, command = self._started.pop((event.connection_id, event.request_id),
+                                                ("", None))
+        duration = event.duration_micros / 1e6
+        MONGO_COMMAND_DURATION.labels(collection=collection,
+                                      command=event.command_name).observe(duration)
+
+        if duration >= self._slow_query_seconds and command is not None:
+            self._log_slow_query(collection, event.command_name, command, duration, failed)
+
+    def _log_slow_query(self, collection, command_name, command, duration, failed):
+        slow_query = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "collection": collection,
+            "command": command_name,
+            "duration_ms": round(duration * 1000, 1),
+            "failed": failed,
+            "shape": get_command_shape(command_name, command),
+        }
+        try:
+            with self._redis.pipeline() as pipe:
+                pipe.lpush(SLOW_QUERY_KEY, json.dumps(slow_query, default=str))
+                pipe.ltrim(SLOW_QUERY_KEY, 0, SLOW_QUERY_LOG_SIZE - 1)
+                pipe.execute()
+        except Exception as e:
+            # Monitoring must never break a query
+            logger.error(f"Failed to log slow query: {str(e)}")
+
+
+def get_slow_queries(redis, limit=SLOW_QUERY_LOG_SIZE):
+    '''
+    Returns the most recent slow commands, the most recent first.
+
+    Args :
+        - redis (Redis) : The connection used by the MongoCommandListener.
+        - limit (int) : Maximum number of commands returned.
+
+    Returns :
+        - slow_queries (list[dict]) : The logged commands.
+    '''
+    return [json.loads(value) for value in redis.lrange(SLOW_QUERY_KEY, 0, limit - 1)]
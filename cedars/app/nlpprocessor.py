@@ -189,11 +189,13 @@ class NlpProcessor:
         docs_with_annotations = 0
         for document, doc in zip(document_list, annotations):
             match_count = 0
-            sentence_start = 0
-            sentence_end = 0
             for sent_no, sentence_annotation in enumerate(doc.sents):
                 sentence_text = sentence_annotation.text.strip()
+                # Offsets of the stripped sentence in the note
+                sentence_start = (sentence_annotation.start_char + len(sentence_annotation.text)
+                                  - len(sentence_annotation.text.lstrip()))
                 sentence_end = sentence_start + len(sentence_text)
+                sentence_hash = db.get_sentence_hash(sentence_text)
                 matches = self.matcher(sentence_annotation)
                 for match in matches:
                     _, start, end = match
@@ -203,6 +205,7 @@ class NlpProcessor:
                     token_end = token_start + len(token.text)
                     annotation = {
                                     "sentence": sentence_text,
+                                    "sentence_hash": sentence_hash,
                                     "token": token.text,
                                     "isNegated": has_negation,
                                     "note_start_index": token_start,
@@ -221,14 +224,19 @@ class NlpProcessor:
                             docs_with_annotations += 1
                         match_count += 1
 
-                sentence_start = sentence_end + 1
-
             if match_count == 0:
                 db.mark_note_reviewed(document["text_id"], reviewed_by="CEDARS")
             count += 1
             if (count) % 10 == 0:
                 logger.info(f"Processed {count} / {len(document_list)} documents")
 
+        # Duplicate sentences are hidden from the reviewers
+        db.assign_duplicate_annotations(patient_id, db.get_search_query("hide_duplicates"))
+
+        # Counters in RESULTS are updated incrementally by review events
+        # so they are recomputed once the new annotations are stored.
+        db.rebuild_patient_results(None if patient_id is None else [patient_id])
+
         # Mark the patient as reviewed if no annotations are found.
         if docs_with_annotations == 0:
             db.mark_patient_reviewed(patient_id, "CEDARS")
@@ -259,6 +267,7 @@ class NlpProcessor:
             return
 
         db.predict_and_save(notes)
+        db.rebuild_prediction_results([patient_id])
         scores = []
         for note_id in notes:
             score = db.get_note_prediction_from_db(note_id)
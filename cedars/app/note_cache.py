@@ -0,0 +1,124 @@
+"""
+This module contatins the per-worker cache of the notes shown to annotators.
+Moving between the annotations of a note shows the same note and the same
+highlighted text, so both are kept in memory instead of being read from
+the database and highlighted again on every page.
+Cached notes are keyed by the version of the review statuses of the notes of
+their patient, which is kept in redis so every worker reads a note again
+once its review status has changed.
+"""
+import threading
+from collections import OrderedDict
+from loguru import logger
+from . import db
+from .adjudication_handler import SentenceHighlighter
+from .cedars_enums import log_function_call
+
+logger.enable(__name__)
+
+# Maximum number of notes and highlighted notes kept by each worker
+NOTE_CACHE_SIZE = 256
+HIGHLIGHT_CACHE_SIZE = 256
+
+
+class LRUCache:
+    '''
+    A thread safe mapping that keeps the most recently used entries.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_notes = LRUCache(NOTE_CACHE_SIZE)
+_highlighted_notes = LRUCache(HIGHLIGHT_CACHE_SIZE)
+_notes_version = None
+
+
+def _check_notes_version(notes_version):
+    global _notes_version
+    if notes_version != _notes_version:
+        if _notes_version is not None:
+            logger.info("Stored notes have changed, clearing the note cache.")
+        clear()
+        _notes_version = notes_version
+
+
+@log_function_call
+def get_note(note_id, patient_id):
+    '''
+    Returns a note, reading it from the database if it is not cached
+    or if the review status of a note of the patient has changed.
+
+    Args :
+        - note_id (str) : Unique ID for the note.
+        - patient_id (str) : Unique ID for the patient of the note.
+
+    Returns :
+        - note (dict) : The note, None if it does not exist.
+    '''
+    notes_version, review_version = db.get_patient_notes_versions(patient_id)
+    _check_notes_version(notes_version)
+    # Entries cached for earlier review versions are dropped by the LRU
+    key = (note_id, review_version)
+    note = _notes.get(key)
+    if note is None:
+        note = db.get_note(note_id)
+        if note is None:
+            return None
+        _notes.put(key, note)
+
+    return note
+
+
+def clear():
+    '''
+    Removes all of the cached notes and highlighted notes.
+    '''
+    _notes.clear()
+    _highlighted_notes.clear()
+
+
+class CachedSentenceHighlighter(SentenceHighlighter):
+    '''
+    SentenceHighlighter that reuses the highlighted text of a note
+    when it is shown again with the same annotations.
+    '''
+
+    def get_highlighted_text(self, note, annotations_for_note):
+        key = (note["text_id"], note.get("content_hash"),
+               tuple((annotation['note_start_index'], annotation['note_end_index'])
+                     for annotation in annotations_for_note))
+        highlighted_text = _highlighted_notes.get(key)
+        if highlighted_text is None:
+            highlighted_text = super().get_highlighted_text(note, annotations_for_note)
+            _highlighted_notes.put(key, highlighted_text)
+
+        return highlighted_text
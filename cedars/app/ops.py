@@ -3,11 +3,9 @@ This page contatins the functions and the flask blueprint for the /proj_details
 """
 import os
 import re
-import copy
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import tempfile
-import pandas as pd
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
 import flask
 from dotenv import dotenv_values
 from flask import (
@@ -16,17 +14,22 @@ from flask import (
     url_for, flash, g, jsonify
 )
 
-from .cedars_enums import ReviewStatus
 from loguru import logger
 import requests
 from flask_login import current_user, login_required
 from werkzeug.utils import secure_filename
 from rq import Retry, Callback
+from rq.job import JobStatus
 from rq.registry import FailedJobRegistry
 from rq.registry import FinishedJobRegistry, StartedJobRegistry
 from . import db
 from . import nlpprocessor
 from . import auth
+from . import file_loader
+from . import exporter
+from . import adjudication_cache
+from . import note_cache
+from . import mongo_metrics
 from .database import minio
 from .api import load_pines_url, kill_pines_api
 from .api import get_token_status
@@ -138,24 +141,31 @@ def internal_processes():
                             rq_dashboard_url = rq_dashboard_url,
                             **db.get_info())
 
+@bp.route("/slow_queries", methods=["GET"])
+@auth.admin_required
 @log_function_call
-def read_gz_csv(filename, *args, **kwargs):
-    '''
-    Function to read a GZIP compressed csv to a pandas DataFrame.
-    '''
-    return pd.read_csv(filename, compression='gzip', *args, **kwargs)
+def slow_queries():
+    """
+    Shows the most recent slow MongoDB commands recorded by the MongoCommandListener.
+    """
+    return render_template("ops/slow_queries.html",
+                           slow_queries = mongo_metrics.get_slow_queries(flask.current_app.redis),
+                           slow_query_ms = flask.current_app.config.get("SLOW_QUERY_MS", 100),
+                           **db.get_info())
 
 @log_function_call
-def load_pandas_dataframe(filepath, chunk_size=1000):
+def load_record_batches(filepath, chunk_size=1000):
     """
-    Load tabular data from a file into a pandas DataFrame.
+    Load tabular data from a file in the minio bucket as a stream of pyarrow RecordBatches.
+    The columns of each batch follow the NOTES schema from file_loader.
 
     Args:
         filepath (str): The path to the file to load data from.
-            Supported file extensions: csv, xlsx, json, parquet, pickle, pkl, xml.
+            Supported file extensions: csv, csv.gz, xlsx, json, parquet, pickle, pkl, xml.
+        chunk_size (int): Maximum number of rows in each batch.
 
     Returns:
-        pd.DataFrame: DataFrame with the data from the file.
+        generator[pyarrow.RecordBatch]: Batches with the data from the file.
 
     Raises:
         ValueError: If the file extension is not supported.
@@ -164,53 +174,29 @@ def load_pandas_dataframe(filepath, chunk_size=1000):
     if not filepath:
         raise ValueError("Filepath must be provided.")
 
-    extension = str(filepath).rsplit('.', maxsplit=1)[-1].lower()
-    # If the extension is gz, we can assume it is a csv.gz file as this
-    # is the only filecheck supported in the allowed_data_file check
-    loaders = {
-        'csv': pd.read_csv,
-        'xlsx': pd.read_excel,
-        'json': pd.read_json,
-        'parquet': pd.read_parquet,
-        'pickle': pd.read_pickle,
-        'pkl': pd.read_pickle,
-        'xml': pd.read_xml,
-        'gz' : read_gz_csv,
-    }
-
-    if extension not in loaders:
+    extension = file_loader.get_file_extension(filepath)
+    if extension not in file_loader.READERS:
         raise ValueError(f"""
                          Unsupported file extension '{extension}'.
                          Supported extensions are
-                         {', '.join(loaders.keys())}.""")
+                         {', '.join(file_loader.READERS.keys())}.""")
 
+    local_directory = tempfile.gettempdir()
+    local_filename = os.path.join(local_directory, os.path.basename(filepath))
     try:
         logger.info(filepath)
-        obj = minio.get_object(g.bucket_name, filepath)
-        local_directory = tempfile.gettempdir()
         os.makedirs(local_directory, exist_ok=True)
-        local_filename = os.path.join(local_directory, os.path.basename(filepath))
         minio.fget_object(g.bucket_name, filepath, local_filename)
         logger.info(f"File downloaded successfully to {local_filename}")
 
-        # Re-initialise object from minio to load it again
-        if extension == 'parquet':
-            parquet_file = pq.ParquetFile(local_filename)
-            for batch in parquet_file.iter_batches(batch_size=chunk_size):
-                yield batch.to_pandas()
-        else:
-            chunks = loaders[extension](local_filename, chunksize=chunk_size)
-            for chunk in chunks:
-                yield chunk
+        yield from file_loader.iter_record_batches(local_filename, chunk_size)
 
     except FileNotFoundError as exc:
         raise FileNotFoundError(f"File '{filepath}' not found.") from exc
     except Exception as exc:
         raise RuntimeError(f"Failed to load the file '{filepath}' due to: {str(exc)}") from exc
     finally:
-        obj.close()
-        obj.release_conn()
-        if 'local_filepath' in locals() and os.path.exists(local_filename):
+        if os.path.exists(local_filename):
             os.remove(local_filename)
             logger.info(f"Removed temporary file: {local_filename}")
 
@@ -218,7 +204,8 @@ def load_pandas_dataframe(filepath, chunk_size=1000):
 def prepare_note(note_info):
     logger.debug(f"Formatting note info for note {note_info['text_id']}.")
     date_format = '%Y-%m-%d'
-    note_info["text_date"] = datetime.strptime(note_info["text_date"], date_format)
+    if isinstance(note_info["text_date"], str):
+        note_info["text_date"] = datetime.strptime(note_info["text_date"], date_format)
     note_info["reviewed"] = False
     note_info["text_id"] = str(note_info["text_id"]).strip()
     note_info["patient_id"] = str(note_info["patient_id"]).strip()
@@ -244,26 +231,29 @@ def EMR_to_mongodb(filepath, chunk_size=1000):
 
     total_rows = 0
     total_chunks = 0
-    all_patient_ids = []
+    # Ordered set of patient IDs, a patient whose notes span
+    # multiple chunks is only stored once.
+    all_patient_ids = {}
 
     try:
-        for chunk in load_pandas_dataframe(filepath, chunk_size):
+        for chunk in load_record_batches(filepath, chunk_size):
             total_chunks += 1
-            rows_in_chunk = len(chunk)
+            rows_in_chunk = chunk.num_rows
             total_rows += rows_in_chunk
 
             logger.info(f"Processing chunk {total_chunks} with {rows_in_chunk} rows")
 
             # Prepare notes
-            notes_to_insert = [prepare_note(row.to_dict()) for _, row in chunk.iterrows()]
+            notes_to_insert = [prepare_note(row) for row in chunk.to_pylist()]
 
-            # Collect patient IDs
-            chunk_patient_ids = list(chunk['patient_id'].unique())
+            # Collect patient IDs, in the order in which they appear
+            chunk_patient_ids = pc.unique(chunk.column('patient_id')).to_pylist()
             chunk_patient_ids = prepare_patients(chunk_patient_ids)
-            all_patient_ids.extend(chunk_patient_ids)
+            all_patient_ids.update(dict.fromkeys(chunk_patient_ids))
 
-            # Bulk insert notes
-            inserted_count = db.bulk_insert_notes(notes_to_insert)
+            # Bulk upsert notes, notes that are already stored are skipped
+            # so that a failed upload can safely be run again.
+            inserted_count = db.bulk_upsert_notes(notes_to_insert)
             logger.info(f"Inserted {inserted_count} notes from chunk {total_chunks}")
 
         # store NOTES_SUMMARY such as first_note_date, last_note_date, total_notes etc.
@@ -555,58 +545,41 @@ def queue_stats():
                           })
 
 @log_function_call
-def backup_session_data(patient_id, patient_data,
+def backup_session_data(patient_id, current_index,
                         reviewed_annotation_ids, patient_comments,
                         skip_after_event):
-    """Backup session data to a file"""
+    """Backup the session data of the current user to the cache"""
     try:
-        backup_dir = os.path.join(flask.current_app.instance_path, 'session_backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        backup_file = os.path.join(backup_dir, f'session.json')
-        patient_data['review_statuses'] = [str(x.value) for x in patient_data['review_statuses']]
         backup_data = {
             'patient_id': patient_id,
-            'patient_data': patient_data,
+            'current_index': current_index,
             'reviewed_annotation_ids' : reviewed_annotation_ids,
             'patient_comments' : patient_comments,
-            'skip_after_event' : skip_after_event,
-            'timestamp': datetime.now().isoformat()
+            'skip_after_event' : skip_after_event
         }
-        
-        with open(backup_file, 'w') as f:
-            json.dump(backup_data, f)
-            
+        adjudication_cache.save_session_snapshot(current_user.username, patient_id,
+                                                 backup_data)
+
         logger.info(f"Backed up session data for patient {patient_id}")
     except Exception as e:
         logger.error(f"Failed to backup session data: {str(e)}")
 
 @log_function_call
 def restore_session_data():
-    """Restore session data from backup file"""
+    """Restore the session data of the current user from the cache"""
     try:
-        backup_dir = os.path.join(flask.current_app.instance_path, 'session_backups')
-        backup_file = os.path.join(backup_dir, f'session.json')
-        
-        if os.path.exists(backup_file):
-            with open(backup_file, 'r') as f:
-                backup_data = json.load(f)
-            backup_data['patient_data']['review_statuses'] = [ReviewStatus(int(x)) for x in backup_data['patient_data']['review_statuses']]
-                
-            # Only restore if the backup is less than 1 hour old
-            backup_time = datetime.fromisoformat(backup_data['timestamp'])
-            if (datetime.now() - backup_time).total_seconds() < 3600:
-                session['patient_id'] = backup_data['patient_id']
-                session['patient_data'] = backup_data['patient_data']
-                session['reviewed_annotation_ids'] = backup_data['reviewed_annotation_ids']
-                session['patient_comments'] = backup_data['patient_comments']
-                session['skip_after_event'] = backup_data['skip_after_event']
-                logger.info(f"Restored session data for patient")
-                return True
-            else:
-                logger.warning(f"Backup for patient is too old")
-                os.remove(backup_file)  # Clean up old backup
-        return False
+        # Snapshots expire after an hour
+        backup_data = adjudication_cache.load_session_snapshot(current_user.username)
+        if backup_data is None:
+            return False
+
+        session['patient_id'] = backup_data['patient_id']
+        session['current_index'] = backup_data['current_index']
+        session['reviewed_annotation_ids'] = backup_data['reviewed_annotation_ids']
+        session['patient_comments'] = backup_data['patient_comments']
+        session['skip_after_event'] = backup_data['skip_after_event']
+        logger.info(f"Restored session data for patient {backup_data['patient_id']}")
+        return True
     except Exception as e:
         logger.error(f"Failed to restore session data: {str(e)}")
         return False
@@ -636,7 +609,7 @@ def update_patient_data(patient_id, comments, reviewed_by,
                                        reviewed_by)
     db.add_comment(patient_id, comments.strip())
 
-    db.upsert_patient_records(patient_id,
+    db.record_patient_review(patient_id,
                              timestamp,
                              reviewed_by
                     )
@@ -715,6 +688,95 @@ def delete_patient_date(patient_id,
                         reviewed_annotation_ids, timestamp,
                         is_patient_reviewed)
 
+RESULTS_DIRTY_KEY_PREFIX = "cedars:results_dirty:"
+
+@log_function_call
+def enqueue_patient_results_update(patient_id, updated_by):
+    '''
+    Schedules an update of the RESULTS entry of a patient on the ops queue.
+    Requests are coalesced per patient : the latest request is stored in a
+    "dirty" marker in redis and a single job with a deterministic ID is
+    scheduled after the configured window. Requests arriving while that
+    job is pending only replace the marker. A running job may already
+    have read the marker, so a follow up job is scheduled with the next
+    free ID instead.
+
+    Args:
+        - patient_id (str) : Unique ID for the patient.
+        - updated_by (str) : The name of the user who reviewed the patient.
+
+    Returns:
+        - job (rq.job.Job) : The pending update job for this patient.
+    '''
+    marker = json.dumps({"updated_by": updated_by})
+    flask.current_app.redis.set(f"{RESULTS_DIRTY_KEY_PREFIX}{patient_id}", marker)
+
+    job_id = f"patient_results_{patient_id}"
+    follow_up = 0
+    while True:
+        job = flask.current_app.ops_queue.fetch_job(job_id)
+        status = None if job is None else job.get_status()
+        if status in (JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.DEFERRED):
+            logger.debug(f"Results update for patient {patient_id} is already pending.")
+            return job
+        if status != JobStatus.STARTED:
+            break
+
+        follow_up += 1
+        job_id = f"patient_results_{patient_id}_{follow_up}"
+
+    window = flask.current_app.config["RQ"]["results_update_window"]
+    return flask.current_app.ops_queue.enqueue_in(timedelta(seconds=window),
+                                                  update_dirty_patient_results,
+                                                  patient_id,
+                                                  job_id=job_id)
+
+@log_function_call
+def update_dirty_patient_results(patient_id):
+    '''
+    Applies the latest pending results update of a patient.
+    Run by the job scheduled in enqueue_patient_results_update.
+
+    Args:
+        - patient_id (str) : Unique ID for the patient.
+
+    Returns:
+        - is_updated (bool) : True if a pending update was applied.
+    '''
+    with flask.current_app.redis.pipeline() as pipe:
+        pipe.get(f"{RESULTS_DIRTY_KEY_PREFIX}{patient_id}")
+        pipe.delete(f"{RESULTS_DIRTY_KEY_PREFIX}{patient_id}")
+        marker, _ = pipe.execute()
+
+    if marker is None:
+        return False
+
+    marker = json.loads(marker)
+    # last_updated is the time at which the RESULTS entry is written (not the
+    # time of the request) so that incremental exports cannot miss the update.
+    db.record_patient_review(patient_id, datetime.now(), marker["updated_by"])
+    return True
+
+def load_adjudication_handler():
+    '''
+    Creates the AdjudicationHandler of the patient in the session from the
+    adjudication cache. The session only stores the patient ID and the
+    index of the annotation shown to the user.
+
+    Returns:
+        - adjudication_handler (AdjudicationHandler) : None if the state of the
+                                                        patient is no longer cached.
+    '''
+    patient_id = session['patient_id']
+    patient_data = adjudication_cache.load_patient_data(patient_id,
+                                                        session.get('current_index', 0))
+    if patient_data is None:
+        return None
+
+    adjudication_handler = AdjudicationHandler(patient_id)
+    adjudication_handler.load_from_patient_data(patient_id, patient_data)
+    return adjudication_handler
+
 @bp.route("/save_adjudications", methods=["GET", "POST"])
 @login_required
 @log_function_call
@@ -730,10 +792,22 @@ def save_adjudications():
             logger.error("No patient_id found in session and no backup found")
             return redirect(url_for("ops.adjudicate_records"))
 
+    # The lease may have expired while the user was idle and the
+    # patient may now be reviewed by another user.
+    if not db.claim_patient(session['patient_id'], current_user.username,
+                            flask.current_app.config["PATIENT_LOCK_LEASE"]):
+        logger.info(f"Lock on patient {session['patient_id']} was lost by {current_user.username}.")
+        flash(f"Patient {session['patient_id']} is currently being reviewed by another user. "
+              "Your changes were not saved.")
+        session.pop("patient_id", None)
+        session.pop("current_index", None)
+        session.modified = True
+        return redirect(url_for("ops.adjudicate_records"))
+
     logger.info(f"Saving adjudications for patient {session['patient_id']}")
-    adjudication_handler = AdjudicationHandler(session['patient_id'])
-    adjudication_handler.load_from_patient_data(session['patient_id'],
-                                                session['patient_data'])
+    adjudication_handler = load_adjudication_handler()
+    if adjudication_handler is None:
+        return redirect(url_for("ops.adjudicate_records"))
 
     current_annotation_id = adjudication_handler.get_curr_annotation_id()
     session['patient_comments'] = request.form['comment'].strip()
@@ -797,18 +871,16 @@ def save_adjudications():
         adjudication_handler.perform_shift(action)
         is_shift_performed = True
 
-    session["patient_data"] = adjudication_handler.get_patient_data()
+    patient_data = adjudication_handler.get_patient_data()
+    session["current_index"] = patient_data["current_index"]
+    if not is_shift_performed:
+        adjudication_cache.save_patient_state(patient_id, patient_data)
+        enqueue_next_patient_prefetch(adjudication_handler)
 
-    try:
-        patient_data_cloned = copy.deepcopy(session['patient_data'])
-        review_status_cloned = copy.deepcopy(session['reviewed_annotation_ids'])
-        patient_comments_cloned = copy.deepcopy(session['patient_comments'])
-        skip_after_event_cloned = copy.deepcopy(session['skip_after_event'])
-        backup_session_data(session['patient_id'], patient_data_cloned,
-                        review_status_cloned, patient_comments_cloned,
-                        skip_after_event_cloned)
-    except Exception as e:
-        logger.error(f"Failed to backup session data: {str(e)}")
+    # The snapshot is serialized when it is written, so the session is not copied
+    backup_session_data(session['patient_id'], session["current_index"],
+                        session['reviewed_annotation_ids'], session['patient_comments'],
+                        session['skip_after_event'])
 
     # We do not skip to the next patient if the current operation was just a shift.
     # This is done as users may want to view notes for a patient that has already been
@@ -824,8 +896,10 @@ def save_adjudications():
                                             session['reviewed_annotation_ids'],
                                             datetime.now())
 
+        adjudication_cache.delete_patient_data(patient_id)
+        adjudication_cache.delete_session_snapshot(current_user.username, patient_id)
         session.pop("patient_id")
-        session.pop("patient_data")
+        session.pop("current_index")
         session.pop("reviewed_annotation_ids")
 
     session.modified = True
@@ -849,13 +923,12 @@ def show_annotation():
 
     logger.info(f"Presenting annotation for patient {session['patient_id']}")
 
-    adjudication_handler = AdjudicationHandler(session['patient_id'])
-    adjudication_handler.load_from_patient_data(session['patient_id'],
-                                                session['patient_data'])
-    annotation_id = adjudication_handler.get_curr_annotation_id()
+    adjudication_handler = load_adjudication_handler()
+    if adjudication_handler is None:
+        return redirect(url_for("ops.adjudicate_records"))
     annotation = adjudication_handler.get_curr_annotation()
 
-    note = db.get_annotation_note(annotation_id)
+    note = note_cache.get_note(annotation["note_id"], annotation["patient_id"])
     if not note:
         flash("Annotation note not found.")
         return redirect(url_for("ops.adjudicate_records"))
@@ -867,14 +940,193 @@ def show_annotation():
     annotation_data = adjudication_handler.get_annotation_details(annotation,
                                                                   note, comments,
                                                                   annotations_for_note,
-                                                                  annotations_for_sentence)
+                                                                  annotations_for_sentence,
+                                                                  note_cache.CachedSentenceHighlighter())
 
     return render_template("ops/adjudicate_records.html",
                            name = current_user.username,
                            **annotation_data,
-                           project = session['project_name']
+                           project = session['project_name'],
+                           lock_lease = flask.current_app.config["PATIENT_LOCK_LEASE"]
                            )
 
+@bp.route("/renew_patient_lock", methods=["POST"])
+@login_required
+@log_function_call
+def renew_patient_lock():
+    """
+    Renews the lease on the lock of the patient in the session.
+    Called periodically by the adjudication page while the user is active.
+    """
+    patient_id = session.get("patient_id")
+    if patient_id is None:
+        return flask.jsonify({"locked": False}), 200
+
+    is_locked = db.claim_patient(patient_id, current_user.username,
+                                 flask.current_app.config["PATIENT_LOCK_LEASE"])
+    if not is_locked:
+        logger.info(f"Lock on patient {patient_id} was lost by {current_user.username}.")
+
+    return flask.jsonify({"locked": is_locked}), 200
+
+
+@log_function_call
+def prepare_patient_data(patient_id):
+    """
+    Loads the annotations of a patient and creates its adjudication handler.
+
+    Args:
+        patient_id (str) : ID for the patient to review.
+
+    Returns:
+        adjudication_handler (AdjudicationHandler) : The handler of the patient.
+        patient_data (dict) : The adjudication state of the patient.
+        annotations_with_duplicates (list) : The duplicate annotations that
+                                             are hidden from the user.
+        patient_comments (str) : The comments stored for the patient.
+    """
+    logger.info(f"Fetching annotations for patient {patient_id}.")
+
+    # Duplicates are found when the notes are annotated
+    raw_annotations = db.get_all_annotations_for_patient(patient_id, include_duplicates=False)
+    hide_duplicates = db.get_search_query("hide_duplicates")
+    stored_event_date = db.get_event_date(patient_id)
+    stored_annotation_id = db.get_event_annotation_id(patient_id)
+    patient_comments = db.get_patient_by_id(patient_id)["comments"]
+
+    logger.info(f"Creating adjudication handler for patient {patient_id}.")
+    adjudication_handler = AdjudicationHandler(patient_id)
+    patient_data, annotations_with_duplicates = adjudication_handler.init_patient_data(raw_annotations,
+                                           hide_duplicates, stored_event_date,
+                                           stored_annotation_id)
+
+    logger.info(f"Finished loading adjudication handler for patient {patient_id}.")
+    return adjudication_handler, patient_data, annotations_with_duplicates, patient_comments
+
+@log_function_call
+def prefetch_next_patient(username, lease_seconds):
+    """
+    Background job that reserves the next patient for a user and stores
+    its adjudication state in the cache, so that the user does not wait
+    for it to be loaded once the current patient is finished.
+    The patient is claimed with a short lease that is extended when the
+    user starts reviewing it, so it is released soon if it is never used.
+    If the user stopped reviewing while the job was running, the patient
+    is released straight away.
+
+    Args:
+        username (str) : The user reviewing patients.
+        lease_seconds (int) : Number of seconds for which the patient is reserved.
+
+    Returns:
+        patient_id (str) : The prefetched patient, None if no patient is left to review.
+    """
+    patient_id = db.claim_next_patient(username, lease_seconds)
+    if patient_id is None:
+        # The reservation is kept until it expires so that
+        # the remaining clicks do not try again.
+        return None
+
+    (adjudication_handler, patient_data,
+     annotations_with_duplicates, patient_comments) = prepare_patient_data(patient_id)
+    if adjudication_handler.get_patient_status() == PatientStatus.NO_ANNOTATIONS:
+        logger.info(f"Patient {patient_id} has no annotations and was not prefetched.")
+        enqueue_patient_results_update(patient_id, username)
+        db.set_patient_lock_status(patient_id, False)
+        adjudication_cache.cancel_prefetch(username)
+        return None
+
+    adjudication_cache.save_patient_data(patient_id, patient_data)
+    is_saved = adjudication_cache.save_prefetched_patient(username, {
+        "patient_id": patient_id,
+        "current_index": patient_data["current_index"],
+        "annotations_with_duplicates": annotations_with_duplicates,
+        "patient_comments": patient_comments
+    }, lease_seconds)
+    if not is_saved:
+        logger.info(f"Prefetch for {username} was cancelled, releasing patient {patient_id}.")
+        release_claimed_patient(patient_id, username)
+        return None
+
+    logger.info(f"Prefetched patient {patient_id} for {username}.")
+    return patient_id
+
+def enqueue_next_patient_prefetch(adjudication_handler):
+    """
+    Starts preparing the next patient once the current patient
+    only has a few annotations left to review.
+    """
+    prefetch_remaining = flask.current_app.config["PATIENT_PREFETCH_REMAINING"]
+    num_unreviewed = adjudication_handler.get_num_unreviewed()
+    if num_unreviewed == 0 or num_unreviewed > prefetch_remaining:
+        return
+
+    prefetch_lease = flask.current_app.config["PATIENT_PREFETCH_LEASE"]
+    if adjudication_cache.reserve_prefetch(current_user.username, prefetch_lease):
+        flask.current_app.ops_queue.enqueue(prefetch_next_patient,
+                                            current_user.username, prefetch_lease)
+
+def start_prefetched_patient(prefetched, lock_lease):
+    """
+    Starts the review of a patient prepared by prefetch_next_patient.
+    The short lease taken by the prefetch is extended to the full lock lease.
+
+    Returns:
+        patient_id (str) : The prefetched patient, None if it has
+                           been claimed by another user since.
+        response : A redirect to the first annotation, None if the cached
+                   state has expired and the patient must be loaded again.
+    """
+    patient_id = prefetched["patient_id"]
+    if not db.claim_patient(patient_id, current_user.username, lock_lease):
+        return None, None
+
+    if not adjudication_cache.has_patient_data(patient_id):
+        return patient_id, None
+
+    logger.info(f"Showing prefetched patient {patient_id}.")
+    db.mark_annotation_reviewed_batch(prefetched["annotations_with_duplicates"],
+                                      current_user.username)
+    session['project_name'] = db.get_info()['project']
+    session["patient_id"] = prefetched["patient_id"]
+    session['current_index'] = prefetched["current_index"]
+    session['reviewed_annotation_ids'] = []
+    session['patient_comments'] = prefetched["patient_comments"]
+    session['skip_after_event'] = db.get_search_query(query_key="skip_after_event")
+    session.modified = True
+    return patient_id, redirect(url_for("ops.show_annotation"))
+
+def get_patient_to_adjudicate(lock_lease):
+    """
+    Finds the patient to show when the adjudication page is opened :
+    the patient in the session, then the patient prefetched for the user,
+    then the next patient to review.
+
+    Returns:
+        patient_id (str) : The patient to review, None if no patient is left to review.
+        response : A redirect if the patient can be shown from the cache, None if
+                   its annotations must be loaded.
+    """
+    patient_id = session.get("patient_id")
+    if patient_id is not None:
+        if db.claim_patient(patient_id, current_user.username, lock_lease):
+            if adjudication_cache.has_patient_data(patient_id):
+                logger.info(f"Getting patient: {patient_id} from session")
+                return patient_id, redirect(url_for("ops.show_annotation"))
+
+            # The cached state has expired, the patient is loaded again
+            return patient_id, None
+
+        logger.info(f"Patient {patient_id} is locked.")
+        logger.info("Retrieving next patient.")
+
+    prefetched = adjudication_cache.pop_prefetched_patient(current_user.username)
+    if prefetched is not None:
+        patient_id, response = start_prefetched_patient(prefetched, lock_lease)
+        if patient_id is not None:
+            return patient_id, response
+
+    return db.claim_next_patient(current_user.username, lock_lease), None
 
 @bp.route("/adjudicate_records", methods=["GET", "POST"])
 @login_required
@@ -908,32 +1160,26 @@ def adjudicate_records():
     logger.info("Getting patient to adjudicate.")
 
     patient_id = None
+    lock_lease = flask.current_app.config["PATIENT_LOCK_LEASE"]
     if request.method == "GET":
-        if session.get("patient_id") is not None:
-            if db.get_patient_lock_status(session.get("patient_id")) is False:
-                logger.info(f"Getting patient: {session.get('patient_id')} from session")
-                return redirect(url_for("ops.show_annotation"))
-
-            logger.info(f"Patient {session.get('patient_id')} is locked.")
-            logger.info("Retrieving next patient.")
-
-        patient_id = db.get_patients_to_annotate()
+        patient_id, response = get_patient_to_adjudicate(lock_lease)
+        if response is not None:
+            return response
     else:
+        # The user chose the patient to review, the prefetched patient is not shown
+        release_prefetched_patient(current_user.username)
         if session.get("patient_id") is not None:
             if session.get('patient_comments') is not None:
                 db.add_comment(session["patient_id"], session['patient_comments'].strip())
             if session.get('reviewed_annotation_ids') is not None:
                 db.mark_annotation_reviewed_batch(session['reviewed_annotation_ids'],
                                                     current_user.username)
-            flask.current_app.ops_queue.enqueue(
-                    db.upsert_patient_records,
-                    session.get("patient_id"),
-                    datetime.now(),
-                    current_user.username
-                    )
+            enqueue_patient_results_update(session.get("patient_id"),
+                                           current_user.username)
             db.set_patient_lock_status(session.get("patient_id"), False)
+            adjudication_cache.delete_patient_data(session.get("patient_id"))
             session.pop("patient_id", None)
-            session.pop("patient_data", None)
+            session.pop("current_index", None)
             session.modified = True
 
         search_patient = str(request.form.get("patient_id")).strip()
@@ -942,12 +1188,11 @@ def adjudicate_records():
             patient = db.get_patient_by_id(search_patient)
             if patient is None:
                 patient_id = None
+            elif db.claim_patient(patient["patient_id"], current_user.username, lock_lease):
+                patient_id = patient["patient_id"]
             else:
-                is_patient_locked = db.get_patient_lock_status(search_patient)
-                if is_patient_locked is False:
-                    patient_id = patient["patient_id"]
-                else:
-                    patient_id = None
+                is_patient_locked = True
+                patient_id = None
 
         if patient_id is None:
             # if the search return no patient, get the next patient
@@ -955,47 +1200,31 @@ def adjudicate_records():
                 flash(f"Patient {search_patient} is currently being reviewed by another user. Showing next patient")
             else:
                 flash(f"Patient {search_patient} does not exist. Showing next patient")
-            patient_id = db.get_patients_to_annotate()
+            patient_id = db.claim_next_patient(current_user.username, lock_lease)
 
     if patient_id is None:
         return render_template("ops/annotations_complete.html", **db.get_info())
 
-    logger.info(f"Fetching annotations for patient {patient_id}.")
-
-    raw_annotations = db.get_all_annotations_for_patient(patient_id)
-    hide_duplicates = db.get_search_query("hide_duplicates")
-    stored_event_date = db.get_event_date(patient_id)
-    stored_annotation_id = db.get_event_annotation_id(patient_id)
-    patient_comments = db.get_patient_by_id(patient_id)["comments"]
-
-    logger.info(f"Creating adjudication handler for patient {patient_id}.")
-    adjudication_handler = AdjudicationHandler(patient_id)
-    patient_data, annotations_with_duplicates = adjudication_handler.init_patient_data(raw_annotations,
-                                           hide_duplicates, stored_event_date,
-                                           stored_annotation_id)
+    (adjudication_handler, patient_data,
+     annotations_with_duplicates, patient_comments) = prepare_patient_data(patient_id)
 
     db.mark_annotation_reviewed_batch(annotations_with_duplicates,
                                       current_user.username)
 
-    logger.info(f"Finished loading adjudication handler for patient {patient_id}.")
-
-    if len(patient_data["annotation_ids"]) > 0:
-        # Only lock the patient for annotation if
-        # there are annotations that exist
-        db.set_patient_lock_status(patient_id, True)
+    if len(patient_data["annotation_ids"]) == 0:
+        # The patient is claimed before its annotations are loaded,
+        # it only stays locked if there are annotations to show.
+        db.set_patient_lock_status(patient_id, False)
 
     patient_status = adjudication_handler.get_patient_status()
     session['project_name'] = db.get_info()['project']
+    if patient_status != PatientStatus.NO_ANNOTATIONS:
+        adjudication_cache.save_patient_data(patient_id, patient_data)
 
     if patient_status == PatientStatus.NO_ANNOTATIONS:
         logger.info(f"Patient {patient_id} has no annotations. Showing next patient")
         flash(f"Patient {patient_id} has no annotations. Showing next patient")
-        flask.current_app.ops_queue.enqueue(
-                    db.upsert_patient_records,
-                    patient_id,
-                    datetime.now(),
-                    current_user.username
-                    )
+        enqueue_patient_results_update(patient_id, current_user.username)
         db.set_patient_lock_status(patient_id, False)
         return redirect(url_for("ops.adjudicate_records"))
 
@@ -1003,7 +1232,7 @@ def adjudicate_records():
         flash(f"Patient {patient_id} has been reviewed. Showing annotation where event date was marked. ")
         logger.info(f"Showing annotations for patient {patient_id}.")
         session["patient_id"] = patient_id
-        session['patient_data'] = patient_data
+        session['current_index'] = patient_data['current_index']
         session['reviewed_annotation_ids'] = []
         session['patient_comments'] = patient_comments
         session['skip_after_event'] = db.get_search_query(query_key="skip_after_event")
@@ -1011,7 +1240,7 @@ def adjudicate_records():
     elif patient_status == PatientStatus.REVIEWED_NO_EVENT:
         flash(f"Patient {patient_id} has no annotations left to review. Showing all annotations.")
         session["patient_id"] = patient_id
-        session['patient_data'] = patient_data
+        session['current_index'] = patient_data['current_index']
         session['reviewed_annotation_ids'] = []
         session['patient_comments'] = patient_comments
         session['skip_after_event'] = db.get_search_query(query_key="skip_after_event")
@@ -1019,7 +1248,7 @@ def adjudicate_records():
     else:
         logger.info(f"Showing annotations for patient {patient_id}.")
         session["patient_id"] = patient_id
-        session['patient_data'] = patient_data
+        session['current_index'] = patient_data['current_index']
         session['reviewed_annotation_ids'] = []
         session['patient_comments'] = patient_comments
         session['skip_after_event'] = db.get_search_query(query_key="skip_after_event")
@@ -1027,6 +1256,22 @@ def adjudicate_records():
     session.modified = True
     return redirect(url_for("ops.show_annotation"))
 
+def release_claimed_patient(patient_id, username):
+    """
+    Releases a patient reserved for a user but never shown to them.
+    """
+    if db.release_patient(patient_id, username):
+        adjudication_cache.delete_patient_data(patient_id)
+
+def release_prefetched_patient(username):
+    """
+    Releases the patient prepared for a user who stopped reviewing.
+    A prefetch that is still running releases its patient when it finishes.
+    """
+    prefetched = adjudication_cache.discard_prefetch(username)
+    if prefetched is not None:
+        release_claimed_patient(prefetched["patient_id"], username)
+
 @bp.route("/unlock_patient", methods=["GET", "POST"])
 @log_function_call
 def unlock_current_patient():
@@ -1042,13 +1287,11 @@ def unlock_current_patient():
         if session.get('reviewed_annotation_ids') is not None:
                 db.mark_annotation_reviewed_batch(session['reviewed_annotation_ids'],
                                                     current_user.username)
-        flask.current_app.ops_queue.enqueue(
-                    db.upsert_patient_records,
-                    patient_id,
-                    datetime.now(),
-                    current_user.username
-                    )
+        enqueue_patient_results_update(patient_id, current_user.username)
         db.set_patient_lock_status(patient_id, False)
+        adjudication_cache.delete_patient_data(patient_id)
+        adjudication_cache.delete_session_snapshot(current_user.username, patient_id)
+        release_prefetched_patient(current_user.username)
         session["patient_id"] = None
         message = f"Unlocking patient # {patient_id}."
 
@@ -1060,7 +1303,7 @@ def unlock_current_patient():
         return jsonify({"message": message}), 200
 
 @log_function_call
-def get_download_filename(is_full_download=False):
+def get_download_filename(is_full_download=False, export_format="csv", is_incremental=False):
     '''
     Returns the filename for a new download task.
 
@@ -1068,19 +1311,25 @@ def get_download_filename(is_full_download=False):
         - is_full_download (bool) : True if all of the results 
                                     (including the key sentences)
                                     are to be downloaded.
+        - export_format (str) : One of exporter.EXPORT_FORMATS,
+                                sets the extension of the file.
+        - is_incremental (bool) : True if only the changes since the
+                                  last export are to be downloaded.
 
     Returns :
         - filename (string) : A string in the format
-                              {project_name}_{timestamp}_{downloadtype}.csv
+                              annotations_{downloadtype}_{project_name}_{timestamp}.{extension}
     '''
     project_name = db.get_proj_name()
     timestamp = datetime.now()
     timestamp = timestamp.strftime("%Y-%m-%d_%H_%M_%S")
+    extension = exporter.EXPORT_FORMATS[export_format]["extension"]
 
-    if is_full_download:
-        return f"annotations_full_{project_name}_{timestamp}.csv"
+    download_type = "full" if is_full_download else "compact"
+    if is_incremental:
+        download_type = f"{download_type}_changes"
 
-    return f"annotations_compact_{project_name}_{timestamp}.csv"
+    return f"annotations_{download_type}_{project_name}_{timestamp}.{extension}"
 
 @bp.route('/download_page')
 @bp.route('/download_page/<job_id>')
@@ -1091,12 +1340,15 @@ def download_page(job_id=None):
     Loads the page where an admin can download the results
     of annotations made for that project.
     """
-    files = [(obj.object_name.rsplit("/", 1)[-1],
+    # Annotation detail exports are folders of parquet parts,
+    # each part is listed as folder/part-xxxxx.parquet
+    files = [(obj.object_name.split("/", 1)[-1],
               obj.size,
               obj.last_modified.strftime("%Y-%m-%d %H:%M:%S")
               ) for obj in minio.list_objects(
                    g.bucket_name,
-                   prefix="annotated_files/")]
+                   prefix="annotated_files/",
+                   recursive=True)]
 
     if job_id is not None:
         return flask.jsonify({"files": files}), 202
@@ -1129,10 +1381,12 @@ def download_file(filename='annotations.csv'):
     file = minio.get_object(g.bucket_name, f"annotated_files/{filename}")
     logger.info(f"Downloaded annotations from s3: {filename}")
 
+    export_format = exporter.get_export_format(filename)
     return flask.Response(
         file.stream(32*1024),
-        mimetype='text/csv',
-        headers={"Content-Disposition": f"attachment;filename=cedars_{filename}"}
+        mimetype=exporter.EXPORT_FORMATS[export_format]["content_type"],
+        headers={"Content-Disposition":
+                 f"attachment;filename=cedars_{filename.replace('/', '_')}"}
     )
 
 
@@ -1141,12 +1395,19 @@ def download_file(filename='annotations.csv'):
 @log_function_call
 def create_download():
     """
-    Create a download task for annotations
+    Create a download task for annotations.
+    The file format is set by the format query parameter (csv, parquet or ipc)
+    and only the changes since the last export are downloaded if incremental is true.
     """
 
-    download_filename = get_download_filename()
+    export_format = request.args.get("format", "csv")
+    if export_format not in exporter.EXPORT_FORMATS:
+        return flask.jsonify({'error': f"Unsupported format {export_format}"}), 400
+    is_incremental = request.args.get("incremental", "false").lower() == "true"
+
+    download_filename = get_download_filename(False, export_format, is_incremental)
     job = flask.current_app.ops_queue.enqueue(
-        db.download_annotations, download_filename,
+        db.download_annotations, download_filename, False, export_format, is_incremental
     )
     return flask.jsonify({'job_id': job.get_id()}), 202
 
@@ -1156,12 +1417,37 @@ def create_download():
 @log_function_call
 def create_download_full():
     """
-    Create a download task for annotations
+    Create a download task for annotations including the key sentences.
+    The file format is set by the format query parameter (csv, parquet or ipc)
+    and only the changes since the last export are downloaded if incremental is true.
     """
 
-    download_filename = get_download_filename(True)
+    export_format = request.args.get("format", "csv")
+    if export_format not in exporter.EXPORT_FORMATS:
+        return flask.jsonify({'error': f"Unsupported format {export_format}"}), 400
+    is_incremental = request.args.get("incremental", "false").lower() == "true"
+
+    download_filename = get_download_filename(True, export_format, is_incremental)
+    job = flask.current_app.ops_queue.enqueue(
+        db.download_annotations, download_filename, True, export_format, is_incremental
+    )
+
+    return flask.jsonify({'job_id': job.get_id()}), 202
+
+@bp.route('/create_annotation_export_task', methods=["GET"])
+@auth.admin_required
+@log_function_call
+def create_annotation_export():
+    """
+    Create a task to export every annotation, with the PINES score of its note,
+    as a partitioned parquet dataset.
+    """
+
+    project_name = db.get_proj_name()
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
+    dirname = f"annotations_detail_{project_name}_{timestamp}"
     job = flask.current_app.ops_queue.enqueue(
-        db.download_annotations, download_filename, True
+        db.export_annotation_details, dirname
     )
 
     return flask.jsonify({'job_id': job.get_id()}), 202
@@ -20,6 +20,15 @@ class Base:  # pylint: disable=too-few-public-methods
     """
     SECRET_KEY = config['SECRET_KEY']
     PERMANENT_SESSION_LIFETIME = timedelta(minutes=60)
+    # Seconds for which a patient stays locked by the user reviewing it
+    PATIENT_LOCK_LEASE = int(config.get("PATIENT_LOCK_LEASE", 1800))
+    # The next patient is prepared in the background once this many
+    # annotations are left to review, 0 disables prefetching
+    PATIENT_PREFETCH_REMAINING = int(config.get("PATIENT_PREFETCH_REMAINING", 3))
+    # Seconds for which a prefetched patient is held until the user starts reviewing it
+    PATIENT_PREFETCH_LEASE = int(config.get("PATIENT_PREFETCH_LEASE", 300))
+    # MongoDB commands slower than this are shown on the slow queries page
+    SLOW_QUERY_MS = int(config.get("SLOW_QUERY_MS", 100))
 
     MONGO_URI = MONGO_URI = (
     f'mongodb://{config["DB_USER"]}:{config["DB_PWD"]}'
@@ -40,7 +49,9 @@ class Base:  # pylint: disable=too-few-public-methods
         "task_queue_name": "cedars",
         "ops_queue_name": "ops",
         "job_timeout": 3600,
-        "operation_timeout": 7200
+        "operation_timeout": 7200,
+        # Seconds during which RESULTS updates for the same patient are coalesced
+        "results_update_window": int(config.get("RESULTS_UPDATE_WINDOW", 5))
     }
 
 class Local(Base):  # pylint: disable=too-few-public-methods
@@ -42,10 +42,10 @@ def db(cedars_app):
     notes_to_insert = [prepare_note(row.to_dict()) for _, row in test_data.iterrows()]
     db.bulk_insert_notes(notes_to_insert)
 
+    notes_summary_count = db.update_notes_summary()
+
     patient_ids = set(test_data['patient_id'])
     db.bulk_upsert_patients(patient_ids)
-
-    notes_summary_count = db.update_notes_summary()
     yield db
 
 
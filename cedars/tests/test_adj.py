@@ -1,3 +1,5 @@
+from array import array
+from datetime import datetime
 from unittest.mock import patch
 import pytest
 from app.adjudication_handler import SentenceHighlighter
@@ -12,6 +14,52 @@ def test_highlighted_text(db):
     assert "<br>" in text_highlighter.get_highlighted_text(note,
                                                            annotations_for_note)
 
+
+def test_highlighted_overlapping_tokens():
+    text_highlighter = SentenceHighlighter()
+    note = {"text": "A <b> tumor & a mass.\nNo cancer."}
+    annotations = [{"note_start_index": 6, "note_end_index": 11},
+                   {"note_start_index": 8, "note_end_index": 13},
+                   {"note_start_index": 25, "note_end_index": 31}]
+    assert text_highlighter.get_highlighted_text(note, annotations) == \
+        "A &lt;b&gt; <b><mark>tumor &amp;</mark></b> a mass.<br>No <b><mark>cancer</mark></b>."
+
+
+@pytest.mark.parametrize("sentence_start", [22, 0, None])
+def test_highlighted_sentence(sentence_start):
+    text_highlighter = SentenceHighlighter()
+    note = {"text": "A <b> tumor & a mass.\nNo Cancer seen."}
+    # Stored offsets that do not match the sentence are not used
+    annotation = {"sentence": "no cancer seen.", "sentence_start": sentence_start,
+                  "note_start_index": 25, "note_end_index": 31}
+    assert text_highlighter.get_highlighted_sentence(annotation, note, [annotation]) == \
+        "No <b><mark>Cancer</mark></b> seen."
+
+
+def test_highlighter_long_note():
+    # Every annotation of a long note is highlighted in a single pass
+    sentence = "The patient has a tumor & <no> other findings."
+    text = "\n".join([sentence] * 20000)
+    annotations = []
+    for sentence_number in range(20000):
+        sentence_start = sentence_number * (len(sentence) + 1)
+        annotations.append({"sentence": sentence.lower(), "sentence_start": sentence_start,
+                            "note_start_index": sentence_start + 18,
+                            "note_end_index": sentence_start + 23})
+    text_highlighter = SentenceHighlighter()
+    note = {"text": text}
+
+    # The undecorated methods are called so that each call is not logged
+    highlighted_text = SentenceHighlighter.get_highlighted_text.__wrapped__(
+        text_highlighter, note, annotations)
+    for annotation in annotations[-100:]:
+        highlighted_sentence = SentenceHighlighter.get_highlighted_sentence.__wrapped__(
+            text_highlighter, annotation, note, [annotation])
+        assert highlighted_sentence.count("<b><mark>tumor</mark></b>") == 1
+
+    assert highlighted_text.count("<b><mark>tumor</mark></b>") == 20000
+    assert highlighted_text.count("&lt;no&gt;") == 20000
+
 @pytest.mark.parametrize(
     "annotations, expected_indices",
     [
@@ -91,10 +139,12 @@ def test_filter_duplicates_by_note(annotations, expected_indices):
                 'event_date': None,
                 'event_annotation_id': None,
                 'annotation_ids': ["1", "3"],
-                'review_statuses': [ReviewStatus.REVIEWED, ReviewStatus.UNREVIEWED],
+                'review_statuses': array('b', [ReviewStatus.REVIEWED.value, ReviewStatus.UNREVIEWED.value]),
                 'current_index': 1,  # First unreviewed annotation
                 'annotations': [{'_id': '1', 'note_id': 'N1', 'sentence': 'Test sentence 1', 'reviewed': 1},
                                 {'_id': '3', 'note_id': 'N2', 'sentence': 'Test sentence 2', 'reviewed': 0}],
+                'note_index': {},
+                'sentence_index': {},
             },
             ["2"],
         ),
@@ -111,10 +161,12 @@ def test_filter_duplicates_by_note(annotations, expected_indices):
                 'event_date': "2024-12-01",
                 'event_annotation_id': "2",
                 'annotation_ids': ["1", "2"],
-                'review_statuses': [ReviewStatus.REVIEWED, ReviewStatus.REVIEWED],
+                'review_statuses': array('b', [ReviewStatus.REVIEWED.value, ReviewStatus.REVIEWED.value]),
                 'current_index': 1,  # Stored annotation ID index
                 'annotations': [{'_id': '1', 'note_id': 'N1', 'sentence': 'Test sentence 1', 'reviewed': 1},
                                 {'_id': '2', 'note_id': 'N2', 'sentence': 'Test sentence 2', 'reviewed': 1}],
+                'note_index': {},
+                'sentence_index': {},
             },
             [],
         ),
@@ -131,10 +183,12 @@ def test_filter_duplicates_by_note(annotations, expected_indices):
                 'event_date': None,
                 'event_annotation_id': None,
                 'annotation_ids': ["1", "2"],
-                'review_statuses': [ReviewStatus.REVIEWED, ReviewStatus.REVIEWED],
+                'review_statuses': array('b', [ReviewStatus.REVIEWED.value, ReviewStatus.REVIEWED.value]),
                 'current_index': 0,  # Default to index 0
                 'annotations': [{'_id': '1', 'note_id': 'N1', 'sentence': 'Test sentence 1', 'reviewed': 1},
                                 {'_id': '2', 'note_id': 'N2', 'sentence': 'Test sentence 2', 'reviewed': 1}],
+                'note_index': {},
+                'sentence_index': {},
             },
             [],
         ),
@@ -223,4 +277,48 @@ def test_load_from_patient_data(
     handler = AdjudicationHandler('input_patient_id')
     handler.load_from_patient_data(input_patient_id, input_patient_data)
     assert handler.patient_id == expected_patient_id
-    assert handler.get_patient_data() == expected_patient_data
\ No newline at end of file
+    assert handler.get_patient_data() == expected_patient_data
+
+def test_annotation_indexes():
+    raw_annotations = [
+        {"_id": "1", "note_id": "N1", "sentence": "Second sentence", "reviewed": 0,
+         "isNegated": False, "text_date": datetime(2020, 1, 1), "sentence_number": 2,
+         "note_start_index": 20},
+        {"_id": "2", "note_id": "N2", "sentence": "Other note", "reviewed": 0,
+         "isNegated": False, "text_date": datetime(2020, 1, 2), "sentence_number": 1,
+         "note_start_index": 0},
+        {"_id": "3", "note_id": "N1", "sentence": "First sentence", "reviewed": 0,
+         "isNegated": False, "text_date": datetime(2020, 1, 1), "sentence_number": 1,
+         "note_start_index": 5},
+        {"_id": "4", "note_id": "N1", "sentence": "Second sentence again", "reviewed": 0,
+         "isNegated": False, "text_date": datetime(2020, 1, 1), "sentence_number": 2,
+         "note_start_index": 10},
+        {"_id": "5", "note_id": "N1", "sentence": "Negated sentence", "reviewed": 0,
+         "isNegated": True, "text_date": datetime(2020, 1, 1), "sentence_number": 3,
+         "note_start_index": 30},
+    ]
+    handler = AdjudicationHandler("1111111111")
+    patient_data, _ = handler.init_patient_data(raw_annotations, False, None, None)
+    assert patient_data["note_index"] == {"N1": [2, 0, 3], "N2": [1]}
+    assert patient_data["sentence_index"] == {"N1:2": [3, 0], "N2:1": [1], "N1:1": [2]}
+
+    note_ids = [annotation["_id"] for annotation in handler.get_all_annotations_for_curr_note()]
+    assert note_ids == ["3", "1", "4"]
+    sentence_ids = [annotation["_id"] for annotation in
+                    handler.get_all_annotations_for_curr_sentence()]
+    assert sentence_ids == ["4", "1"]
+
+
+@pytest.mark.parametrize("hide_duplicates, expected_kept", [(True, 100), (False, 1000)])
+def test_filter_annotations_many_duplicates(hide_duplicates, expected_kept):
+    annotations = [{"_id": i, "note_id": i // 1000, "sentence": f"Sentence {i % 100}.",
+                    "reviewed": 0} for i in range(10000)]
+    strategy = AnnotationFilterStrategy()
+
+    # The undecorated method is called so that the annotations are not logged
+    filtered_results, duplicates = AnnotationFilterStrategy.filter_annotations.__wrapped__(
+        strategy, annotations, hide_duplicates)
+
+    assert len(filtered_results["annotations"]) == expected_kept
+    assert len(duplicates) == 10000 - expected_kept
+    assert filtered_results["annotation_ids"][:2] == ["0", "1"]
@@ -0,0 +1,105 @@
+'''
+Automated tests for adjudication_cache.py
+'''
+from array import array
+from datetime import date, datetime
+from bson import ObjectId
+from app import adjudication_cache
+from app.cedars_enums import ReviewStatus
+
+
+def test_adjudication_cache(cedars_app):
+    annotations = [{"_id": ObjectId(), "note_id": f"note_{i}", "isNegated": False,
+                    "text_date": datetime(2020, 1, i + 1), "sentence_number": i,
+                    "note_start_index": 0, "note_end_index": 4, "sentence": f"test {i}"}
+                   for i in range(3)]
+    patient_data = {
+        'event_date' : None,
+        'event_annotation_id' : None,
+        'annotation_ids' : [str(annotation["_id"]) for annotation in annotations],
+        'review_statuses' : array('b', [ReviewStatus.REVIEWED.value,
+                                        ReviewStatus.UNREVIEWED.value,
+                                        ReviewStatus.UNREVIEWED.value]),
+        'current_index' : 1,
+        'annotations' : annotations,
+        'note_index' : {"note_0": [0], "note_1": [1], "note_2": [2]},
+        'sentence_index' : {"note_0:0": [0], "note_1:1": [1], "note_2:2": [2]}
+    }
+    adjudication_cache.save_patient_data("cache_patient", patient_data)
+    assert adjudication_cache.has_patient_data("cache_patient")
+
+    cached = adjudication_cache.load_patient_data("cache_patient", 2)
+    assert cached["current_index"] == 2
+    assert cached["annotation_ids"] == patient_data["annotation_ids"]
+    assert cached["review_statuses"] == patient_data["review_statuses"]
+    assert len(cached["annotations"]) == 3
+    assert cached["annotations"][2]["sentence"] == "test 2"
+    assert cached["annotations"][2]["text_date"] == datetime(2020, 1, 3)
+    assert [annotation["note_id"] for annotation in cached["annotations"]] == \
+        ["note_0", "note_1", "note_2"]
+    assert cached["note_index"]["note_1"] == [1]
+    assert cached["sentence_index"].get("note_2:2") == [2]
+    assert cached["sentence_index"].get("note_2:1", []) == []
+
+    cached["review_statuses"][1] = ReviewStatus.REVIEWED.value
+    cached["event_date"] = datetime(2020, 1, 2)
+    cached["event_annotation_id"] = cached["annotation_ids"][1]
+    adjudication_cache.save_patient_state("cache_patient", cached)
+
+    cached = adjudication_cache.load_patient_data("cache_patient", 0)
+    assert cached["review_statuses"][1] == ReviewStatus.REVIEWED.value
+    assert cached["event_date"] == date(2020, 1, 2)
+    assert cached["event_annotation_id"] == patient_data["annotation_ids"][1]
+
+    adjudication_cache.delete_patient_data("cache_patient")
+    assert adjudication_cache.load_patient_data("cache_patient", 0) is None
+
+
+def test_session_snapshot(cedars_app):
+    assert adjudication_cache.load_session_snapshot("snapshot_user") is None
+
+    snapshot = {"patient_id": "patient_1", "current_index": 2,
+                "reviewed_annotation_ids": ["a", "b"], "patient_comments": "",
+                "skip_after_event": True}
+    adjudication_cache.save_session_snapshot("snapshot_user", "patient_1", snapshot)
+    adjudication_cache.save_session_snapshot("other_user", "patient_2",
+                                             {**snapshot, "patient_id": "patient_2"})
+    assert adjudication_cache.load_session_snapshot("snapshot_user") == snapshot
+    assert adjudication_cache.load_session_snapshot("other_user")["patient_id"] == "patient_2"
+
+    adjudication_cache.delete_session_snapshot("snapshot_user", "patient_1")
+    assert adjudication_cache.load_session_snapshot("snapshot_user") is None
+    adjudication_cache.delete_session_snapshot("other_user", "patient_2")
+
+
+def test_prefetched_patient(cedars_app):
+    assert adjudication_cache.reserve_prefetch("prefetch_user", 60)
+    # Only one prefetch is started at a time
+    assert not adjudication_cache.reserve_prefetch("prefetch_user", 60)
+    assert adjudication_cache.pop_prefetched_patient("prefetch_user") is None
+
+    prefetched = {"patient_id": "patient_1", "current_index": 0,
+                  "annotations_with_duplicates": [], "patient_comments": ""}
+    assert adjudication_cache.save_prefetched_patient("prefetch_user", prefetched, 60)
+    assert adjudication_cache.pop_prefetched_patient("prefetch_user") == prefetched
+    assert adjudication_cache.pop_prefetched_patient("prefetch_user") is None
+
+    assert adjudication_cache.reserve_prefetch("prefetch_user", 60)
+    adjudication_cache.cancel_prefetch("prefetch_user")
+    assert adjudication_cache.reserve_prefetch("prefetch_user", 60)
+    adjudication_cache.cancel_prefetch("prefetch_user")
+
+
+def test_discard_prefetch(cedars_app):
+    prefetched = {"patient_id": "patient_1", "current_index": 0,
+                  "annotations_with_duplicates": [], "patient_comments": ""}
+    # A prefetch finishing after the user stopped reviewing is not stored
+    assert adjudication_cache.reserve_prefetch("discard_user", 60)
+    assert adjudication_cache.discard_prefetch("discard_user") is None
+    assert not adjudication_cache.save_prefetched_patient("discard_user", prefetched, 60)
+    assert adjudication_cache.pop_prefetched_patient("discard_user") is None
+
+    assert adjudication_cache.reserve_prefetch("discard_user", 60)
+    assert adjudication_cache.save_prefetched_patient("discard_user", prefetched, 60)
+    assert adjudication_cache.discard_prefetch("discard_user") == prefetched
+    assert adjudication_cache.pop_prefetched_patient("discard_user") is None
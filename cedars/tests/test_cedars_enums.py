@@ -0,0 +1,39 @@
+'''
+Automated tests for cedars_enums.py
+'''
+from prometheus_client import REGISTRY
+from app.cedars_enums import log_function_call, set_trace_sample_rate
+
+
+class ReprCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __repr__(self):
+        self.count += 1
+        return "ReprCounter()"
+
+
+@log_function_call
+def add(first, second):
+    return first + second
+
+
+def test_log_function_call():
+    labels = {"function": f"{__name__}.add"}
+    calls = REGISTRY.get_sample_value("cedars_function_duration_seconds_count", labels) or 0
+
+    argument = ReprCounter()
+    assert add(1, 2) == 3
+    assert add([argument], []) == [argument]
+    # Arguments are not formatted unless calls are traced
+    assert argument.count == 0
+    assert REGISTRY.get_sample_value("cedars_function_duration_seconds_count",
+                                     labels) == calls + 2
+
+    set_trace_sample_rate(1)
+    try:
+        add([argument], [])
+    finally:
+        set_trace_sample_rate(0)
+    assert argument.count == 1
@@ -2,8 +2,12 @@
 Automated tests for db.py
 '''
 
-from datetime import datetime
-from unittest.mock import patch
+import io
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+from app.cedars_enums import ReviewStatus
+import polars as pl
 import pytest
 
 @pytest.mark.parametrize("expected_result, patient_id", [
@@ -155,6 +159,101 @@ def test_get_all_patient_ids(db):
     assert len(db.get_all_patient_ids()) == 5
 
 
+def test_bulk_upsert_patients_results(db):
+    assert db.get_total_counts("RESULTS") == 5
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": "1111111111"})
+    assert results["total_notes"] == 12
+    assert results["first_note_date"] == datetime(2009, 12, 25, 0, 0)
+    assert results["index_no"] == db.get_patient_by_id("1111111111")["index_no"]
+
+    # Existing results are not overwritten on a second upload
+    db.bulk_upsert_patients(["1111111111"])
+    assert db.get_total_counts("RESULTS") == 5
+    assert db.get_total_counts("PATIENTS") == 5
+
+
+def test_bulk_upsert_patients_duplicates(db):
+    # Existing and repeated patient IDs do not inflate the index_no
+    db.bulk_upsert_patients(["1111111111", "6666666666", "6666666666", "7777777777"])
+    assert db.get_total_counts("PATIENTS") == 7
+    assert db.get_patient_by_id("6666666666")["index_no"] == 5
+    assert db.get_patient_by_id("7777777777")["index_no"] == 6
+
+    db.mongo.db["PATIENTS"].delete_many({"patient_id": {"$in": ["6666666666", "7777777777"]}})
+
+
+def test_update_patient_results_missing(db):
+    patient_id = "2222222222"
+    expected = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id}, {"_id": 0})
+    results_count = db.get_total_counts("RESULTS")
+    db.mongo.db["RESULTS"].delete_one({"patient_id": patient_id})
+
+    # Only the patients without results are created
+    with patch.object(db, "rebuild_patient_results",
+                      wraps=db.rebuild_patient_results) as rebuild_patient_results:
+        db.update_patient_results()
+        rebuild_patient_results.assert_called_once_with([patient_id])
+
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id}, {"_id": 0})
+    assert db.get_total_counts("RESULTS") == results_count
+    assert results["total_notes"] == expected["total_notes"]
+    assert results["index_no"] == expected["index_no"]
+
+
+def test_rebuild_patient_results(db):
+    patient_id = "1111111111"
+    annotations = [{"patient_id": patient_id, "note_id": "REBUILD0000000001",
+                    "text_date": datetime(2010, 1, 1), "sentence_number": number,
+                    "sentence": sentence, "isNegated": False, "reviewed": reviewed}
+                   for number, sentence, reviewed in [[1, "first  match\nsplit", 0],
+                                                      [2, "second match", 1],
+                                                      [3, "skipped match", 2]]]
+    db.mongo.db["ANNOTATIONS"].insert_many(annotations)
+    event_annotation_id = str(annotations[1]["_id"])
+    db.mongo.db["PATIENTS"].update_one({"patient_id": patient_id},
+                                       {"$set": {"event_date": datetime(2010, 1, 1),
+                                                 "event_annotation_id": event_annotation_id,
+                                                 "comments": "rebuild"}})
+
+    # The set based rebuild matches the per patient computation
+    db.upsert_patient_records(patient_id)
+    expected = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id}, {"_id": 0})
+    db.rebuild_patient_results()
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id}, {"_id": 0})
+    assert results["last_updated"] is not None
+    expected.pop("last_updated")
+    results.pop("last_updated")
+    assert results == expected
+    assert "second match" in results["event_information"]
+    assert results["total_sentences"] == 2
+    assert db.format_sentences(results["sentences"]) == (
+        "REBUILD0000000001:2010-01-01:second match\n"
+        "REBUILD0000000001:2010-01-01:first match split")
+
+    db.mongo.db["PINES"].insert_many([
+        {"patient_id": patient_id, "text_id": "REBUILD0000000001",
+         "text_date": datetime(2010, 1, 1), "predicted_score": 0.25},
+        {"patient_id": patient_id, "text_id": "REBUILD0000000002",
+         "text_date": datetime(2010, 1, 2), "predicted_score": 0.75}])
+    db.rebuild_patient_results([patient_id])
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})
+    assert results["max_score"] == 0.75
+    assert results["max_score_note_id"] == "REBUILD0000000002"
+    assert results["max_score_note_date"] == datetime(2010, 1, 2)
+    assert len(results["predicted_notes"]) == 2
+    assert db.format_predicted_notes(results["predicted_notes"]) == (
+        "REBUILD0000000001:2010-01-01:0.25\n"
+        "REBUILD0000000002:2010-01-02:0.75")
+
+    db.mongo.db["PINES"].delete_many({"patient_id": patient_id})
+    db.mongo.db["ANNOTATIONS"].delete_many({"note_id": "REBUILD0000000001"})
+    db.mongo.db["PATIENTS"].update_one({"patient_id": patient_id},
+                                       {"$set": {"event_date": None,
+                                                 "event_annotation_id": None,
+                                                 "comments": ""}})
+    db.rebuild_patient_results([patient_id])
+
+
 def test_get_patient_ids(db):
     assert len(db.get_patient_ids()) == 5
     assert "1111111111" in db.get_patient_ids()
@@ -311,3 +410,398 @@ def test_get_curr_stats(db):
     assert stats["number_of_patients"] == 5
     assert stats["number_of_annotated_patients"] == 0
     assert stats["number_of_reviewed"] == 1
+
+
+def test_bulk_upsert_notes(db):
+    from app.ops import prepare_note
+    from tests.conftest import test_data
+
+    notes = [prepare_note(row.to_dict()) for _, row in test_data.head(5).iterrows()]
+    # Re-uploading notes that are already stored does not write anything
+    assert db.bulk_upsert_notes(notes) == 0
+
+    new_note = prepare_note({"text_id": "UNIQUE9999999999",
+                             "patient_id": "9999999999",
+                             "text": "New note.",
+                             "text_date": "2020-01-01"})
+    assert db.bulk_upsert_notes(notes + [new_note]) == 1
+
+    new_note["text"] = "Updated note."
+    assert db.bulk_upsert_notes([new_note]) == 1
+    assert db.mongo.db["NOTES"].find_one({"text_id": "UNIQUE9999999999"})["text"] == "Updated note."
+
+    db.mongo.db["NOTES"].delete_one({"text_id": "UNIQUE9999999999"})
+
+
+def test_bulk_upsert_notes_modified(db):
+    from app.ops import prepare_note
+
+    patient_id = "1111111111"
+    note_id = "MODIFIED0000000001"
+    note = prepare_note({"text_id": note_id, "patient_id": patient_id,
+                         "text": "Original note.", "text_date": "2010-01-01"})
+    assert db.bulk_upsert_notes([note]) == 1
+    db.mongo.db["ANNOTATIONS"].insert_one({"patient_id": patient_id, "note_id": note_id,
+                                           "text_date": datetime(2010, 1, 1), "sentence_number": 0,
+                                           "sentence": "modified match", "isNegated": False,
+                                           "reviewed": ReviewStatus.REVIEWED.value})
+    db.mongo.db["PINES"].insert_one({"patient_id": patient_id, "text_id": note_id,
+                                     "text_date": datetime(2010, 1, 1), "predicted_score": 0.99})
+    db.set_note_review_status({"text_id": note_id}, True, "test_user")
+    db.rebuild_patient_results([patient_id])
+    reviewed_notes = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})["reviewed_notes"]
+
+    # A note uploaded again with new contents is annotated again
+    modified_note = prepare_note({"text_id": note_id, "patient_id": patient_id,
+                                  "text": "Modified note.", "text_date": "2010-01-01"})
+    assert db.bulk_upsert_notes([modified_note]) == 1
+    assert db.mongo.db["ANNOTATIONS"].count_documents({"note_id": note_id}) == 0
+    assert db.mongo.db["PINES"].count_documents({"text_id": note_id}) == 0
+    assert db.get_note(note_id)["reviewed"] is False
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})
+    assert results["reviewed_notes"] == reviewed_notes - 1
+    assert results["max_score_note_id"] != note_id
+    assert "modified match" not in db.format_sentences(results["sentences"])
+
+    db.mongo.db["NOTES"].delete_one({"text_id": note_id})
+    db.rebuild_patient_results([patient_id])
+
+
+def test_incremental_patient_results(db):
+    patient_id = "2222222222"
+    db.rebuild_patient_results([patient_id])
+    annotations = [{"patient_id": patient_id, "note_id": "INCREMENT0000001",
+                    "text_date": datetime(2010, 1, day), "sentence_number": day,
+                    "sentence": f"sentence {day}", "isNegated": False,
+                    "reviewed": ReviewStatus.UNREVIEWED.value}
+                   for day in [1, 2, 3]]
+    db.mongo.db["ANNOTATIONS"].insert_many(annotations)
+    db.rebuild_patient_results([patient_id])
+
+    def get_results():
+        return db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})
+
+    assert get_results()["total_sentences"] == 3
+
+    db.mark_annotation_reviewed_batch([str(annotations[0]["_id"])], "test1")
+    results = get_results()
+    assert results["reviewed_sentences"] == 1
+    assert [sentence["reviewed"] for sentence in results["sentences"]
+            if sentence["annotation_id"] == annotations[0]["_id"]] == [True]
+
+    # Skipped annotations are removed from the listing and restored with the event date
+    db.mark_annotations_post_event(patient_id, datetime(2010, 1, 2))
+    assert get_results()["total_sentences"] == 1
+    assert len(get_results()["sentences"]) == 1
+    db.update_event_date(patient_id, datetime(2010, 1, 1), str(annotations[0]["_id"]))
+    db.add_comment(patient_id, " incremental ")
+    results = get_results()
+    assert results["event_date"] == datetime(2010, 1, 1)
+    assert results["event_information"] == "sentence 1\nNote_id : INCREMENT0000001"
+    assert results["comments"] == "incremental"
+
+    db.delete_event_date(patient_id)
+    db.revert_skipped_annotations(patient_id)
+    assert get_results()["total_sentences"] == 3
+    assert get_results()["event_information"] == ""
+
+    # The incremental updates give the same result as a full rebuild
+    results = get_results()
+    assert db.format_sentences(results["sentences"]).split("\n")[0] == \
+        "INCREMENT0000001:2010-01-01:sentence 1"
+    db.rebuild_patient_results([patient_id])
+    rebuilt = get_results()
+    for field in ["total_sentences", "reviewed_sentences", "reviewed_notes"]:
+        assert results[field] == rebuilt[field]
+    assert db.format_sentences(results["sentences"]) == db.format_sentences(rebuilt["sentences"])
+
+    db.mongo.db["ANNOTATIONS"].delete_many({"note_id": "INCREMENT0000001"})
+    db.add_comment(patient_id, "")
+    db.rebuild_patient_results([patient_id])
+
+
+def test_download_annotations(db):
+    from flask import g
+
+    uploads = {}
+
+    def put_object(bucket_name, object_name, data, length, part_size, content_type,
+                   metadata=None):
+        assert length == -1
+        uploads[object_name] = data.read()
+
+    g.bucket_name = "cedars-test"
+    mock_minio = MagicMock()
+    mock_minio.put_object.side_effect = put_object
+    with patch.object(db, "minio", new=mock_minio):
+        assert db.download_annotations("export.csv", get_sentences=True) is True
+
+    lines = uploads["annotated_files/export.csv"].decode().splitlines()
+    assert lines[0].split(",") == list(db.RESULTS_EXPORT_SCHEMA.keys())
+    assert len(lines) == 1 + db.get_total_counts("RESULTS")
+    assert lines[1].startswith(db.get_all_patient_ids()[0])
+
+    with patch.object(db, "minio", new=mock_minio):
+        assert db.download_annotations("export.parquet", export_format="parquet") is True
+        assert db.download_annotations("export.txt", export_format="txt") is False
+
+    frame = pl.read_parquet(io.BytesIO(uploads["annotated_files/export.parquet"]))
+    assert "sentences" not in frame.columns
+    assert frame.height == db.get_total_counts("RESULTS")
+    assert frame["patient_id"][0] == db.get_all_patient_ids()[0]
+
+
+def test_download_annotations_incremental(db):
+    from flask import g
+
+    uploads = {}
+
+    def put_object(bucket_name, object_name, data, length, part_size, content_type,
+                   metadata=None):
+        uploads[object_name] = (data.read(), metadata)
+
+    g.bucket_name = "cedars-test"
+    mock_minio = MagicMock()
+    mock_minio.put_object.side_effect = put_object
+    patient_id = db.get_all_patient_ids()[0]
+    with patch.object(db, "minio", new=mock_minio), \
+         patch.object(db, "EXPORT_WATERMARK_OVERLAP", timedelta(0)):
+        # The first incremental export contains every patient
+        assert db.download_annotations("first.csv", incremental=True) is True
+        db.add_comment(patient_id, "updated after the first export")
+        # Entries updated in the same millisecond as the watermark are exported again
+        time.sleep(0.01)
+        assert db.download_annotations("second.csv", incremental=True) is True
+        assert db.download_annotations("third.csv", incremental=True) is True
+
+    first, first_metadata = uploads["annotated_files/first.csv"]
+    assert len(first.decode().splitlines()) == 1 + db.get_total_counts("RESULTS")
+    assert first_metadata["export-since"] == ""
+
+    second, second_metadata = uploads["annotated_files/second.csv"]
+    lines = second.decode().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith(patient_id)
+    assert second_metadata["export-since"] == first_metadata["export-until"]
+
+    third, _ = uploads["annotated_files/third.csv"]
+    assert len(third.decode().splitlines()) == 1
+
+    db.add_comment(patient_id, "")
+    db.mongo.db["INFO"].update_one({}, {"$unset": {"export_watermarks": ""}})
+
+
+def test_download_annotations_incremental_predictions(db):
+    from flask import g
+
+    uploads = {}
+
+    def put_object(bucket_name, object_name, data, length, part_size, content_type,
+                   metadata=None):
+        uploads[object_name] = data.read()
+
+    g.bucket_name = "cedars-test"
+    mock_minio = MagicMock()
+    mock_minio.put_object.side_effect = put_object
+    patient_id = db.get_all_patient_ids()[0]
+    with patch.object(db, "minio", new=mock_minio), \
+         patch.object(db, "EXPORT_WATERMARK_OVERLAP", timedelta(0)):
+        assert db.download_annotations("first.csv", incremental=True) is True
+        time.sleep(0.01)
+        # PINES scores only reach RESULTS through rebuild_prediction_results
+        db.mongo.db["PINES"].insert_one({"patient_id": patient_id, "text_id": "INCREMENTAL01",
+                                         "text_date": datetime(2010, 1, 1),
+                                         "predicted_score": 0.5})
+        db.rebuild_prediction_results([patient_id])
+        assert db.download_annotations("second.csv", incremental=True) is True
+
+    lines = uploads["annotated_files/second.csv"].decode().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith(patient_id)
+    assert "INCREMENTAL01" in lines[1]
+
+    db.mongo.db["PINES"].delete_many({"patient_id": patient_id})
+    db.rebuild_prediction_results([patient_id])
+    db.mongo.db["INFO"].update_one({}, {"$unset": {"export_watermarks": ""}})
+
+
+def test_download_annotations_incremental_overlap(db):
+    from flask import g
+
+    uploads = {}
+
+    def put_object(bucket_name, object_name, data, length, part_size, content_type,
+                   metadata=None):
+        uploads[object_name] = data.read()
+
+    g.bucket_name = "cedars-test"
+    mock_minio = MagicMock()
+    mock_minio.put_object.side_effect = put_object
+    patient_id = db.get_all_patient_ids()[0]
+    with patch.object(db, "minio", new=mock_minio):
+        assert db.download_annotations("first.csv", incremental=True) is True
+        # An update stamped just before the watermark but committed after
+        # the first export read past it is exported by the next export
+        watermark = db.get_export_watermark("compact")
+        db.mongo.db["RESULTS"].update_many({}, {"$set": {"last_updated": datetime(2000, 1, 1)}})
+        db.mongo.db["RESULTS"].update_one({"patient_id": patient_id},
+                                          {"$set": {"last_updated": watermark - timedelta(minutes=1)}})
+        assert db.download_annotations("second.csv", incremental=True) is True
+
+    lines = uploads["annotated_files/second.csv"].decode().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith(patient_id)
+
+    db.mongo.db["INFO"].update_one({}, {"$unset": {"export_watermarks": ""}})
+
+
+def test_export_annotation_details(db):
+    from flask import g
+
+    annotations = [{"patient_id": "9999999999", "note_id": note_id,
+                    "text_date": datetime(2020, 1, day), "sentence_number": 0,
+                    "sentence_start": 0, "sentence_end": 10,
+                    "note_start_index": 0, "note_end_index": 4,
+                    "token": "test", "sentence": "test text.",
+                    "isNegated": False, "reviewed": ReviewStatus.UNREVIEWED.value}
+                   for day, note_id in [(2, "9999_b"), (1, "9999_a"), (1, "9999_a")]]
+    db.mongo.db["ANNOTATIONS"].insert_many(annotations)
+    db.mongo.db["PINES"].insert_one({"text_id": "9999_a", "patient_id": "9999999999",
+                                     "predicted_score": 0.75})
+
+    uploads = {}
+
+    def put_object(bucket_name, object_name, data, length, part_size, content_type):
+        uploads[object_name] = data.read()
+
+    g.bucket_name = "cedars-test"
+    mock_minio = MagicMock()
+    mock_minio.put_object.side_effect = put_object
+    with patch.object(db, "minio", new=mock_minio):
+        assert db.export_annotation_details("details", rows_per_part=2, batch_size=1) is True
+
+    total_annotations = db.get_total_counts("ANNOTATIONS")
+    assert len(uploads) == (total_annotations + 1) // 2
+    frame = pl.concat([pl.read_parquet(io.BytesIO(uploads[name]))
+                       for name in sorted(uploads)])
+    assert frame.columns == list(db.ANNOTATION_EXPORT_SCHEMA.keys())
+    assert frame.height == total_annotations
+
+    patient_rows = frame.filter(pl.col("patient_id") == "9999999999")
+    assert patient_rows["note_id"].to_list() == ["9999_a", "9999_a", "9999_b"]
+    assert patient_rows["predicted_score"].to_list() == [0.75, 0.75, None]
+
+    db.mongo.db["ANNOTATIONS"].delete_many({"patient_id": "9999999999"})
+    db.mongo.db["PINES"].delete_many({"patient_id": "9999999999"})
+
+
+def test_pending_annotations(db):
+    patient_id = db.get_patient_ids()[0]
+    annotations = [{"patient_id": patient_id, "note_id": f"{patient_id}_pending",
+                    "text_date": datetime(2020, 1, 1), "sentence_number": number,
+                    "sentence": "test text.", "isNegated": is_negated,
+                    "reviewed": ReviewStatus.UNREVIEWED.value}
+                   for number, is_negated in enumerate([False, False, True])]
+    annotation_ids = db.mongo.db["ANNOTATIONS"].insert_many(annotations).inserted_ids
+    db.rebuild_pending_annotations([patient_id])
+
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_id})
+    assert patient["pending_annotations"] == 2
+    assert db.get_patients_to_annotate() == patient_id
+
+    db.set_annotation_review_status({"_id": annotation_ids[0]}, ReviewStatus.REVIEWED)
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_id})
+    assert patient["pending_annotations"] == 1
+
+    db.set_annotation_review_status({"_id": annotation_ids[1]}, ReviewStatus.SKIPPED)
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_id})
+    assert patient["pending_annotations"] == 0
+    assert db.get_patients_to_annotate() is None
+
+    db.mongo.db["ANNOTATIONS"].delete_many({"_id": {"$in": annotation_ids}})
+    db.rebuild_patient_results([patient_id])
+
+
+def test_assign_duplicate_annotations(db):
+    patient_id = db.get_patient_ids()[0]
+    sentences = [("note_a", "Has a tumor."), ("note_a", " has a TUMOR."),
+                 ("note_b", "has a tumor."), ("note_b", "No tumor.")]
+    annotations = [{"patient_id": patient_id, "note_id": f"{patient_id}_{note_id}",
+                    "text_date": datetime(2020, 1, 1), "note_start_index": number,
+                    "sentence_number": number,
+                    "sentence": sentence, "isNegated": False,
+                    "reviewed": ReviewStatus.UNREVIEWED.value}
+                   for number, (note_id, sentence) in enumerate(sentences)]
+    annotation_ids = db.mongo.db["ANNOTATIONS"].insert_many(annotations).inserted_ids
+    assert db.get_sentence_hash("Has a tumor.") == db.get_sentence_hash(" has a TUMOR.")
+
+    # Duplicates within a note
+    assert db.assign_duplicate_annotations(patient_id, hide_duplicates=False) == 1
+    stored = {annotation["_id"]: annotation for annotation in
+              db.mongo.db["ANNOTATIONS"].find({"_id": {"$in": annotation_ids}})}
+    assert [stored[_id]["duplicate_of"] for _id in annotation_ids] == \
+        [None, annotation_ids[0], None, None]
+    assert stored[annotation_ids[1]]["reviewed"] == ReviewStatus.REVIEWED.value
+    assert stored[annotation_ids[2]]["reviewed"] == ReviewStatus.UNREVIEWED.value
+
+    # Duplicates across the notes of the patient
+    assert db.assign_duplicate_annotations(patient_id, hide_duplicates=True) == 2
+    canonical = db.get_all_annotations_for_patient(patient_id, include_duplicates=False)
+    assert [annotation["_id"] for annotation in canonical
+            if annotation["_id"] in annotation_ids] == [annotation_ids[0], annotation_ids[3]]
+    assert db.mongo.db["ANNOTATIONS"].find_one(
+        {"_id": annotation_ids[2]})["reviewed"] == ReviewStatus.REVIEWED.value
+
+    db.mongo.db["ANNOTATIONS"].delete_many({"_id": {"$in": annotation_ids}})
+    db.rebuild_patient_results([patient_id])
+
+
+def test_claim_next_patient(db):
+    patient_ids = db.get_patient_ids()[:2]
+    db.mongo.db["PATIENTS"].update_many({"patient_id": {"$in": patient_ids}},
+                                        {"$set": {"pending_annotations": 1}})
+
+    # Concurrent users are given different patients
+    assert db.claim_next_patient("first_user", 60) == patient_ids[0]
+    assert db.claim_next_patient("second_user", 60) == patient_ids[1]
+    assert db.claim_next_patient("third_user", 60) is None
+
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_ids[0]})
+    assert patient["locked"] is True
+    assert patient["locked_by"] == "first_user"
+    assert patient["lock_expires_at"] > datetime.now()
+
+    # Only the owner of a lock can claim the patient again
+    assert db.claim_patient(patient_ids[0], "second_user", 60) is False
+    assert db.claim_patient(patient_ids[0], "first_user", 60) is True
+
+    # Only the owner of a lock can release it
+    assert db.release_patient(patient_ids[1], "first_user") is False
+    assert db.release_patient(patient_ids[1], "second_user") is True
+    assert db.get_patient_lock_status(patient_ids[1]) is False
+
+    for patient_id in patient_ids:
+        db.set_patient_lock_status(patient_id, False)
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_ids[0]})
+    assert "locked_by" not in patient
+    assert db.claim_patient(patient_ids[0], "second_user", 60) is True
+
+    db.set_patient_lock_status(patient_ids[0], False)
+    db.rebuild_pending_annotations(patient_ids)
+
+
+def test_expired_patient_locks(db):
+    patient_id = db.get_patient_ids()[0]
+    # A lease that has already expired, e.g. a closed session
+    assert db.claim_patient(patient_id, "first_user", -1) is True
+    assert db.get_patient_lock_status(patient_id) is False
+    assert db.claim_patient(patient_id, "second_user", 60) is True
+    assert db.get_patient_lock_status(patient_id) is True
+
+    assert db.claim_patient(patient_id, "first_user", -1) is False
+    assert db.claim_patient(patient_id, "second_user", -1) is True
+    assert db.release_expired_locks() == 1
+    patient = db.mongo.db["PATIENTS"].find_one({"patient_id": patient_id})
+    assert patient["locked"] is False
+    assert "lock_expires_at" not in patient
+    assert db.release_expired_locks() == 0
@@ -0,0 +1,58 @@
+'''
+Automated tests for exporter.py
+'''
+import io
+import polars as pl
+import pyarrow.parquet as pq
+from app.exporter import IterStream, csv_chunks, parquet_chunks, ipc_chunks
+from app.exporter import get_export_format, iter_partitions
+
+
+def test_iter_stream():
+    stream = IterStream([b"ab", b"", b"cde", b"f"])
+    assert stream.read(4) == b"abcd"
+    assert stream.read() == b"ef"
+    assert stream.read(1) == b""
+
+
+def test_csv_chunks():
+    frames = [pl.DataFrame({"patient_id": ["1", "2"], "max_score": [0.5, None]}),
+              pl.DataFrame({"patient_id": ["3"], "max_score": [1.0]})]
+
+    chunks = list(csv_chunks(frames))
+
+    assert len(chunks) == 2
+    assert b"".join(chunks) == b"patient_id,max_score\n1,0.5\n2,\n3,1.0\n"
+
+
+def test_columnar_chunks():
+    frames = [pl.DataFrame({"patient_id": ["1", "2"], "max_score": [0.5, None]}),
+              pl.DataFrame({"patient_id": ["3"], "max_score": [1.0]})]
+    expected = pl.concat(frames)
+
+    parquet_file = b"".join(parquet_chunks(frames))
+    metadata = pq.ParquetFile(io.BytesIO(parquet_file)).metadata
+    assert metadata.num_row_groups == 2
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+    assert pl.read_parquet(io.BytesIO(parquet_file)).equals(expected)
+
+    ipc_file = b"".join(ipc_chunks(frames))
+    assert pl.read_ipc(io.BytesIO(ipc_file)).equals(expected)
+
+    assert list(parquet_chunks([])) == []
+
+
+def test_get_export_format():
+    assert get_export_format("annotations_full_test.parquet") == "parquet"
+    assert get_export_format("annotations_full_test.arrow") == "ipc"
+    assert get_export_format("annotations_full_test.csv") == "csv"
+
+
+def test_iter_partitions():
+    frames = [pl.DataFrame({"patient_id": [str(i)] * size})
+              for i, size in enumerate([3, 3, 3, 1, 5])]
+
+    partitions = [[frame.height for frame in part]
+                  for part in iter_partitions(frames, 5)]
+
+    assert partitions == [[3, 3], [3, 1], [5]]
@@ -0,0 +1,88 @@
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pytest
+from unittest.mock import patch
+from app import file_loader
+
+
+test_data = pd.read_csv(Path(__file__).parent / "simulated_patients.csv")
+
+
+def write_file(dataframe, filepath):
+    extension = file_loader.get_file_extension(filepath)
+    if extension == "csv":
+        dataframe.to_csv(filepath, index=False)
+    elif extension == "csv.gz":
+        dataframe.to_csv(filepath, index=False, compression="gzip")
+    elif extension == "parquet":
+        dataframe.to_parquet(filepath, index=False)
+    elif extension == "json":
+        dataframe.to_json(filepath, orient="records", lines=True)
+    elif extension == "xlsx":
+        dataframe.to_excel(filepath, index=False)
+    elif extension == "xml":
+        dataframe.to_xml(filepath, index=False, parser="etree")
+    else:
+        dataframe.to_pickle(filepath)
+
+
+@pytest.mark.parametrize("filename", ["notes.csv", "notes.csv.gz", "notes.parquet",
+                                      "notes.json", "notes.xlsx", "notes.xml", "notes.pkl"])
+def test_iter_record_batches(tmp_path, filename):
+    filepath = tmp_path / filename
+    write_file(test_data, filepath)
+
+    batches = list(file_loader.iter_record_batches(str(filepath), batch_size=40))
+
+    assert [batch.num_rows for batch in batches] == [40, 40, 23]
+    for batch in batches:
+        assert batch.schema.field("text_id").type == pa.string()
+        assert batch.schema.field("patient_id").type == pa.string()
+        assert batch.schema.field("text_date").type == pa.timestamp("ms")
+        assert batch.schema.field("text_tag_1").type == pa.string()
+
+    first_row = batches[0].to_pylist()[0]
+    assert first_row["patient_id"] == "1111111111"
+    assert first_row["text_id"] == "UNIQUE0000000001"
+    assert first_row["text_date"] == datetime.strptime(test_data["text_date"][0], "%Y-%m-%d")
+    assert first_row["text"] == test_data["text"][0]
+
+
+def test_json_array(tmp_path):
+    filepath = tmp_path / "notes.json"
+    test_data.to_json(filepath, orient="records")
+
+    batches = list(file_loader.iter_record_batches(str(filepath), batch_size=100))
+    assert sum(batch.num_rows for batch in batches) == len(test_data)
+
+
+@pytest.mark.parametrize("filename", ["notes.csv", "notes.csv.gz"])
+def test_csv_mixed_type_tags(tmp_path, filename):
+    filepath = tmp_path / filename
+    dataframe = pd.concat([test_data] * 20, ignore_index=True)
+    # A tag column that looks numeric in the first blocks
+    dataframe["text_tag_1"] = ["0012"] * (len(dataframe) - 1) + ["abc"]
+    write_file(dataframe, filepath)
+
+    with patch.object(file_loader, "CSV_BLOCK_SIZE", 64 * 1024):
+        batches = list(file_loader.iter_record_batches(str(filepath), batch_size=500))
+
+    tags = [tag for batch in batches for tag in batch.column("text_tag_1").to_pylist()]
+    assert len(tags) == len(dataframe)
+    assert tags[0] == "0012"
+    assert tags[-1] == "abc"
+
+
+def test_missing_columns(tmp_path):
+    filepath = tmp_path / "notes.csv"
+    test_data.drop(columns=["text_date"]).to_csv(filepath, index=False)
+
+    with pytest.raises(ValueError):
+        list(file_loader.iter_record_batches(str(filepath)))
+
+
+def test_unsupported_extension():
+    with pytest.raises(ValueError):
+        list(file_loader.iter_record_batches("notes.txt"))
@@ -0,0 +1,107 @@
+'''
+Automated tests for mongo_metrics.py
+'''
+from types import SimpleNamespace
+from unittest.mock import patch
+from prometheus_client import REGISTRY
+from app import auth
+from app import mongo_metrics
+
+
+def test_command_shape():
+    command = {"find": "PATIENTS",
+               "filter": {"patient_id": {"$in": ["1", "2"]}, "reviewed": False,
+                          "$or": [{"locked": False}, {"locked_by": "user"}]},
+               "sort": {"index_no": 1}}
+    assert mongo_metrics.get_command_shape("find", command) == {
+        "filter": {"patient_id": {"$in": ["?"]}, "reviewed": "?",
+                   "$or": [{"locked": "?"}, {"locked_by": "?"}]},
+        "sort": {"index_no": 1}}
+
+    command = {"update": "RESULTS",
+               "updates": [{"q": {"patient_id": "1"}, "u": {"$set": {"comments": "text"}}}]}
+    assert mongo_metrics.get_command_shape("update", command) == {
+        "updates": {"q": {"patient_id": "?"}, "u": {"$set": {"comments": "?"}}}}
+
+
+def test_aggregate_shape():
+    command = {"aggregate": "PATIENTS",
+               "pipeline": [
+                   {"$match": {"patient_id": {"$in": ["1", "2"]}, "reviewed": False}},
+                   {"$lookup": {"from": "RESULTS", "localField": "patient_id",
+                                "foreignField": "patient_id", "as": "results"}},
+                   {"$match": {"results": []}},
+                   {"$group": {"_id": "$patient_id", "count": {"$sum": 1},
+                               "comments": {"$first": "secret comment"}}},
+                   {"$sort": {"count": -1}},
+                   {"$merge": {"into": "RESULTS", "on": "patient_id"}}]}
+    assert mongo_metrics.get_command_shape("aggregate", command) == {"pipeline": [
+        {"$match": {"patient_id": {"$in": ["?"]}, "reviewed": "?"}},
+        {"$lookup": {"from": "RESULTS", "localField": "patient_id",
+                     "foreignField": "patient_id", "as": "results"}},
+        {"$match": {"results": []}},
+        {"$group": {"_id": "$patient_id", "count": {"$sum": "?"},
+                    "comments": {"$first": "?"}}},
+        {"$sort": {"count": -1}},
+        {"$merge": {"into": "RESULTS", "on": "patient_id"}}]}
+
+
+def test_get_more_collection(cedars_app):
+    listener = mongo_metrics.MongoCommandListener(cedars_app.redis, slow_query_ms=1000)
+    labels = {"collection": "NOTES", "command": "getMore"}
+    count = REGISTRY.get_sample_value("cedars_mongo_command_duration_seconds_count",
+                                      labels) or 0
+
+    listener.started(SimpleNamespace(command_name="getMore", connection_id=("db", 1),
+                                     request_id=1,
+                                     command={"getMore": 123456789, "collection": "NOTES"}))
+    listener.succeeded(SimpleNamespace(command_name="getMore", connection_id=("db", 1),
+                                       request_id=1, duration_micros=1000))
+
+    assert REGISTRY.get_sample_value("cedars_mongo_command_duration_seconds_count",
+                                     labels) == count + 1
+
+
+def test_mongo_command_listener(cedars_app):
+    redis = cedars_app.redis
+    redis.delete(mongo_metrics.SLOW_QUERY_KEY)
+    listener = mongo_metrics.MongoCommandListener(redis, slow_query_ms=100)
+    labels = {"collection": "NOTES", "command": "find"}
+    count = REGISTRY.get_sample_value("cedars_mongo_command_duration_seconds_count",
+                                      labels) or 0
+
+    for request_id, duration_micros in enumerate([1000, 250000]):
+        listener.started(SimpleNamespace(command_name="find", connection_id=("db", 1),
+                                         request_id=request_id,
+                                         command={"find": "NOTES",
+                                                  "filter": {"text_id": "note_1"}}))
+        listener.succeeded(SimpleNamespace(command_name="find", connection_id=("db", 1),
+                                           request_id=request_id,
+                                           duration_micros=duration_micros))
+
+    assert REGISTRY.get_sample_value("cedars_mongo_command_duration_seconds_count",
+                                     labels) == count + 2
+    # Only the slow command is logged, without the values of its filter
+    slow_queries = mongo_metrics.get_slow_queries(redis)
+    assert len(slow_queries) == 1
+    assert slow_queries[0]["collection"] == "NOTES"
+    assert slow_queries[0]["duration_ms"] == 250.0
+    assert slow_queries[0]["shape"] == {"filter": {"text_id": "?"}}
+    redis.delete(mongo_metrics.SLOW_QUERY_KEY)
+
+
+def test_slow_queries_page(db, client, cedars_app):
+    listener = mongo_metrics.MongoCommandListener(cedars_app.redis, slow_query_ms=0)
+    listener.started(SimpleNamespace(command_name="count", connection_id=("db", 1),
+                                     request_id=1,
+                                     command={"count": "ANNOTATIONS",
+                                              "query": {"patient_id": "1"}}))
+    listener.succeeded(SimpleNamespace(command_name="count", connection_id=("db", 1),
+                                       request_id=1, duration_micros=5000))
+
+    with patch.object(auth, "current_user", SimpleNamespace(is_admin=True)):
+        response = client.get("/ops/slow_queries")
+    assert response.status_code == 200
+    assert b"Slow Database Queries" in response.data
+    assert b"ANNOTATIONS" in response.data
+    cedars_app.redis.delete(mongo_metrics.SLOW_QUERY_KEY)
@@ -0,0 +1,56 @@
+'''
+Automated tests for note_cache.py
+'''
+from unittest.mock import patch
+from app import note_cache
+
+
+def test_lru_cache():
+    cache = note_cache.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used entry
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_get_note(db):
+    note_cache.clear()
+    note = db.get_all_notes("1111111111")[0]
+
+    with patch.object(db, "get_note", wraps=db.get_note) as get_note:
+        assert note_cache.get_note(note["text_id"], "1111111111")["text"] == note["text"]
+        assert note_cache.get_note(note["text_id"], "1111111111")["text"] == note["text"]
+        assert get_note.call_count == 1
+
+        # Notes are read again once the review status of a note of the patient changes
+        is_reviewed = not note.get("reviewed", False)
+        db.set_note_review_status({"text_id": note["text_id"]}, is_reviewed, "test_user")
+        assert note_cache.get_note(note["text_id"], "1111111111")["reviewed"] is is_reviewed
+        assert get_note.call_count == 2
+
+        # or once the stored notes change
+        db.bump_notes_version()
+        note_cache.get_note(note["text_id"], "1111111111")
+        assert get_note.call_count == 3
+
+    assert note_cache.get_note("missing_note", "1111111111") is None
+    db.set_note_review_status({"text_id": note["text_id"]}, note.get("reviewed", False),
+                              note.get("reviewed_by"))
+
+
+def test_cached_highlighter(db):
+    note = db.get_all_notes("1111111111")[0]
+    annotations = [{"note_start_index": 0, "note_end_index": 4}]
+    highlighter = note_cache.CachedSentenceHighlighter()
+
+    highlighted_text = highlighter.get_highlighted_text(note, annotations)
+    assert f"<b><mark>{note['text'][:4]}</mark></b>" in highlighted_text
+    with patch.object(note_cache.SentenceHighlighter, "get_highlighted_text") as highlight:
+        assert highlighter.get_highlighted_text(note, annotations) == highlighted_text
+        highlighter.get_highlighted_text(note, [])
+        assert highlight.call_count == 1
@@ -254,3 +254,38 @@ def test_stat_elements_to_int(input_dict, output_dict):
         assert key in result
         assert result[key] == output_dict[key]
         isinstance(result[key], int)
+
+
+def test_enqueue_patient_results_update(cedars_app, db):
+    from rq.job import JobStatus
+    from rq.registry import ScheduledJobRegistry
+    from app.ops import enqueue_patient_results_update, update_dirty_patient_results
+
+    patient_id = "3333333333"
+    # Repeated requests for a patient are coalesced into one pending job
+    first_job = enqueue_patient_results_update(patient_id, "first_user")
+    second_job = enqueue_patient_results_update(patient_id, "second_user")
+    assert first_job.id == second_job.id
+    registry = ScheduledJobRegistry(queue=cedars_app.ops_queue)
+    assert registry.get_job_ids() == [first_job.id]
+
+    # The job applies the latest request once
+    assert update_dirty_patient_results(patient_id) is True
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})
+    assert results["reviewer"] == "second_user"
+    assert update_dirty_patient_results(patient_id) is False
+
+    # A request made after a running job has read the marker
+    # is applied by a follow up job
+    first_job.set_status(JobStatus.STARTED)
+    assert update_dirty_patient_results(patient_id) is False
+    third_job = enqueue_patient_results_update(patient_id, "third_user")
+    assert third_job.id == f"{first_job.id}_1"
+    assert enqueue_patient_results_update(patient_id, "fourth_user").id == third_job.id
+    assert first_job.get_status() == JobStatus.STARTED
+    assert update_dirty_patient_results(patient_id) is True
+    results = db.mongo.db["RESULTS"].find_one({"patient_id": patient_id})
+    assert results["reviewer"] == "fourth_user"
+
+    registry.remove(third_job, delete_job=True)
+    registry.remove(first_job, delete_job=True)